@@ -0,0 +1,934 @@
+#!/usr/bin/python
+
+#-------------------------------------------------------------------------------
+# Name:        benchmark.py
+# Purpose:     Timing harness for the hot paths of Neptune Pool and Spa Automation.
+#              Every benchmark runs against a throwaway home directory so that the
+#              real device info and log files are never touched.
+#
+# Author:      alji
+#
+# Created:     18/10/2026
+# Copyright:   (c) alji 2026
+# Licence:     <your licence>
+#-------------------------------------------------------------------------------
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import argparse
+from datetime import datetime, timedelta
+
+from modules.neptune.crown import NeptuneCrown
+from modules.neptune.logger import NeptuneLogger, NeptuneLogEntry, FlushPolicy, formatLogTime
+from modules.neptune.writer import DiskWriter
+from modules.neptune.devices import DeviceManager
+from modules.neptune.routing import SerialRouter
+from modules.neptune.framing import FrameDecoder, encodeFrame
+from modules.neptune.outbound import OutboundQueue, CRITICAL, NORMAL, BULK, LANE_NAMES, CRITICAL_COMMANDS
+from modules.neptune.outbound import SEQUENCE_MARK, BITS_PER_BYTE, ACK_WINDOW
+
+###################################
+## HELPERS
+###################################
+# Extra milliseconds added to every fsync, to stand in for the controller's SD card
+SIMULATED_FSYNC_MS = 0
+
+class IsolatedHome(object):
+    """
+    Context manager which points HOME at a temporary directory for the duration of a
+    benchmark, so that loggers and device managers read and write scratch files.
+    """
+    def __enter__(self):
+        self.path = tempfile.mkdtemp(prefix='neptuneBench')
+        self.saved = dict((key, os.environ.get(key)) for key in ('HOME', 'HOMEPATH'))
+        os.environ.pop('HOMEPATH', None)
+        os.environ['HOME'] = self.path
+        return self.path
+
+    def __exit__(self, *exc):
+        for key, value in self.saved.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+        shutil.rmtree(self.path, ignore_errors=True)
+
+# Seeded logs cycle through these destinations, and one entry in COMMENT_EVERY is a comment
+SEED_DESTINATIONS = ('2007', '2008', '2000', '2001', '2002', '2003', '2004', '2005', '2006', '1102')
+COMMENT_EVERY = 1000
+
+def seedEntry(i, start=datetime(2013, 4, 3)):
+    """
+    Builds the i'th entry of a seeded log, one second after the one before it.
+    :rtype: NeptuneLogEntry
+    """
+    logTime = formatLogTime(start + timedelta(seconds=i))
+    if i % COMMENT_EVERY == 0:
+        return NeptuneLogEntry(entryType="comment", author='0000', logTime=logTime,
+                               entryBody="Seeded comment %s" % i)
+    devId = SEED_DESTINATIONS[i % len(SEED_DESTINATIONS)]
+    return NeptuneLogEntry(entryType="command",
+                           author='1000',
+                           destination=devId,
+                           logTime=logTime,
+                           entryBody="Updating sensor device %s to 80." % devId,
+                           success=('>%sn80' % devId, "Device %s has been updated to value 80." % devId))
+
+def seedLog(home, size):
+    """
+    Writes a log of the requested size straight to disk, without going through the logger.
+    :param home: Home directory holding the log
+    :type home: str
+    :param size: Number of entries to write
+    :type size: int
+    :return: None
+    """
+    with open(os.path.join(home, '.neptuneLog.jsonl'), 'w') as logFile:
+        for i in range(size):
+            entry = seedEntry(i)
+            record = entry.data
+            record['logTime'] = entry.logTime
+            logFile.write(json.dumps(record) + "\n")
+
+class SlowFsync(object):
+    """
+    Context manager adding SIMULATED_FSYNC_MS to every os.fsync, and counting them.
+    """
+    def __enter__(self):
+        self.count = 0
+        self.realFsync = os.fsync
+        def slowFsync(fd):
+            self.count += 1
+            self.realFsync(fd)
+            time.sleep(SIMULATED_FSYNC_MS / 1000.0)
+        os.fsync = slowFsync
+        return self
+
+    def __exit__(self, *exc):
+        os.fsync = self.realFsync
+
+def bestPerCall(func, count, repeat=5, budget=0.25):
+    """
+    Times count calls of func, repeat times over, and returns the best mean in microseconds.
+    Taking the best run keeps other work on the machine from showing up as a regression.
+    Slow calls are made fewer times, so that each run takes about budget seconds at most.
+    :rtype: float
+    """
+    first = timePerCall(func, 1) / 1000.0
+    count = max(1, min(count, int(budget / max(first, 1e-9))))
+    return min(timePerCall(func, count) for i in range(repeat)) * 1000.0
+
+def timePerCall(func, count):
+    """
+    Calls func count times and returns the mean wall time of a call in milliseconds.
+    :param func: Callable taking no arguments
+    :param count: Number of calls to average over
+    :type count: int
+    :rtype: float
+    """
+    start = time.time()
+    for i in range(count):
+        func()
+    return (time.time() - start) * 1000.0 / count
+
+###################################
+## BENCHMARKS
+###################################
+def benchCrownPerRequest(logSizes, requests):
+    """
+    Compares the cost of a /switch request when every request builds its own crown (the
+    old behavior) with one crown shared for the life of the reactor.
+    :return: rows of (log size, ms per request fresh, ms per request shared)
+    :rtype: list
+    """
+    rows = []
+    for size in logSizes:
+        with IsolatedHome() as home:
+            seedLog(home, size)
+            def fresh():
+                NeptuneCrown().setSwitchDevice('2002', '1', author='0001')
+            freshMs = timePerCall(fresh, requests)
+
+        with IsolatedHome() as home:
+            seedLog(home, size)
+            crown = NeptuneCrown()
+            def shared():
+                crown.setSwitchDevice('2002', '1', author='0001')
+            sharedMs = timePerCall(shared, requests)
+        rows.append((size, freshMs, sharedMs))
+    return rows
+
+def benchLogAppend(logSizes, requests):
+    """
+    Measures the cost of logging one command, and of loading the log, at each log size.
+    :return: rows of (log size, ms per logCommand, ms to load)
+    :rtype: list
+    """
+    rows = []
+    for size in logSizes:
+        with IsolatedHome() as home:
+            seedLog(home, size)
+            start = time.time()
+            # The seeded log is old and may be large; rolling it over would be timed as
+            #  the first append
+            logger = NeptuneLogger('0000', maxSegmentBytes=None, maxSegmentAge=None)
+            loadMs = (time.time() - start) * 1000.0
+            def logOne():
+                logger.logCommand('2002', "Switch device 2002 to 1.", ('>2002s1', "Pump on"))
+            rows.append((size, timePerCall(logOne, requests), loadMs))
+    return rows
+
+def benchIndexes(logSizes, requests):
+    """
+    Compares the indexed per-device and per-type queries with the full scans they replaced.
+    One device in SEED_DESTINATIONS receives a tenth of the log, comments are far rarer.
+    :return: rows of (log size, results, ms scanned, ms indexed) for each query
+    :rtype: list
+    """
+    rows = []
+    for size in logSizes:
+        with IsolatedHome() as home:
+            seedLog(home, size)
+            logger = NeptuneLogger('0000')
+            log = logger.log
+
+            def scanDestination():
+                return [entry for entry in log if log[entry]['destination'] == '2007']
+            def scanComments():
+                return [entry for entry in log if log[entry]['entryType'] == 'comment']
+
+            for (label, scan, indexed) in (
+                    ('dest 2007', scanDestination, lambda: logger.getByDestination('2007')),
+                    ('comments', scanComments, logger.getComments)):
+                results = len(indexed())
+                assert results == len(scan())
+                rows.append(("%s %s" % (size, label), results,
+                             timePerCall(scan, requests), timePerCall(indexed, requests)))
+    return rows
+
+def benchArchive(logSizes, requests):
+    """
+    Rolls a seeded log over into a single archived segment and scans it for one device,
+    first as plain JSON lines and again once compressed, then looks up its comments, which
+    only the blocks holding one are read for.
+    :return: rows of (segment entries, raw KB, compressed KB, ratio, raw scan MB/s,
+    compressed scan MB/s, ms to find comments), scan rates measured over the uncompressed bytes
+    :rtype: list
+    """
+    rows = []
+    for size in logSizes:
+        with IsolatedHome() as home:
+            seedLog(home, size)
+            logger = NeptuneLogger('0000', maxSegmentBytes=None, maxSegmentAge=None)
+            logger.rollOver()
+            archive = logger.archive
+            rawBytes = archive.segments[0]['bytes']
+
+            def scan():
+                for entry in archive.iterEntries(field='destination', value='2007'):
+                    pass
+            rawMs = timePerCall(scan, requests)
+            archive.compressPending()
+            compressedMs = timePerCall(scan, requests)
+            compressedBytes = archive.segments[0]['compressedBytes']
+            def findComments():
+                for entry in archive.iterEntries(field='entryType', value='comment'):
+                    pass
+            commentsMs = timePerCall(findComments, requests)
+
+            rows.append((size, rawBytes / 1024.0, compressedBytes / 1024.0,
+                         float(rawBytes) / compressedBytes,
+                         rawBytes / 1024.0 / 1024.0 / (rawMs / 1000.0),
+                         rawBytes / 1024.0 / 1024.0 / (compressedMs / 1000.0), commentsMs))
+    return rows
+
+def benchReactorStall(logSizes, requests):
+    """
+    Measures how long the calling (reactor) thread is held by a /switch request when files
+    are written inline, and when they are handed to a DiskWriter. Write-behind is left off,
+    so every request saves the device file with an fsync and appends to the log.
+    :return: rows of (writer, mean ms, worst ms) held on the calling thread
+    :rtype: list
+    """
+    rows = []
+    for (label, makeWriter) in (('inline', lambda: None), ('disk writer', DiskWriter)):
+        with IsolatedHome(), SlowFsync():
+            writer = makeWriter()
+            if writer is not None:
+                writer.start()
+            crown = NeptuneCrown(writer=writer)
+            samples = []
+            for i in range(requests):
+                start = time.time()
+                crown.setSwitchDevice('2002', str(i % 2), author='0001')
+                samples.append((time.time() - start) * 1000.0)
+            if writer is not None:
+                writer.stop()
+        rows.append((label, sum(samples) / len(samples), max(samples)))
+    return rows
+
+def benchGroupCommit(logSizes, requests):
+    """
+    Logs a burst of sensor readings under several flush policies, and measures the time
+    until all of it is durable on disk, along with the fsyncs it took.
+    :return: rows of (policy, fsyncs, ms until durable)
+    :rtype: list
+    """
+    policies = (('every entry', FlushPolicy(), False),
+                ('every 10', FlushPolicy(maxEntries=10), False),
+                ('every 100', FlushPolicy(maxEntries=100), False),
+                ('one batch', FlushPolicy(), True))
+    rows = []
+    for (label, policy, batched) in policies:
+        with IsolatedHome(), SlowFsync() as fsyncs:
+            writer = DiskWriter()
+            writer.start()
+            logger = NeptuneLogger('1000', writer=writer, flushPolicy=policy)
+            entries = [seedEntry(i) for i in range(1, requests + 1)]
+            for entry in entries:
+                entry.logTime = None
+                entry.entryType = "command"
+            writer.drain()
+            fsyncs.count = 0
+
+            start = time.time()
+            if batched:
+                logger.logMany(entries)
+            else:
+                for entry in entries:
+                    logger.logCommand(entry.destination, entry.entryBody, entry.success)
+            logger.flush()
+            writer.drain()
+            rows.append((label, fsyncs.count, (time.time() - start) * 1000.0))
+            writer.stop()
+    return rows
+
+def benchLanes(logSizes, requests):
+    """
+    Floods a 9600 baud link with device commands and probes, far more than it can carry,
+    while heater and fill valve shut-offs arrive now and then, and measures how long the
+    commands in each lane wait for the link: first without acks, then with an ack window
+    and one ack in three never coming back, so the window is mostly full. Checks that a
+    shut-off never waits longer than the command on the wire plus one for each other
+    critical device, and that probes still get through.
+    :return: rows of (lane, sent, mean ms waited, worst ms waited)
+    :rtype: list
+    """
+    rows = []
+    for (window, suffix) in ((None, ''), (ACK_WINDOW, ', acks')):
+        waits = laneWaits(requests, window)
+        rows.extend((name + suffix, len(waits[name]), sum(waits[name]) / max(len(waits[name]), 1),
+                     max(waits[name] or [0.0])) for name in LANE_NAMES)
+    return rows
+
+def laneWaits(requests, window):
+    """
+    Runs the flood for benchLanes.
+    :param window: Ack window, or None to send without acks
+    :type window: int
+    :return: milliseconds waited by each command sent, by lane name
+    :rtype: dict
+    """
+    from twisted.internet.task import Clock
+    clock = Clock()
+    tick = 0.001
+    queued = {}
+    waits = dict((name, []) for name in LANE_NAMES)
+    def transmit(command):
+        (command, mark, seq) = command.partition(SEQUENCE_MARK)
+        if seq and int(seq) % 3:
+            clock.callLater(0.02, outbound.ack, command[1:5], seq)
+        # Retries were timed when first sent
+        if command in queued:
+            (lane, since) = queued.pop(command)
+            waits[LANE_NAMES[lane]].append((clock.seconds() - since) * 1000.0)
+    outbound = OutboundQueue(transmit, clock.callLater, 9600, overhead=6, window=window)
+    def put(command, lane):
+        # A command replacing one still waiting is timed from when the first arrived
+        queued.setdefault(command, (lane, clock.seconds()))
+        outbound.put(command, lane)
+
+    devices = ['1100', '1101', '2000', '2001', '2002', '2007', '2008', '3000', '3001', '3002', '3003']
+    probe = "I like you. %05d"
+    for i in range(requests * 1000):
+        devId = devices[i % len(devices)]
+        queued.pop('>%ss%s' % (devId, (i + 1) % 2), None)
+        put('>%ss%s' % (devId, i % 2), NORMAL)
+        if i % 10 == 0:
+            put(probe % i, BULK)
+        if i % 97 == 0:
+            put(CRITICAL_COMMANDS[i % len(CRITICAL_COMMANDS)], CRITICAL)
+        clock.advance(tick)
+
+    # Waits are measured in whole ticks, so allow one on top of the link time
+    bound = (len(CRITICAL_COMMANDS) * outbound.transmitTime(probe % 0) + tick) * 1000.0
+    worst = max(waits['critical'])
+    assert worst <= bound, "Critical command waited %.3f ms, bound %.3f ms" % (worst, bound)
+    assert waits['bulk'], "Bulk lane starved"
+    return waits
+
+def benchFraming(logSizes, requests):
+    """
+    Compares sensor readings sent as text lines with the same readings in binary frames of
+    several sizes: bytes on the wire for each reading, the readings a 9600 baud link can
+    carry each second, and the cost of decoding them.
+    :return: rows of (format, bytes/reading, readings/s at 9600 baud, us to decode a reading)
+    :rtype: list
+    """
+    count = requests * 1000
+    readings = [(devId, 'n', str(60 + i % 40))
+                for (i, devId) in enumerate(SEED_DESTINATIONS[i % 2] for i in range(count))]
+
+    def decodeLines(stream):
+        decoded = []
+        for line in stream.split('\r\n')[:-1]:
+            decoded.append((line[0:4], line[4], line[5:]))
+        return decoded
+    streams = [('text lines', ''.join('%s%s%s\r\n' % reading for reading in readings), decodeLines)]
+    for perFrame in (1, 8, 64):
+        stream = ''.join(encodeFrame(readings[i:i + perFrame]) for i in range(0, count, perFrame))
+        # Bytes arrive from the port in chunks of a few dozen
+        chunks = [stream[i:i + 32] for i in range(0, len(stream), 32)]
+        def decodeFrames(stream, chunks=chunks):
+            decoder = FrameDecoder()
+            decoded = []
+            for chunk in chunks:
+                decoded.extend(decoder.feed(chunk))
+            return decoded
+        streams.append(('frames of %s' % perFrame, stream, decodeFrames))
+
+    rows = []
+    for (label, stream, decode) in streams:
+        assert decode(stream) == readings
+        perReading = float(len(stream)) / count
+        rows.append((label, perReading, 9600 / 10.0 / perReading,
+                     timePerCall(lambda: decode(stream), 3) * 1000.0 / count))
+    return rows
+
+def percentile(samples, q):
+    """
+    The q'th quantile of samples, e.g. q=0.95.
+    :rtype: float
+    """
+    ordered = sorted(samples)
+    return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+def benchAcks(logSizes, requests):
+    """
+    Sends commands to a simulated Arduino which works through them one at a time, taking
+    ARDUINO_MS each, and acknowledges them over the return link; one command in
+    DROP_EVERY is lost. Compares waiting for each ack before sending the next command with
+    letting several await their acks at once.
+    :return: rows of (ack window, commands/s, p50 ms, p95 ms, retries, failed)
+    :rtype: list
+    """
+    from twisted.internet.task import Clock
+    ARDUINO_MS = 10.0
+    DROP_EVERY = 25
+    devices = ['1100', '1101', '2000', '2001', '2002', '2003', '2004', '3000', '3001', '3002', '3003']
+    rows = []
+    for window in (1, 2, 4, 8):
+        clock = Clock()
+        arduino = {'busyUntil': 0.0, 'received': 0}
+        latencies = []
+        total = requests * 20
+        queued = [0]
+
+        def transmit(command):
+            arduino['received'] += 1
+            if arduino['received'] % DROP_EVERY == 0:
+                return
+            (command, seq) = command.split(SEQUENCE_MARK)
+            arrived = clock.seconds() + outbound.transmitTime(command + SEQUENCE_MARK + seq)
+            done = max(arrived, arduino['busyUntil']) + ARDUINO_MS / 1000.0
+            arduino['busyUntil'] = done
+            ack = "%sa%s\r\n" % (command[1:5], seq)
+            ackTime = len(ack) * BITS_PER_BYTE / 9600.0
+            clock.callLater(done + ackTime - clock.seconds(), outbound.ack, command[1:5], seq)
+
+        def nextCommand(devId):
+            if queued[0] < total:
+                outbound.put('>%ss%s' % (devId, queued[0] % 2))
+                queued[0] += 1
+
+        def acked(record, latency):
+            latencies.append(latency * 1000.0)
+            nextCommand(record.devId)
+
+        def failed(record):
+            nextCommand(record.devId)
+
+        outbound = OutboundQueue(transmit, clock.callLater, 9600, overhead=6, window=window,
+                                 ackTimeout=0.25, seconds=clock.seconds,
+                                 onAck=acked, onFailure=failed)
+        for devId in devices:
+            nextCommand(devId)
+        while outbound.depth or outbound.inFlight:
+            clock.advance(0.0005)
+        rows.append((window, len(latencies) / clock.seconds(), percentile(latencies, 0.5),
+                     percentile(latencies, 0.95), outbound.retried, outbound.failed))
+    return rows
+
+def benchLinks(logSizes, requests):
+    """
+    Keeps a command waiting for every default device at all times, and counts the commands
+    carried each second when the devices are spread over one, two and three 9600 baud links
+    by ID range.
+    :return: rows of (links, commands/s, commands/s per link)
+    :rtype: list
+    """
+    from twisted.internet.task import Clock
+    devices = ['1100', '1101', '1102', '2000', '2001', '2002', '2003', '2004', '2005', '2006',
+               '3000', '3001', '3002', '3003']
+    layouts = (((1000, 9999),),
+               ((1000, 1999), (2000, 9999)),
+               ((1000, 1999), (2000, 2999), (3000, 9999)))
+    rows = []
+    for layout in layouts:
+        clock = Clock()
+        router = SerialRouter()
+        sent = [0]
+
+        class Link(object):
+            def __init__(self):
+                self.outbound = OutboundQueue(self.transmit, clock.callLater, 9600, overhead=6)
+            queueDepth = property(lambda self: self.outbound.depth)
+            def serialWrite(self, data, lane=None):
+                self.outbound.put(data, lane)
+                return True
+            def transmit(self, command):
+                sent[0] += 1
+                # The device wants another change as soon as this one is on its way
+                devId = command[1:5]
+                router.serialWrite('>%ss%s' % (devId, sent[0] % 2))
+
+        for (low, high) in layout:
+            router.addLink(Link(), low, high)
+        for devId in devices:
+            router.serialWrite('>%ss1' % devId)
+        seconds = requests / 2.0
+        clock.pump([0.001] * int(seconds * 1000))
+        rate = sent[0] / seconds
+        rows.append((len(layout), rate, rate / len(layout)))
+    return rows
+
+def benchIngest(logSizes, requests):
+    """
+    Records what the simulated Arduino sends in a simulated second per request, as text lines
+    and as frames, with and without malformed lines, and then times the serial resource
+    taking it all in: parsing, updating the sensor devices and logging every reading. The
+    service's own output is discarded while timing, as when it runs with output redirected.
+    :return: rows of (format, malformed, readings, readings/s taken in, bad lines)
+    :rtype: list
+    """
+    from twisted.internet.task import Clock
+    from twisted.test.proto_helpers import StringTransport
+    from modules.neptune.simulator import ArduinoSimulator
+    from modules.neptune.framing import FRAMES_ACCEPTED
+    import main
+
+    rows = []
+    for (framed, malformedEvery) in ((False, 0), (False, 100), (True, 0), (True, 100)):
+        clock = Clock()
+        simulator = ArduinoSimulator(clock.callLater, rate=50, jitter=0.2,
+                                     malformedEvery=malformedEvery, seed=1)
+        simulator.makeConnection(StringTransport())
+        simulator.framed = framed
+        clock.pump([0.001] * (requests * 1000))
+        stream = simulator.transport.value()
+        chunks = [stream[i:i + 64] for i in range(0, len(stream), 64)]
+
+        with IsolatedHome():
+            crownClock = Clock()
+            crown = NeptuneCrown(callLater=crownClock.callLater,
+                                 flushPolicy=FlushPolicy(maxEntries=32, maxDelay=0.25))
+            serial = main.SerialResource()
+            serial.setCrown(crown)
+            serial.makeConnection(StringTransport())
+            if framed:
+                serial.lineReceived(FRAMES_ACCEPTED)
+            stdout = sys.stdout
+            sys.stdout = open(os.devnull, 'w')
+            try:
+                start = time.time()
+                for chunk in chunks:
+                    serial.dataReceived(chunk)
+                elapsed = time.time() - start
+            finally:
+                sys.stdout = stdout
+            rows.append(('frames' if framed else 'text lines', malformedEvery and "1 in %s" % malformedEvery,
+                         serial.readingsIn, serial.readingsIn / elapsed, serial.badLines))
+    return rows
+
+def benchShedding(logSizes, requests):
+    """
+    Feeds the serial resource what the simulated Arduino sends in a simulated second per
+    request, 50 readings a second from each sensor, in 10 ms chunks on a simulated clock:
+    as usual, eased off as when the reactor is overloaded but before the Arduino has slowed
+    down, and eased off with the Arduino slowed down too. Counts the crown updates the
+    readings cost, and times taking them all in with the service's output discarded.
+    :return: rows of (mode, readings, crown updates, readings shed, readings/s taken in)
+    :rtype: list
+    """
+    from twisted.internet.task import Clock
+    from twisted.test.proto_helpers import StringTransport
+    from modules.neptune.simulator import ArduinoSimulator
+    from modules.neptune.lag import OVERLOAD_SLOWDOWN
+    import main
+
+    rows = []
+    for (mode, easedOff, slowdown) in (('as usual', False, 1), ('eased off', True, 1),
+                                       ('eased off, slowed', True, OVERLOAD_SLOWDOWN)):
+        clock = Clock()
+        simulator = ArduinoSimulator(clock.callLater, rate=50, jitter=0.2, seed=1)
+        simulator.slowdown = slowdown
+        simulator.makeConnection(StringTransport())
+        chunks = []
+        for tick in range(requests * 100):
+            clock.advance(0.01)
+            chunks.append(simulator.transport.value())
+            simulator.transport.clear()
+
+        with IsolatedHome():
+            crownClock = Clock()
+            crown = NeptuneCrown(callLater=crownClock.callLater,
+                                 flushPolicy=FlushPolicy(maxEntries=32, maxDelay=0.25))
+            updates = [0]
+            updateSensorDevice = crown.updateSensorDevice
+            def countedUpdate(*args, **kwargs):
+                updates[0] += 1
+                return updateSensorDevice(*args, **kwargs)
+            crown.updateSensorDevice = countedUpdate
+            serial = main.SerialResource(callLater=crownClock.callLater)
+            serial.setCrown(crown)
+            serial.makeConnection(StringTransport())
+            stdout = sys.stdout
+            sys.stdout = open(os.devnull, 'w')
+            try:
+                if easedOff:
+                    serial.easeOff()
+                start = time.time()
+                for chunk in chunks:
+                    serial.dataReceived(chunk)
+                    crownClock.advance(0.01)
+                elapsed = time.time() - start
+            finally:
+                sys.stdout = stdout
+            rows.append((mode, serial.readingsIn, updates[0], serial.readingsShed,
+                         serial.readingsIn / elapsed))
+    return rows
+
+# Spa mode: both pump valves to the spa, the pump and heater on, and the heater set
+SPA_MODE = (('2000', '1'), ('2001', '1'), ('2002', '1'), ('2005', '1'), ('2003', '102'))
+
+def benchScene(logSizes, requests):
+    """
+    Turns on spa mode once per request, as one /switch or /step call per device and as a
+    single batch, with device state and the log written as soon as they change. Counts the
+    file writes, fsyncs and serial writes each costs, and times it.
+    :return: rows of (way, file writes, fsyncs, serial writes and ms, per spa mode)
+    :rtype: list
+    """
+    from twisted.test.proto_helpers import StringTransport
+    from modules.neptune.writer import InlineWriter
+    import main
+
+    class CountingWriter(InlineWriter):
+        written = 0
+        def submit(self, func, *args):
+            self.written += 1
+            return InlineWriter.submit(self, func, *args)
+
+    rows = []
+    for way in ('one call each', 'batch'):
+        with IsolatedHome():
+            writer = CountingWriter()
+            crown = NeptuneCrown(writer=writer)
+            serial = main.SerialResource()
+            serial.setCrown(crown)
+            transport = StringTransport()
+            serial.makeConnection(transport)
+            serialWrites = [0]
+            transportWrite = transport.write
+            def countedWrite(data):
+                serialWrites[0] += 1
+                transportWrite(data)
+            transport.write = countedWrite
+            def spaMode():
+                if way == 'batch':
+                    (commands, pretty) = crown.applyChanges(SPA_MODE, author='0001')
+                    serial.serialWriteMany(commands)
+                    return
+                for (devId, value) in SPA_MODE:
+                    if crown.devices[devId]['deviceType'] == 'switch':
+                        (code, pretty) = crown.setSwitchDevice(devId, value, author='0001')
+                    else:
+                        (code, pretty) = crown.setStepDevice(devId, value, author='0001')
+                    serial.serialWrite(code)
+            (writer.written, serialWrites[0]) = (0, 0)
+            stdout = sys.stdout
+            sys.stdout = open(os.devnull, 'w')
+            try:
+                with SlowFsync() as fsyncs:
+                    ms = timePerCall(spaMode, requests)
+            finally:
+                sys.stdout = stdout
+            rows.append((way, writer.written / float(requests), fsyncs.count / float(requests),
+                         serialWrites[0] / float(requests), ms))
+    return rows
+
+class StreamRequest(object):
+    """
+    Stands in for a client's request holding an event stream open, counting what is written.
+    """
+    def __init__(self):
+        self.written = 0
+
+    def registerProducer(self, producer, streaming):
+        pass
+
+    def unregisterProducer(self):
+        pass
+
+    def notifyFinish(self):
+        from twisted.internet.defer import Deferred
+        return Deferred()
+
+    def write(self, data):
+        self.written += len(data)
+
+    def finish(self):
+        pass
+
+def benchStream(logSizes, requests):
+    """
+    Pushes 100 sensor readings per request through the crown to event stream subscribers,
+    all keeping up or all paused by a full connection, and times each reading's push to
+    them all; paused subscribers only hold back the latest reading, and are pushed no more
+    than MAX_PENDING readings, past which they would be dropped.
+    :return: rows of (subscribers and mode, readings/s pushed, us per reading, KB sent to
+    each subscriber, most readings held back by one)
+    :rtype: list
+    """
+    from twisted.internet.task import Clock
+    from modules.neptune.streaming import ChangeStream, MAX_PENDING
+
+    rows = []
+    for subscriberCount in (1, 100, 500):
+        for mode in ('keeping up', 'paused'):
+            with IsolatedHome():
+                clock = Clock()
+                crown = NeptuneCrown(callLater=clock.callLater,
+                                     flushPolicy=FlushPolicy(maxEntries=32, maxDelay=0.25))
+                stream = ChangeStream(crown, clock.callLater)
+                clients = [StreamRequest() for i in range(subscriberCount)]
+                for client in clients:
+                    stream.subscribe(client)
+                readings = requests * 100
+                for i in range(readings):
+                    crown.updateSensorDevice('2007', str(70 + i % 10))
+                if mode == 'paused':
+                    for subscriber in stream.subscribers:
+                        subscriber.pauseProducing()
+                    readings = min(readings, MAX_PENDING)
+                sent = [client.written for client in clients]
+                # Time the pushes alone, as the crown would make them
+                start = time.time()
+                for i in range(readings):
+                    stream.deviceChanged('2007')
+                elapsed = time.time() - start
+                rows.append(("%s %s" % (subscriberCount, mode), readings / elapsed,
+                             elapsed / readings * 1000000.0,
+                             sum(client.written - before for (client, before) in zip(clients, sent))
+                             / 1024.0 / subscriberCount,
+                             max(subscriber.heldBack for subscriber in stream.subscribers)))
+    return rows
+
+def benchHotPaths(logSizes, requests):
+    """
+    Times each of the per-command hot paths on their own, at each log size: the crown's
+    device updates, the device manager saving and loading the device file, and the logger
+    adding entries, loading the log and fetching entries by type. The crown is set up as
+    main.py sets it up, with device saves written behind and log entries in groups of 32.
+    The seeded entries are years old, so the first new entry rolls them into the archive:
+    from then on loading the active log stays flat, while fetching by type, which reads the
+    archive too, grows with the log.
+    :return: rows of (hot path @ log size, us per call)
+    :rtype: list
+    """
+    from twisted.internet.task import Clock
+    rows = []
+    for size in logSizes:
+        with IsolatedHome() as home:
+            seedLog(home, size)
+            clock = Clock()
+            crown = NeptuneCrown(callLater=clock.callLater,
+                                 flushPolicy=FlushPolicy(maxEntries=32, maxDelay=0.25))
+            logger = crown.logger
+            counter = [0]
+            def nextValue(low, high):
+                counter[0] += 1
+                return str(low + counter[0] % (high - low + 1))
+
+            # The device manager on its own, saving immediately, as when nothing schedules saves
+            deviceManager = DeviceManager(logger=logger)
+            devices = deviceManager.devices
+            def addEntry():
+                logger._addEntry(NeptuneLogEntry(entryType="command", author='0001', destination='2002',
+                                                 logTime=logger._nextLogTime(), entryBody="Switch 2002.",
+                                                 success=('>2002s1', "Pump on")))
+            paths = (
+                ('crown.setSwitchDevice', lambda: crown.setSwitchDevice('2002', nextValue(0, 1), author='0001')),
+                ('crown.setStepDevice', lambda: crown.setStepDevice('2003', nextValue(55, 110), author='0001')),
+                ('crown.updateSensorDevice', lambda: crown.updateSensorDevice('2007', nextValue(60, 104), author='1000')),
+                ('crown.setDeviceAttribute', lambda: crown.setDeviceAttribute('3000', 'name', 'Aux %s' % nextValue(1, 9), author='0001')),
+                ('devices.saveState', lambda: deviceManager.saveState(devices)),
+                ('devices._loadDevicesFromFile', deviceManager._loadDevicesFromFile),
+                ('logger._addEntry', addEntry),
+                ('logger._getType', lambda: logger._getType('comment')),
+            )
+            for (label, func) in paths:
+                rows.append(("%s @%s" % (label, size), bestPerCall(func, requests)))
+            rows.append(("logger.getOrCreateLog @%s" % size, bestPerCall(logger.getOrCreateLog, requests)))
+            logger.flush()
+    return rows
+
+BENCHMARKS = {
+    'crown': (benchCrownPerRequest, ('log size', 'fresh ms/req', 'shared ms/req')),
+    'acks': (benchAcks, ('ack window', 'commands/s', 'p50 ms', 'p95 ms', 'retries', 'failed')),
+    'append': (benchLogAppend, ('log size', 'ms/entry', 'load ms')),
+    'ingest': (benchIngest, ('format', 'malformed', 'readings', 'readings/s', 'bad lines')),
+    'hotpaths': (benchHotPaths, ('hot path @log size', 'us/call')),
+    'shedding': (benchShedding, ('mode', 'readings', 'crown updates', 'shed', 'readings/s')),
+    'scene': (benchScene, ('spa mode', 'file writes', 'fsyncs', 'serial writes', 'ms/scene')),
+    'stream': (benchStream, ('subscribers', 'readings/s', 'us/reading', 'KB each', 'held back')),
+    'indexes': (benchIndexes, ('log size query', 'results', 'scan ms', 'indexed ms')),
+    'archive': (benchArchive, ('segment entries', 'raw KB', 'gzip KB', 'ratio',
+                               'raw MB/s', 'gzip MB/s', 'comments ms')),
+    'stall': (benchReactorStall, ('writer', 'mean ms held', 'worst ms held')),
+    'group': (benchGroupCommit, ('flush policy', 'fsyncs', 'ms to durable')),
+    'framing': (benchFraming, ('format', 'bytes/reading', 'readings/s', 'us/reading')),
+    'links': (benchLinks, ('links', 'commands/s', 'per link')),
+    'lanes': (benchLanes, ('lane', 'sent', 'mean ms waited', 'worst ms waited')),
+}
+
+###################################
+## BASELINES
+###################################
+# How much worse than its baseline a figure may get before it counts as a regression
+REGRESSION_THRESHOLD = 0.25
+# Log sizes run by default, and by --full: up to the million entries of a long-lived controller
+DEFAULT_SIZES = '1000,10000,100000'
+FULL_SIZES = '1000,10000,100000,1000000'
+
+def betterDirection(header):
+    """
+    Whether a higher or lower figure is better for a column, judged by its units: rates
+    ("/s") should rise, times ("ms", "us") should fall. Other columns are not compared.
+    :param header: Column header
+    :type header: str
+    :return: 1 if higher is better, -1 if lower is better, 0 if not compared
+    :rtype: int
+    """
+    if header.endswith('/s'):
+        return 1
+    units = header.replace('/', ' ').split()
+    if 'ms' in units or 'us' in units:
+        return -1
+    return 0
+
+def findRegressions(name, headers, rows, baseline, threshold):
+    """
+    Compares a benchmark's rows with the rows saved for it in a baseline, matching rows on
+    their first column.
+    :param baseline: Results saved with --save-baseline, by benchmark name
+    :type baseline: dict
+    :param threshold: Fraction by which a figure may get worse
+    :type threshold: float
+    :return: descriptions of every figure worse than its baseline by more than threshold
+    :rtype: list
+    """
+    saved = dict((str(row[0]), row) for row in baseline.get(name, {}).get('rows', []))
+    regressions = []
+    for row in rows:
+        before = saved.get(str(row[0]))
+        if before is None:
+            continue
+        for (i, header) in enumerate(headers):
+            direction = betterDirection(header)
+            if not direction or not isinstance(row[i], float) or not before[i]:
+                continue
+            change = (row[i] - before[i]) / float(before[i]) * direction
+            if change < -threshold:
+                regressions.append("%s %s %s: %.3f, baseline %.3f (%+.0f%%)" % (
+                    name, row[0], header, row[i], before[i], change * 100))
+    return regressions
+
+###################################
+## main
+###################################
+def printRows(name, headers, rows):
+    print("== %s ==" % name)
+    # The first column holds labels, which may be long
+    width = max([16] + [len(str(row[0])) for row in rows])
+    print("%*s  " % (width, headers[0]) + "  ".join("%16s" % header for header in headers[1:]))
+    for row in rows:
+        print("%*s  " % (width, row[0]) +
+              "  ".join(("%16.3f" % value) if isinstance(value, float) else ("%16s" % value)
+                        for value in row[1:]))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Neptune benchmarks")
+    parser.add_argument('names', nargs='*', default=sorted(BENCHMARKS.keys()),
+                        help="Benchmarks to run (default: all)")
+    parser.add_argument('--sizes', default=DEFAULT_SIZES,
+                        help="Comma separated log sizes (default: %s)" % DEFAULT_SIZES)
+    parser.add_argument('--full', action='store_true',
+                        help="Run every log size up to a million entries, i.e. --sizes %s" % FULL_SIZES)
+    parser.add_argument('--requests', type=int, default=20,
+                        help="Requests to average over per log size")
+    parser.add_argument('--fsync-ms', type=float, default=0,
+                        help="Simulated extra fsync latency, for the stall and group benchmarks")
+    parser.add_argument('--save-baseline', metavar='FILE',
+                        help="Save the results to FILE, to compare later runs with")
+    parser.add_argument('--compare', metavar='FILE',
+                        help="Compare the results with a baseline saved earlier, exiting with "
+                             "status 1 if any time or rate is worse by more than the threshold; "
+                             "benchmarkBaseline.json holds hotpaths run with --full")
+    parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD,
+                        help="Fraction by which a figure may get worse before it is a regression")
+    args = parser.parse_args()
+    SIMULATED_FSYNC_MS = args.fsync_ms
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as baselineFile:
+            baseline = json.load(baselineFile)
+
+    logSizes = [int(size) for size in (FULL_SIZES if args.full else args.sizes).split(',')]
+    results = {}
+    regressions = []
+    for name in args.names:
+        if name not in BENCHMARKS:
+            sys.exit("Unknown benchmark %s, choose from %s" % (name, ', '.join(sorted(BENCHMARKS))))
+        func, headers = BENCHMARKS[name]
+        rows = func(logSizes, args.requests)
+        printRows(name, headers, rows)
+        results[name] = {'headers': headers, 'rows': rows}
+        if args.compare:
+            regressions.extend(findRegressions(name, headers, rows, baseline, args.threshold))
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as baselineFile:
+            json.dump(results, baselineFile, indent=1)
+        print("Saved baseline to %s" % args.save_baseline)
+    if args.compare:
+        if regressions:
+            print("== %s regression(s) against %s ==" % (len(regressions), args.compare))
+            for regression in regressions:
+                print("  " + regression)
+            sys.exit(1)
+        print("No regressions against %s (threshold %.0f%%)" % (args.compare, args.threshold * 100))
@@ -0,0 +1,205 @@
+#!/usr/bin/python
+
+#-------------------------------------------------------------------------------
+# Name:        loadtest.py
+# Purpose:     HTTP load harness for Neptune Pool and Spa Automation. Serves the
+#              full site in-process, on a scratch home directory, with a simulated
+#              Arduino on the serial side, and drives it with concurrent clients.
+#
+# Author:      alji
+#
+# Created:     18/10/2026
+# Copyright:   (c) alji 2026
+# Licence:     <your licence>
+#-------------------------------------------------------------------------------
+import os
+import sys
+import json
+import time
+import random
+import argparse
+
+from twisted.internet import reactor, defer
+from twisted.internet.task import deferLater
+from twisted.protocols.loopback import loopbackAsync
+from twisted.web import server
+from twisted.web.client import Agent, HTTPConnectionPool, readBody
+from twisted.web.http_headers import Headers
+from twisted.logger import globalLogBeginner, textFileLogObserver
+
+import main
+from benchmark import IsolatedHome, percentile, printRows
+from modules.neptune.crown import NeptuneCrown
+from modules.neptune.writer import DiskWriter
+from modules.neptune.simulator import ArduinoSimulator
+
+# Requests made by the clients, by endpoint; each is given a random number generator
+ENDPOINTS = {
+    'fetch': lambda rng: "/fetch",
+    'map': lambda rng: "/map?npasasc=%s&dev=%s" % (main.NPASASC, rng.choice(('2007', '2008'))),
+    'switch': lambda rng: "/switch?npasasc=%s&dev=%s&to=%s" % (
+        main.NPASASC, rng.choice(('1100', '2002', '3000', '3001')), rng.randint(0, 1)),
+    'step': lambda rng: "/step?npasasc=%s&dev=%s&to=%s" % (
+        main.NPASASC, rng.choice(('2000', '2001', '2003')), rng.randint(55, 110)),
+    'set': lambda rng: "/set?npasasc=%s&dev=3002&set=name&to=Aux%%20%s" % (main.NPASASC, rng.randint(1, 9)),
+}
+
+# Load profiles: concurrent clients, the share of requests to each endpoint, and the
+# readings per second from each simulated sensor
+PROFILES = {
+    # Several family members' phones polling the dashboard while the sensors stream in
+    'dashboard': {'clients': 8, 'mix': {'fetch': 10, 'map': 2, 'switch': 1}, 'sensorRate': 10},
+    # Someone working through the controls
+    'controls': {'clients': 4, 'mix': {'switch': 3, 'step': 3, 'set': 1}, 'sensorRate': 1},
+    # Every endpoint at once
+    'mixed': {'clients': 8, 'mix': {'fetch': 4, 'map': 2, 'switch': 2, 'step': 2, 'set': 1},
+              'sensorRate': 10},
+}
+
+class Results(object):
+    """
+    This object collects the latency of every request, and the failures, by endpoint.
+    """
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+
+    def record(self, endpoint, seconds, ok):
+        self.latencies.setdefault(endpoint, []).append(seconds * 1000.0)
+        if not ok:
+            self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+
+    def summary(self, duration):
+        """
+        :param duration: Seconds over which the requests were made
+        :type duration: float
+        :return: figures by endpoint, plus 'all' for every request together
+        :rtype: dict
+        """
+        summary = {}
+        everything = []
+        for (endpoint, latencies) in sorted(self.latencies.items()):
+            everything.extend(latencies)
+            summary[endpoint] = self._figures(latencies, self.errors.get(endpoint, 0), duration)
+        if everything:
+            summary['all'] = self._figures(everything, sum(self.errors.values()), duration)
+        return summary
+
+    def _figures(self, latencies, errors, duration):
+        return {'requests': len(latencies), 'errors': errors, 'rps': len(latencies) / duration,
+                'p50': percentile(latencies, 0.50), 'p95': percentile(latencies, 0.95),
+                'p99': percentile(latencies, 0.99)}
+
+@defer.inlineCallbacks
+def client(agent, base, mix, rng, results, recordFrom, until, think):
+    """
+    Makes requests one after another until the run is over, choosing each endpoint at
+    random in the proportions of mix. Like a browser, each client sends back the ETag it
+    was last given for a URL, and counts 304 Not Modified as success.
+    """
+    endpoints = []
+    for (endpoint, weight) in sorted(mix.items()):
+        endpoints.extend([endpoint] * weight)
+    etags = {}
+    while reactor.seconds() < until:
+        endpoint = rng.choice(endpoints)
+        url = base + ENDPOINTS[endpoint](rng)
+        headers = Headers({'If-None-Match': [etags[url]]} if url in etags else {})
+        start = time.time()
+        try:
+            response = yield agent.request('GET', url, headers)
+            body = yield readBody(response)
+            if response.headers.hasHeader('ETag'):
+                etags[url] = response.headers.getRawHeaders('ETag')[0]
+            # Failures are reported in the body, as "0:..."
+            ok = response.code in (200, 304) and not body.startswith('0:')
+        except Exception:
+            ok = False
+        if start >= recordFrom:
+            results.record(endpoint, time.time() - start, ok)
+        if think:
+            yield deferLater(reactor, think, lambda: None)
+
+def run(args, profile):
+    """
+    Serves the site, runs the clients for the warm-up and the measured duration, and
+    returns the results.
+    :rtype: dict
+    """
+    writer = DiskWriter()
+    writer.start()
+    crown = NeptuneCrown(callLater=reactor.callLater, writer=writer, flushPolicy=main.LOG_FLUSH_POLICY)
+    serial = main.SerialResource(callLater=reactor.callLater, acks=True, port='loopback')
+    serial.setCrown(crown)
+    simulator = ArduinoSimulator(reactor.callLater, rate=profile['sensorRate'], jitter=0.2,
+                                 seed=args.seed)
+    loopbackAsync(simulator, serial)
+    listening = reactor.listenTCP(0, server.Site(main.buildRoot(crown, serial)), interface='127.0.0.1')
+    base = "http://127.0.0.1:%s" % listening.getHost().port
+
+    pool = HTTPConnectionPool(reactor, persistent=True)
+    pool.maxPersistentPerHost = profile['clients']
+    agent = Agent(reactor, pool=pool)
+    results = Results()
+    recordFrom = reactor.seconds() + args.warmup
+    until = recordFrom + args.duration
+    rng = random.Random(args.seed)
+    clients = [client(agent, base, profile['mix'], random.Random(rng.random()), results,
+                      recordFrom, until, args.think)
+               for i in range(profile['clients'])]
+    outcome = {}
+
+    def finish(ignored):
+        outcome.update(profile=args.profile, clients=profile['clients'], mix=profile['mix'],
+                       sensorRate=profile['sensorRate'], duration=args.duration,
+                       readingsTaken=serial.readingsIn, endpoints=results.summary(args.duration))
+        simulator.stop()
+        crown.flush()
+        writer.stop()
+        d = pool.closeCachedConnections()
+        d.addBoth(lambda ignored: listening.stopListening())
+        d.addBoth(lambda ignored: reactor.stop())
+    defer.DeferredList(clients).addCallback(finish)
+    reactor.run()
+    return outcome
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Neptune HTTP load harness")
+    parser.add_argument('profile', choices=sorted(PROFILES), help="Load profile to run")
+    parser.add_argument('--clients', type=int, help="Concurrent clients, overriding the profile")
+    parser.add_argument('--duration', type=float, default=20.0, help="Seconds measured")
+    parser.add_argument('--warmup', type=float, default=2.0, help="Seconds run before measuring")
+    parser.add_argument('--think', type=float, default=0.0,
+                        help="Seconds each client waits between requests, e.g. 1 for polling phones")
+    parser.add_argument('--seed', type=int, default=1, help="Seed, for repeatable runs")
+    parser.add_argument('--output', help="JSON file for the results (default: loadtest-PROFILE.json)")
+    parser.add_argument('--verbose', action='store_true',
+                        help="Show the service's own output and errors, hidden by default")
+    args = parser.parse_args()
+
+    profile = dict(PROFILES[args.profile])
+    if args.clients:
+        profile['clients'] = args.clients
+    with IsolatedHome():
+        # The service's own output, and the errors behind failed requests, would swamp the report
+        stdout = sys.stdout
+        if args.verbose:
+            globalLogBeginner.beginLoggingTo([textFileLogObserver(sys.stderr)], redirectStandardIO=False)
+        else:
+            sys.stdout = open(os.devnull, 'w')
+            globalLogBeginner.beginLoggingTo([lambda event: None], redirectStandardIO=False)
+        try:
+            outcome = run(args, profile)
+        finally:
+            sys.stdout = stdout
+
+    endpoints = outcome['endpoints']
+    printRows("%s, %s clients" % (args.profile, profile['clients']),
+              ('endpoint', 'requests', 'errors', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms'),
+              [(name, endpoints[name]['requests'], endpoints[name]['errors'], endpoints[name]['rps'],
+                endpoints[name]['p50'], endpoints[name]['p95'], endpoints[name]['p99'])
+               for name in sorted(endpoints)])
+    output = args.output or "loadtest-%s.json" % args.profile
+    with open(output, 'w') as outputFile:
+        json.dump(outcome, outputFile, indent=1, sort_keys=True)
+    print("Saved results to %s" % output)
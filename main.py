@@ -11,13 +11,19 @@
 # Licence: 	<your licence>
 #-------------------------------------------------------------------------------
 import os
+import json
+import time
+import hashlib
 import datetime as dt
+from collections import OrderedDict
 
 #---Twisted Serial / HTTP---
-from twisted.internet import reactor
-from twisted.web import server, resource
+from twisted.internet import reactor, threads
+from twisted.internet.task import LoopingCall
+from twisted.web import server, resource, http
 from twisted.protocols.basic import LineReceiver
 from twisted.internet.serialport import SerialPort
+from twisted.python.failure import Failure
 
 import xml.etree.ElementTree as xmlEtree
 
@@ -33,7 +39,17 @@ if PLATFORM == "mac":
   sys.path.insert(0, '/Users/jisunstetson/bin')
 # Now, the following imports will work
 from modules.neptune.crown import NeptuneCrown
-from modules.neptune.logger import NeptuneLogger
+from modules.neptune.logger import FlushPolicy
+from modules.neptune.writer import DiskWriter
+from modules.neptune.outbound import OutboundQueue, NORMAL, ACK_WINDOW, LANE_NAMES
+from modules.neptune.routing import SerialRouter
+from modules.neptune.framing import FrameDecoder, FRAMES_ON, FRAMES_OFF, FRAMES_ACCEPTED
+from modules.neptune import metrics
+from modules.neptune.metrics import REGISTRY
+from modules.neptune.lag import LagMonitor, SENSOR_SLOWDOWN, OVERLOAD_SLOWDOWN
+from modules.neptune.profiling import PROFILER, PROFILE_VARIABLE, PROFILE_COUNT, parseRound
+from modules.neptune.tracing import TRACER, TRACE_FLUSH_INTERVAL, TRACE_SERIAL_EVERY
+from modules.neptune.streaming import ChangeStream
 
 ###################################
 ## GLOBALS
@@ -44,6 +60,24 @@ if PLATFORM == "windows":
     COM_PORT = 'COM3'
 elif PLATFORM == "mac":
     COM_PORT = '/dev/ttys0'
+BAUD_RATE = 9600
+# Serial links to Arduinos, as (port, lowest device ID, highest device ID) served by each, e.g.
+#   [('COM3', 1100, 1199), ('COM4', 2000, 2999), ('COM5', 3000, 9999)]
+SERIAL_LINKS = [(COM_PORT, 1000, 9999)]
+# Appended to every outgoing command, on top of the line delimiter
+LINE_SUFFIX = "/r/n"
+# Ask the Arduino to send readings in binary frames; it stays on text lines if it declines
+SERIAL_FRAMING = False
+# Bad frames in a row after which the link goes back to text lines
+MAX_BAD_FRAMES = 8
+# Number device commands and wait for the Arduino to acknowledge each (e.g. 2002a17)
+SERIAL_ACKS = False
+# Seconds between passes dropping log segments past their retention period
+LOG_COMPACTION_INTERVAL = 60 * 60
+# Log entries are written out in groups: every 32 entries, or a quarter second after the first
+LOG_FLUSH_POLICY = FlushPolicy(maxEntries=32, maxDelay=0.25)
+# While the reactor is overloaded, seconds between applying the latest reading of each sensor
+SHED_INTERVAL = 1.0
 
 ###################################
 ## SERIAL
@@ -51,7 +85,67 @@ elif PLATFORM == "mac":
 class SerialResource(LineReceiver):
     """
     This object processes incoming serial requests and sends outgoing serial commands.
+
+    Outgoing commands wait in an OutboundQueue, which keeps only the latest command for each
+    device and releases them at the pace the link can carry, safety commands (heaters off,
+    fill valve closed) ahead of the rest.
+
+    Incoming readings arrive as text lines, one reading each, unless binary frames have been
+    agreed with the Arduino (see framing.py), in which case the receiver is switched to raw
+    mode and each frame may carry many readings.
+
+    With acks, device commands carry a sequence number which the Arduino sends back as a
+    reading of type "a"; several commands may await their acks at once, and any not
+    acknowledged in time are sent again. Each ack or failure is logged as a handshake.
+
+    While the reactor is overloaded (see lag.py) the link eases off: the Arduino is asked to
+    report less often, and sensor readings are held back, only the latest for each sensor
+    being applied every SHED_INTERVAL seconds. Acks and outgoing commands carry on as usual.
     """
+    def __init__(self, callLater=None, baudrate=BAUD_RATE, framing=SERIAL_FRAMING, acks=SERIAL_ACKS,
+                 port=COM_PORT):
+        """
+        :param callLater: Scheduler, e.g. reactor.callLater, pacing outgoing commands; without
+        one every command is sent immediately.
+        :type callLater: callable
+        :param baudrate: Speed of the serial link
+        :type baudrate: int
+        :param framing: Whether to ask the Arduino for binary frames once connected
+        :type framing: bool
+        :param acks: Whether the Arduino acknowledges device commands; needs callLater
+        :type acks: bool
+        :param port: Serial port of the link, for messages
+        :type port: str
+        :return: None
+        """
+        self.port = port
+        # Readings taken in, lines or readings which could not be parsed, and bytes each way
+        self.readingsIn = 0
+        self.badLines = 0
+        self.bytesIn = 0
+        self.bytesOut = 0
+        # Latest reading held back from each sensor while easing off, and readings superseded
+        self.callLater = callLater
+        self.shedding = False
+        self.heldReadings = OrderedDict()
+        self.readingsShed = 0
+        self._applyHeld = None
+        self.outbound = OutboundQueue(self.transmit, callLater, baudrate,
+                                      overhead=len(LINE_SUFFIX) + len(self.delimiter),
+                                      window=ACK_WINDOW if acks else None,
+                                      onAck=self.commandAcked, onFailure=self.commandFailed)
+        self.framing = framing
+        self.framed = False
+        self.decoder = FrameDecoder()
+
+    @property
+    def queueDepth(self):
+        """Commands waiting for the serial link"""
+        return self.outbound.depth
+
+    def setCrown(self, crown):
+        self.crown = crown
+
     def processData(self, data):
         """
         Processes any incoming serial data
@@ -60,31 +154,174 @@ class SerialResource(LineReceiver):
         :return: None
         """
         # Alert user to incoming serial data
-        print("<--%s--: %s" % (COM_PORT, data))
+        print("<--%s--: %s" % (self.port, data))
         # Decode the data according to Neptune protocol
+        if len(data) < 6:
+            raise ValueError("Line too short: %r" % data)
         devId    = data[0:4]
         devType  = data[4]
         newValue = data[5:]
+        self.processReading(devId, devType, newValue)
 
-        crown = NeptuneCrown()
-        author = '1000'  # Arduino device ID
+    def processReading(self, devId, devType, newValue):
+        """
+        Processes one reading from the Arduino, whether it came in a text line or a frame.
+        :param devId: Device ID
+        :type devId: str
+        :param devType: Device type code
+        :type devType: str
+        :param newValue: Value reported
+        :type newValue: str
+        :return: None
+        """
+        self.readingsIn += 1
 
-        # Currently, Arduino only ever sends signals regarding Sensors
+        if devType == "a":
+            # Acknowledgement of a command we sent; the queue reports back to commandAcked
+            if self.outbound.ack(devId, newValue) is None:
+                print("ERROR: Unexpected ack %s from device %s" % (newValue, devId))
+            return
+        if devType == "n" and self.shedding:
+            # Easing off: only the latest reading from each sensor will be applied
+            if devId in self.heldReadings:
+                self.readingsShed += 1
+            self.heldReadings[devId] = newValue
+            return
+        self.applyReading(devId, devType, newValue)
+
+    def applyReading(self, devId, devType, newValue):
+        """
+        Updates the crown with a reading from the Arduino.
+        :param devId: Device ID
+        :type devId: str
+        :param devType: Device type code
+        :type devType: str
+        :param newValue: Value reported
+        :type newValue: str
+        :return: None
+        """
+        author = '1000'  # Arduino device ID
+        # Other than acks, Arduino only ever sends signals regarding Sensors
+        (success, pretty) = (0, "Unknown device type %s for device %s" % (devType, devId))
         if devType == "n":
-            (success, pretty) = crown.updateSensorDevice(devId, newValue, author=author)
+            (success, pretty) = self.crown.updateSensorDevice(devId, newValue, author=author)
         # Alert user to success or failure
         if success:
             print(pretty)
         else:
             print("ERROR: %s" % pretty)
 
+    def easeOff(self):
+        """
+        Starts easing off, while the reactor is overloaded: asks the Arduino to report its
+        sensors less often, and holds back sensor readings. Without a scheduler the readings
+        cannot be applied later, so they carry on being applied as they arrive.
+        :return: None
+        """
+        if self.shedding:
+            return
+        print('Serial link on %s easing off' % self.port)
+        self.serialWrite(SENSOR_SLOWDOWN % OVERLOAD_SLOWDOWN, NORMAL)
+        if self.callLater is not None:
+            self.shedding = True
+            self._applyHeld = self.callLater(SHED_INTERVAL, self.applyHeldReadings)
+
+    def resume(self):
+        """
+        Stops easing off, once the reactor has recovered: applies the readings held back and
+        asks the Arduino for its usual rate again.
+        :return: None
+        """
+        print('Serial link on %s resuming' % self.port)
+        self.shedding = False
+        if self._applyHeld is not None and self._applyHeld.active():
+            self._applyHeld.cancel()
+        self._applyHeld = None
+        self.applyHeldReadings()
+        self.serialWrite(SENSOR_SLOWDOWN % 1, NORMAL)
+
+    def applyHeldReadings(self):
+        """
+        Applies the latest reading held back from each sensor, logging them together, and,
+        while still easing off, schedules the next round.
+        :return: None
+        """
+        (held, self.heldReadings) = (self.heldReadings, OrderedDict())
+        with self.crown.logger.batch():
+            for (devId, newValue) in held.items():
+                self.applyReading(devId, 'n', newValue)
+        if self.shedding:
+            self._applyHeld = self.callLater(SHED_INTERVAL, self.applyHeldReadings)
+
+    def commandAcked(self, command, latency):
+        """
+        Called by the outbound queue when the Arduino acknowledges a command.
+        :param command: The command acknowledged
+        :type command: outbound.InFlight
+        :param latency: Seconds from the command's first send to its ack
+        :type latency: float
+        :return: None
+        """
+        self.crown.logger.author = '1000'
+        self.crown.logger.logHandshake(command.devId, (1, "Command %s acknowledged in %.1f ms, "
+                                       "%s attempt(s)." % (command.command, latency * 1000.0,
+                                                           command.attempts)))
+
+    def commandFailed(self, command):
+        """
+        Called by the outbound queue when a command has gone unacknowledged too many times.
+        :param command: The command given up on
+        :type command: outbound.InFlight
+        :return: None
+        """
+        pretty = "Command %s not acknowledged after %s attempts." % (command.command, command.attempts)
+        print("ERROR: %s" % pretty)
+        self.crown.logger.author = '1000'
+        self.crown.logger.logHandshake(command.devId, (0, pretty))
+
     def connectionMade(self):
         """
         This method is built in to the LineReceiver object, and tells the Receiver
         what to do in the case of a successful connection. We only wish to alert the user.
         :return: None
         """
-        print('Serial connection made!')
+        print('Serial connection made on %s!' % self.port)
+        if self.framing:
+            self.serialWrite(FRAMES_ON, NORMAL)
+
+    def startFrames(self):
+        """
+        Switches the receiver to binary frames, once the Arduino has agreed to send them.
+        :return: None
+        """
+        print('Serial link switching to binary frames')
+        self.decoder.reset()
+        self.framed = True
+        self.setRawMode()
+
+    def stopFrames(self):
+        """
+        Puts the link back on text lines, e.g. when frames keep failing their checksum.
+        :return: None
+        """
+        print('ERROR: %s bad frames in a row, serial link going back to text lines'
+              % self.decoder.badRun)
+        self.serialWrite(FRAMES_OFF, NORMAL)
+        self.framed = False
+        self.decoder.reset()
+        self.setLineMode()
+
+    def dataReceived(self, data):
+        """
+        This method is built in to the LineReceiver object, and is handed each chunk of
+        serial bytes, which may hold several lines. Log entries from all of them are
+        written out together.
+        :param data: Incoming serial bytes
+        :return: None
+        """
+        self.bytesIn += len(data)
+        with self.crown.logger.batch():
+            return LineReceiver.dataReceived(self, data)
 
     def lineReceived(self, line):
         """
@@ -94,26 +331,86 @@ class SerialResource(LineReceiver):
         :return: None
         """
         data = str(line)
+        if data == FRAMES_ACCEPTED:
+            self.startFrames()
+            return
         try:
-            self.processData(data)
+            self.processTraced(self.processData, data)
         except ValueError:
+            self.badLines += 1
             print('Unable to parse data %s' % line)
 
-    def serialWrite(self, data):
+    def rawDataReceived(self, data):
+        """
+        This method is built in to the LineReceiver object, and is handed incoming bytes
+        once the receiver is in raw mode, i.e. while binary frames are in use.
+        :param data: Incoming serial bytes
+        :return: None
+        """
+        for (devId, devType, newValue) in self.decoder.feed(data):
+            try:
+                self.processTraced(self.processReading, devId, devType, newValue)
+            except ValueError:
+                self.badLines += 1
+                print('Unable to parse reading %s%s%s' % (devId, devType, newValue))
+        if self.decoder.badRun >= MAX_BAD_FRAMES:
+            self.stopFrames()
+
+    def processTraced(self, func, *args):
+        """
+        Processes an incoming line or reading with func(*args), tracing one in every
+        TRACE_SERIAL_EVERY readings, and profiling it during a round of profiling.
+        :param func: processData or processReading
+        :type func: callable
+        :return: None
         """
-        This method writes any requested data to the serial connection.
+        if self.readingsIn % TRACE_SERIAL_EVERY:
+            PROFILER.call('serial', self.port, func, *args)
+            return
+        with TRACER.trace('serial', port=self.port):
+            PROFILER.call('serial', self.port, func, *args)
+
+    def serialWrite(self, data, lane=None):
+        """
+        This method queues any requested data for the serial connection.
         :param data: Requested data to be sent
         :type data: str
+        :param lane: outbound.CRITICAL, NORMAL or BULK; chosen from the command if not given
+        :type lane: int
         :return: True
         :rtype: bool
         """
+        self.outbound.put(data, lane)
+        return True
+
+    def serialWriteMany(self, commands, lane=None):
+        """
+        This method queues several commands to be sent together, in one transmission.
+        :param commands: Requested commands to be sent
+        :type commands: list
+        :param lane: outbound.CRITICAL, NORMAL or BULK; chosen from each command if not given
+        :type lane: int
+        :return: True
+        :rtype: bool
+        """
+        self.outbound.putMany(commands, lane)
+        return True
+
+    def transmit(self, data, *more):
+        """
+        This method writes data to the serial connection, once the queue releases it.
+        :param data: Requested data to be sent
+        :type data: str
+        :param more: Further commands sent along with it, in the same write
+        :return: None
+        """
         # Alert the user to outgoing serial data
-        print(" --%s-->: %s" % (COM_PORT, data))
-        # Append return and newline expected by Arduino
-        data += "/r/n"
+        print(" --%s-->: %s (%s queued)" % (self.port, ' '.join((data,) + more), self.queueDepth))
+        # Append return and newline expected by Arduino, line by line
+        lines = ''.join(line + LINE_SUFFIX + self.delimiter for line in (data,) + more)
         # Send data
-        self.sendLine(data)
-        return True
+        self.bytesOut += len(lines)
+        self.transport.write(lines)
 
 #    def sendLine(self):
 #         pass
@@ -124,11 +421,109 @@ class SerialResource(LineReceiver):
 class WebResource(resource.Resource):
     """
     This base class for all http protocol resources just provides a serial property
-    which these resources will use to execute any commands specified over http.
+    which these resources will use to execute any commands specified over http, and
+    the crown shared by every resource for the life of the reactor.
     """
+    # Whether requests are profiled during a round of profiling
+    profiled = True
+    # Whether each request is traced, see tracing.py; its trace ID is sent back in X-Trace-Id
+    traced = False
+    # Whether requests are held open waiting on changes; these are counted, but not timed,
+    #  and a client leaving is how they end rather than a failure
+    streamed = False
+
     def setSerial(self, serialProcess):
         self.serialProcess = serialProcess
 
+    def setCrown(self, crown):
+        self.crown = crown
+
+    def render(self, request):
+        """
+        Built-in method to resource.Resource which hands the request to render_GET; counts
+        and times every request by endpoint for /metrics. A request fails if it is answered
+        with a "0:" report, or not answered at all.
+        :param request: incoming http request
+        :return: the response body, or NOT_DONE_YET
+        """
+        endpoint = "/%s" % (request.prepath[-1] if request.prepath else '')
+        start = time.time()
+        try:
+            if self.traced:
+                with TRACER.trace('http', endpoint=endpoint) as traceId:
+                    if traceId is not None:
+                        request.setHeader('X-Trace-Id', traceId)
+                    body = self.renderProfiled(request, endpoint)
+            else:
+                body = self.renderProfiled(request, endpoint)
+        except Exception:
+            self.measure(endpoint, start, True)
+            raise
+        if body is server.NOT_DONE_YET and self.streamed:
+            REGISTRY.inc(metrics.HTTP_REQUESTS, endpoint=endpoint)
+        elif body is server.NOT_DONE_YET:
+            request.notifyFinish().addBoth(lambda outcome: self.measure(
+                endpoint, start, isinstance(outcome, Failure) or getattr(request, 'answeredFailure', False)))
+        else:
+            self.measure(endpoint, start, body.startswith("0:"))
+        return body
+
+    def renderProfiled(self, request, endpoint):
+        """
+        Hands the request to render_GET, profiling it during a round of profiling.
+        :param request: incoming http request
+        :param endpoint: Path of the resource, e.g. "/switch"
+        :type endpoint: str
+        :return: the response body, or NOT_DONE_YET
+        """
+        if self.profiled:
+            return PROFILER.call('http', endpoint, resource.Resource.render, self, request)
+        return resource.Resource.render(self, request)
+
+    def measure(self, endpoint, start, failed):
+        """
+        Records one request answered, for /metrics.
+        :param endpoint: Path of the resource, e.g. "/switch"
+        :type endpoint: str
+        :param start: When the request arrived
+        :type start: float
+        :param failed: Whether the request failed
+        :type failed: bool
+        :return: None
+        """
+        REGISTRY.observe(metrics.HTTP_SECONDS, time.time() - start, endpoint=endpoint)
+        REGISTRY.inc(metrics.HTTP_REQUESTS, endpoint=endpoint)
+        if failed:
+            REGISTRY.inc(metrics.HTTP_ERRORS, endpoint=endpoint)
+
+    def deferRender(self, request, d):
+        """
+        Lets a resource answer once work off the reactor thread is done: the request is
+        finished with whatever string d fires with, or a "0:" failure report.
+        :param request: incoming http request
+        :param d: Deferred firing with the response body
+        :type d: Deferred
+        :return: NOT_DONE_YET, for render_GET to return
+        """
+        finished = []
+        request.notifyFinish().addBoth(finished.append)
+
+        def fail(failure):
+            print("ERROR: %s" % failure.getErrorMessage())
+            return "0:%s" % failure.getErrorMessage()
+
+        def respond(body):
+            # Nobody to answer if the client hung up while we worked
+            if not finished:
+                body = str(body)
+                request.answeredFailure = body.startswith("0:")
+                request.write(body)
+                request.finish()
+
+        d.addErrback(fail)
+        d.addCallback(respond)
+        return server.NOT_DONE_YET
+
 class HttpResource(WebResource):
     """
     This object functions as our root http resource, being called to display by default
@@ -177,7 +572,20 @@ class WebFetch(WebResource):
     """
     This object defines the Fetch child resource. Its job is simply to dump device
     information into the browser in the form of an XML etree for the user to read.
+
+    The XML is built from the crown's devices in memory, and kept until they change, with
+    a strong ETag; a client sending it back in If-None-Match is answered 304 Not Modified.
+
+    The root element carries the version of the state. A client holding the state as of a
+    version may ask for /fetch?since=<version>, and is sent only the devices changed since,
+    with the version they were changed from in the root's since attribute. Without a since
+    attribute the answer holds every device, e.g. when the version is too old to compare.
     """
+    def __init__(self):
+        WebResource.__init__(self)
+        # (device state version, ETag, XML) for the last state served
+        self._cached = (None, None, None)
+
     def render_GET(self, request):
         """
         Built-in method to resource.Resource which defines what to do when asked to display
@@ -187,23 +595,60 @@ class WebFetch(WebResource):
         :rtype: str
         """
         request.setHeader('Content-Type', 'text/xml')
-        # Load the device info
-        ## I keep the device info in different places depending on the platform. This is a hacky
-        ##  convenience and is not elegant code.
-        if PLATFORM == "mac":
-            tree = xmlEtree.parse('/Users/jisunstetson/allen/code/webpy/deviceInfo.xml')
-        elif PLATFORM == "windows":
-            tree = xmlEtree.parse('/Users/alji/Documents/neptune/main/deviceState.xml')
-
-        # Parse the XML file and serve it as-is.
-        root = tree.getroot()
-        return(xmlEtree.tostring(root))
+        if request.args.has_key('since'):
+            since = request.args['since'][0]
+            if not since.isdigit():
+                return "0:Version %s is not a number." % since
+            changed = self.crown.deviceManager.changedSince(int(since))
+            if changed is not None:
+                return self.buildXml(changed, since)
+        (etag, body) = self.currentState()
+        # Sets the ETag, and the 304 if the client already holds this state
+        if request.setETag(etag) == http.CACHED:
+            return ''
+        return body
+
+    def currentState(self):
+        """
+        Builds the XML for the devices in memory, unless it is already built for this state.
+        :return: (ETag, XML)
+        :rtype: tuple
+        """
+        version = self.crown.deviceManager.version
+        (cachedVersion, etag, body) = self._cached
+        if cachedVersion != version:
+            body = self.buildXml(sorted(self.crown.devices))
+            etag = '"%s"' % hashlib.sha1(body).hexdigest()
+            self._cached = (version, etag, body)
+        return (etag, body)
+
+    def buildXml(self, devIds, since=None):
+        """
+        Builds the XML for some of the devices in memory.
+        :param devIds: IDs of the devices to include
+        :type devIds: list
+        :param since: Version the devices have changed since, if only changes are included
+        :type since: str
+        :return: XML
+        :rtype: str
+        """
+        root = xmlEtree.Element('devices', version=str(self.crown.deviceManager.version))
+        if since is not None:
+            root.set('since', since)
+        devices = self.crown.devices
+        for devId in devIds:
+            device = xmlEtree.SubElement(root, 'device')
+            for (attrName, value) in sorted(devices[devId].items()):
+                xmlEtree.SubElement(device, attrName).text = unicode(value)
+        return xmlEtree.tostring(root, encoding='utf-8')
 
 class WebSwitch(WebResource):
     """
     This object defines the Switch child resource. Its job is to manipulate switch-type devices
     based on incoming http requests.
     """
+    traced = True
+
     def render_GET(self, request):
         """
         Built-in method to resource.Resource which defines what to do when asked to display
@@ -212,7 +657,6 @@ class WebSwitch(WebResource):
         :return: html markup
         :rtype: str
         """
-        self.crown = NeptuneCrown()
         request.setHeader("content-type", "text/plain")
         data = request.args
 
@@ -244,6 +688,8 @@ class WebStep(WebResource):
     This object defines the Step child resource. Its job is to manipulate step-type devices
     based on incoming http requests.
     """
+    traced = True
+
     def render_GET(self, request):
         """
         Built-in method to resource.Resource which defines what to do when asked to display
@@ -252,7 +698,6 @@ class WebStep(WebResource):
         :return: html markup
         :rtype: str
         """
-        self.crown = NeptuneCrown()
         request.setHeader("content-type", "text/plain")
         data = request.args
 
@@ -274,6 +719,73 @@ class WebStep(WebResource):
         (code, pretty) = self.crown.setStepDevice(devId, value, author='0001')
         if code:
             report = "1:%s\n  %s" % (pretty, code)
+            self.serialProcess.serialWrite(code)
+        else:
+            report = "0:Serial Write failed. %s" % pretty
+        return str(report)
+
+class WebScene(WebResource):
+    """
+    This object defines the Scene child resource. Its job is to set several switch and step
+    devices at once, all or none, as one change: saved and logged together, and sent to the
+    Arduino in one transmission.
+
+    The devices are given as repeated pairs, e.g. dev=2000&to=1&dev=2002&to=1. With name
+    and save=1 they are stored as a named scene instead of being applied; name alone
+    applies the stored scene, and with remove=1 forgets it. list=1 lists the scenes.
+    """
+    traced = True
+
+    def render_GET(self, request):
+        """
+        Built-in method to resource.Resource which defines what to do when asked to display
+        via http.
+        :param request: incoming http request
+        :return: html markup
+        :rtype: str
+        """
+        request.setHeader("content-type", "text/plain")
+        data = request.args
+
+        if not data:
+            return ''
+
+        # Verify authorized connection
+        if not data.has_key("npasasc"):
+            return "0:Authentication required. Access denied."
+        securityCode = data['npasasc'][0]
+        if securityCode != NPASASC:
+            return "0:Authentication failed. Access denied."
+
+        if data.has_key('list'):
+            scenes = self.crown.deviceManager.scenes
+            return str("1:%s" % "".join("\n  %s: %s" % (name, ", ".join("%s to %s" % tuple(change)
+                                                                        for change in scenes[name]))
+                                       for name in sorted(scenes)))
+
+        # Collect requested device IDs and new values, in pairs
+        devIds = data.get('dev', [])
+        values = data.get('to', [])
+        if len(devIds) != len(values):
+            return "0:Every dev needs a to, %s devices were given %s values." % (len(devIds), len(values))
+        changes = zip(devIds, values)
+        name = data.get('name', [None])[0]
+
+        if name is not None and data.has_key('save'):
+            (code, pretty) = self.crown.saveScene(name, changes)
+            return str("%s:%s" % (code, pretty))
+        if name is not None and data.has_key('remove'):
+            (code, pretty) = self.crown.removeScene(name)
+            return str("%s:%s" % (code, pretty))
+
+        # Perform the device updates
+        if name is not None:
+            (commands, pretty) = self.crown.applyScene(name, author='0001')
+        else:
+            (commands, pretty) = self.crown.applyChanges(changes, author='0001')
+        if commands:
+            report = "1:%s\n  %s" % (pretty, " ".join(commands))
+            self.serialProcess.serialWriteMany(commands)
         else:
             report = "0:Serial Write failed. %s" % pretty
         return str(report)
@@ -283,6 +795,8 @@ class WebSet(WebResource):
     This object defines the Set child resource. Its job is to manipulate any type of
     device by setting a given attribute to a value provided through incoming http requests.
     """
+    traced = True
+
     def render_GET(self, request):
         """
         Built-in method to resource.Resource which defines what to do when asked to display
@@ -291,7 +805,6 @@ class WebSet(WebResource):
         :return: html markup
         :rtype: str
         """
-        self.crown = NeptuneCrown()
         request.setHeader("content-type", "text/plain")
         data = request.args
 
@@ -415,8 +928,10 @@ class WebLog(WebResource):
 
 class WebReadLog(WebResource):
     """
-    ! UNFINISHED ! This object will provide users with a way to read through a whole log file
-    in their browser.
+    This object defines the Read Log child resource. Its job is to let users read through the
+    log in their browser, one entry per line, across the active log and the archive. The
+    optional "from" and "to" arguments bound the entries returned; any leading part of a log
+    key works, e.g. from=2013:04:03&to=2013:04:04 for a single day.
     """
     def render_GET(self, request):
         """
@@ -427,11 +942,33 @@ class WebReadLog(WebResource):
         :rtype: str
         """
         data = request.args
+        request.setHeader("content-type", "text/plain")
 
         if not data:
             return ''
 
-        return "Not yet implemented."
+        # Verify authorized connection
+        if not data.has_key("npasasc"):
+            return "Authentication required. Access denied."
+        securityCode = data['npasasc'][0]
+        if securityCode != NPASASC:
+            return "Authentication failed. Access denied."
+
+        start = data.get('from', [None])[0]
+        end = data.get('to', [None])[0]
+        logger = self.crown.logger
+
+        def render(archived):
+            log = logger.getRange(start, end, archived=archived)
+            lines = []
+            for entry in log:
+                lines.append("%s %s" % (entry, json.dumps(log[entry])))
+            return "\n".join(lines)
+
+        # Read the archive on a worker thread, then add the entries held in memory on ours
+        d = threads.deferToThread(list, logger.archive.iterEntries(start, end))
+        d.addCallback(render)
+        return self.deferRender(request, d)
 
 class WebMap(WebResource):
     """
@@ -463,67 +1000,371 @@ class WebMap(WebResource):
         # Collect device ID
         devId = data['dev'][0]
 
-        # Load the log
-        ## ALLEN - this whole mess should be off-loaded to a method in a module
-        logger = NeptuneLogger('0001')
-        log = logger.getOrCreateLog()
-        values = []
-        for entry in log:
-            if log[entry]['destination'] == devId:
+        logger = self.crown.logger
+
+        def render(archived):
+            # Look up the device's entries in the log held by the crown
+            log = logger.getByDestination(devId, archived=archived)
+            values = []
+            for entry in log:
                 values.append((entry,log[entry]['success'][1].split()[-1]))
-        return str(values)
+            return str(values)
 
-###################################
-## main
-###################################
-if __name__ == '__main__':
-    # Serial
-    ## Define our serial resource and spin up a connection to the Arduino
-    print('About to open port %s' % COM_PORT)
-    serialProcess = SerialResource()
-    s = SerialPort(serialProcess, COM_PORT, reactor, baudrate=9600)
+        # Read the archive on a worker thread, then add the entries held in memory on ours
+        d = threads.deferToThread(list, logger.archive.iterEntries(field='destination', value=devId))
+        d.addCallback(render)
+        return self.deferRender(request, d)
 
+class WebReload(WebResource):
+    """
+    This object defines the Reload child resource. Device state and the log are held in
+    memory for the life of the service; its job is to discard them and re-read both from
+    disk, e.g. after the files have been edited by hand.
+    """
+    def render_GET(self, request):
+        """
+        Built-in method to resource.Resource which defines what to do when asked to display
+        via http.
+        :param request: incoming http request
+        :return: html markup
+        :rtype: str
+        """
+        data = request.args
+        request.setHeader("content-type", "text/plain")
 
-    # HTTP
-    ## Define Web Resources and give them access to the serial process
+        if not data:
+            return ''
+
+        # Verify authorized connection
+        if not data.has_key("npasasc"):
+            return "0:Authentication required. Access denied."
+        securityCode = data['npasasc'][0]
+        if securityCode != NPASASC:
+            return "0:Authentication failed. Access denied."
+
+        def reload(ignored):
+            self.crown.reload()
+            return "1:Reloaded %s devices and %s log entries." % (len(self.crown.devices),
+                                                                  len(self.crown.logger.log))
+
+        # Write out changes still waiting, and wait on a worker thread for them to land, so
+        #  the reload reads them back
+        self.crown.flush()
+        d = threads.deferToThread(self.crown.logger.writer.drain)
+        d.addCallback(reload)
+        return self.deferRender(request, d)
+
+class WebStream(WebResource):
+    """
+    This object defines the Stream child resource. Its job is to push device changes, set
+    over http or read from the sensors, to clients as the crown applies them, so they need
+    not keep asking /fetch; see streaming.py.
+
+    By default the connection is held open as a Server-Sent Events stream, starting with
+    every device, or only those changed since the version sent in Last-Event-ID or as since=.
+    With poll=1 it is a long poll instead: answered, as JSON, as soon as a device has changed
+    since the version sent (every device without one), or with none after a while.
+    """
+    streamed = True
+
+    def __init__(self, callLater=None):
+        """
+        :param callLater: Scheduler for heartbeats and long poll timeouts; reactor.callLater
+        by default
+        :type callLater: callable
+        :return: None
+        """
+        WebResource.__init__(self)
+        self.callLater = callLater or reactor.callLater
+        self.stream = None
+
+    def setCrown(self, crown):
+        WebResource.setCrown(self, crown)
+        self.stream = ChangeStream(crown, self.callLater)
+
+    def render_GET(self, request):
+        """
+        Built-in method to resource.Resource which defines what to do when asked to display
+        via http.
+        :param request: incoming http request
+        :return: NOT_DONE_YET, the answer being written as devices change
+        """
+        request.setHeader('Cache-Control', 'no-cache')
+        since = request.getHeader('Last-Event-ID') or request.args.get('since', [None])[0]
+        if since is not None and not since.isdigit():
+            return "0:Version %s is not a number." % since
+        if request.args.has_key('poll'):
+            request.setHeader('Content-Type', 'application/json')
+            self.stream.poll(request, int(since or 0))
+        else:
+            request.setHeader('Content-Type', 'text/event-stream')
+            self.stream.subscribe(request, None if since is None else int(since))
+        return server.NOT_DONE_YET
+
+class WebProfile(WebResource):
+    """
+    This object defines the Profile child resource. Its job is to profile the next few HTTP
+    requests or serial lines in the running service, see profiling.py: count gives how many
+    (by default PROFILE_COUNT), target which ("http", "serial" or "all", the default), and
+    stop=1 ends the round early. Stats are written to ~/.neptuneProfiles once the round ends.
+    """
+    # Asking about the round should not count towards it
+    profiled = False
+
+    def render_GET(self, request):
+        """
+        Built-in method to resource.Resource which defines what to do when asked to display
+        via http.
+        :param request: incoming http request
+        :return: html markup
+        :rtype: str
+        """
+        request.setHeader("content-type", "text/plain")
+        data = request.args
+
+        if not data:
+            return ''
+
+        # Verify authorized connection
+        if not data.has_key("npasasc"):
+            return "0:Authentication required. Access denied."
+        securityCode = data['npasasc'][0]
+        if securityCode != NPASASC:
+            return "0:Authentication failed. Access denied."
+
+        if data.has_key('stop'):
+            if not PROFILER.remaining:
+                return "0:Not profiling."
+            written = PROFILER.finish()
+            return "1:Profiling stopped, stats written to:\n  %s" % "\n  ".join(written)
+
+        count = data.get('count', [str(PROFILE_COUNT)])[0]
+        target = data.get('target', ['all'])[0]
+        if not count.isdigit():
+            return "0:Count %s is not a number." % count
+        try:
+            PROFILER.arm(int(count), target)
+        except ValueError as error:
+            return "0:%s." % error
+        return "1:Profiling the next %s %s calls." % (count, target)
+
+class WebTrace(WebResource):
+    """
+    This object defines the Trace child resource. Its job is to show, as JSON, the spans of
+    the trace given by id, e.g. from a request's X-Trace-Id header, or without one the most
+    recent traces; see tracing.py. Only traces still in memory can be shown; older ones are
+    in ~/.neptuneTraces.jsonl.
+    """
+    def render_GET(self, request):
+        """
+        Built-in method to resource.Resource which defines what to do when asked to display
+        via http.
+        :param request: incoming http request
+        :return: JSON
+        :rtype: str
+        """
+        request.setHeader("content-type", "text/plain")
+        data = request.args
+
+        if not data:
+            return ''
+
+        # Verify authorized connection
+        if not data.has_key("npasasc"):
+            return "0:Authentication required. Access denied."
+        securityCode = data['npasasc'][0]
+        if securityCode != NPASASC:
+            return "0:Authentication failed. Access denied."
+
+        request.setHeader("content-type", "application/json")
+        if data.has_key('id'):
+            spans = TRACER.get(data['id'][0])
+            if not spans:
+                return "0:No trace %s in memory." % data['id'][0]
+            return json.dumps(spans, indent=1, sort_keys=True)
+        return json.dumps(TRACER.recent(), indent=1, sort_keys=True)
+
+class WebMetrics(WebResource):
+    """
+    This object defines the Metrics child resource. Its job is to report how the service
+    is performing, in the Prometheus text format: requests, failures and latency by
+    endpoint, crown operations, serial traffic and queues, and the log.
+    """
+    def render_GET(self, request):
+        """
+        Built-in method to resource.Resource which defines what to do when asked to display
+        via http.
+        :param request: incoming http request
+        :return: metrics, as text
+        :rtype: str
+        """
+        request.setHeader('Content-Type', 'text/plain; version=0.0.4')
+        sampled = []
+        # Figures kept by each serial link, taken as they stand now
+        for link in getattr(self.serialProcess, 'links', [self.serialProcess]):
+            port = {'port': link.port}
+            outbound = link.outbound
+            sampled.append((metrics.SERIAL_BYTES, dict(port, direction='in'), link.bytesIn))
+            sampled.append((metrics.SERIAL_BYTES, dict(port, direction='out'), link.bytesOut))
+            sampled.append((metrics.SERIAL_READINGS, port, link.readingsIn))
+            sampled.append((metrics.SERIAL_BAD_LINES, port, link.badLines))
+            sampled.append((metrics.SERIAL_READINGS_SHED, port, link.readingsShed))
+            for outcome in ('sent', 'coalesced', 'acked', 'retried', 'failed', 'superseded'):
+                sampled.append((metrics.SERIAL_COMMANDS, dict(port, outcome=outcome),
+                                getattr(outbound, outcome)))
+            for (lane, depth) in zip(LANE_NAMES, outbound.laneDepths):
+                sampled.append((metrics.SERIAL_QUEUE_DEPTH, dict(port, lane=lane), depth))
+            for (devId, histogram) in sorted(outbound.latency.items()):
+                sampled.append((metrics.SERIAL_ACK_SECONDS, dict(port, device=devId), histogram))
+        # The log
+        logger = self.crown.logger
+        sampled.append((metrics.LOG_ENTRIES, {}, len(logger.log)))
+        sampled.append((metrics.LOG_ARCHIVED_ENTRIES, {},
+                        sum(segment['count'] for segment in logger.archive.segments)))
+        if os.path.exists(logger.logFilePath):
+            sampled.append((metrics.LOG_FILE_BYTES, {}, os.path.getsize(logger.logFilePath)))
+        sampled.append((metrics.DISK_WRITER_DEPTH, {}, logger.writer.depth))
+        return REGISTRY.render(sampled)
+
+###################################
+## SITE
+###################################
+def buildRoot(crown, serialProcess):
+    """
+    Builds the tree of web resources, giving each the crown and the serial link to use.
+    :param crown: The crown shared by every resource
+    :type crown: NeptuneCrown
+    :param serialProcess: Serial link, or SerialRouter over several, for outgoing commands
+    :return: root resource, to serve with server.Site
+    :rtype: HttpResource
+    """
+    # Define Web Resources and give them access to the serial process
     root = HttpResource()
     root.setSerial(serialProcess)
+    root.setCrown(crown)
     webFetch = WebFetch()
     webFetch.setSerial(serialProcess)
+    webFetch.setCrown(crown)
     webSet = WebSet()
     webSet.setSerial(serialProcess)
+    webSet.setCrown(crown)
     webSwitch = WebSwitch()
     webSwitch.setSerial(serialProcess)
+    webSwitch.setCrown(crown)
     webStep = WebStep()
     webStep.setSerial(serialProcess)
+    webStep.setCrown(crown)
+    webScene = WebScene()
+    webScene.setSerial(serialProcess)
+    webScene.setCrown(crown)
     webAdd = WebAdd()
     webAdd.setSerial(serialProcess)
+    webAdd.setCrown(crown)
     webRemove = WebRemove()
     webRemove.setSerial(serialProcess)
+    webRemove.setCrown(crown)
     webLog = WebLog()
     webLog.setSerial(serialProcess)
+    webLog.setCrown(crown)
     webReadLog = WebReadLog()
     webReadLog.setSerial(serialProcess)
+    webReadLog.setCrown(crown)
     webMap = WebMap()
     webMap.setSerial(serialProcess)
+    webMap.setCrown(crown)
+    webReload = WebReload()
+    webReload.setSerial(serialProcess)
+    webReload.setCrown(crown)
+    webProfile = WebProfile()
+    webProfile.setSerial(serialProcess)
+    webProfile.setCrown(crown)
+    webTrace = WebTrace()
+    webTrace.setSerial(serialProcess)
+    webTrace.setCrown(crown)
+    webMetrics = WebMetrics()
+    webMetrics.setSerial(serialProcess)
+    webMetrics.setCrown(crown)
+    webStream = WebStream()
+    webStream.setSerial(serialProcess)
+    webStream.setCrown(crown)
 
-    ## Add Web Resources to root
+    # Add Web Resources to root
     root.putChild('fetch', webFetch)
     root.putChild('set', webSet)
     root.putChild('switch', webSwitch)
     root.putChild('step', webStep)
+    root.putChild('scene', webScene)
     root.putChild('add', webAdd)
     root.putChild('remove', webRemove)
     root.putChild('log', webLog)
     root.putChild('readlog', webReadLog)
     root.putChild('map', webMap)
+    root.putChild('reload', webReload)
+    root.putChild('profile', webProfile)
+    root.putChild('trace', webTrace)
+    root.putChild('metrics', webMetrics)
+    root.putChild('stream', webStream)
+    return root
+
+###################################
+## main
+###################################
+if __name__ == '__main__':
+    # State
+    ## Files are written in order on one background thread, so the reactor never waits on disk.
+    writer = DiskWriter()
+    writer.start()
+    ## One crown owns device state and the log for as long as the reactor runs.
+    crown = NeptuneCrown(callLater=reactor.callLater, writer=writer, flushPolicy=LOG_FLUSH_POLICY)
+    ## Device changes are written behind; make sure the last of them reach the disk.
+    def shutdown():
+        crown.flush()
+        TRACER.flush()
+        writer.stop()
+    reactor.addSystemEventTrigger('before', 'shutdown', shutdown)
+    ## Profiles and traces are written by the same thread; a round of profiling may be
+    ##  started from the environment.
+    PROFILER.writer = writer
+    TRACER.writer = writer
+    LoopingCall(TRACER.flush).start(TRACE_FLUSH_INTERVAL, now=False)
+    if os.environ.get(PROFILE_VARIABLE):
+        PROFILER.arm(*parseRound(os.environ[PROFILE_VARIABLE]))
+    ## Expired log segments are removed on a worker thread, away from the reactor. A failed
+    ##  round is reported and left for the next; uncaught, it would stop the loop for good.
+    def compactLog():
+        def fail(failure):
+            print("ERROR: Log compaction failed: %s" % failure.getErrorMessage())
+        return threads.deferToThread(crown.logger.compact).addErrback(fail)
+    compaction = LoopingCall(compactLog)
+    compaction.start(LOG_COMPACTION_INTERVAL)
+
+    # Serial
+    ## Define a serial resource and spin up a connection for each Arduino; the router hands
+    ##  each outgoing command to the link serving its device, and readings from every link
+    ##  update the one crown.
+    serialProcess = SerialRouter()
+    for (port, lowId, highId) in SERIAL_LINKS:
+        print('About to open port %s for devices %s-%s' % (port, lowId, highId))
+        link = SerialResource(callLater=reactor.callLater, port=port)
+        link.setCrown(crown)
+        SerialPort(link, port, reactor, baudrate=BAUD_RATE)
+        serialProcess.addLink(link, lowId, highId)
+    ## Watch how late the reactor runs, and have every link ease off while it is overloaded.
+    lagMonitor = LagMonitor(reactor.callLater, seconds=reactor.seconds,
+                            onOverload=lambda: [link.easeOff() for link in serialProcess.links],
+                            onRecover=lambda: [link.resume() for link in serialProcess.links])
+    lagMonitor.start()
+
+    # HTTP
+    ## Build the web resources, giving them access to the crown and serial process
+    root = buildRoot(crown, serialProcess)
 
     ## Add root to Site factory and add factory to reactor
     factory = server.Site(root)
     reactor.listenTCP(8080, factory)
 
     # Fire it up, Herb
-    print("Running Neptune Serial service at: %s" % COM_PORT)
+    print("Running Neptune Serial service at: %s" % ", ".join(link.port for link in serialProcess.links))
     if PLATFORM == "windows":
         address = "http://alji-hp610:8080/"
     if PLATFORM == "mac":
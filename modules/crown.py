@@ -16,8 +16,38 @@ if PLATFORM == "mac":
     import sys
     sys.path.insert(0, '/Users/jisunstetson/bin')
 # Now, the following imports will work
+import time
+import functools
+
 from modules.neptune.devices import DeviceManager
 from modules.neptune.logger import NeptuneLogger
+from modules.neptune.metrics import REGISTRY, CROWN_OPERATIONS, CROWN_SECONDS
+from modules.neptune.tracing import TRACER
+
+# Serial type code for each kind of device that can be set; only these take part in batches
+TYPE_CODES = {"switch": "s", "step": "t"}
+
+def measured(method):
+    """
+    Decorator counting and timing a crown operation for /metrics, by whether it failed, and
+    recording it as a span of the current trace; operations report failure with a 0 in
+    place of the serial command.
+    :param method: A crown method returning (command or 0, text)
+    :type method: callable
+    :return: The wrapped method
+    :rtype: callable
+    """
+    operation = method.__name__
+    @functools.wraps(method)
+    def measuredMethod(self, *args, **kwargs):
+        start = time.time()
+        with TRACER.span('crown.%s' % operation, device=args[0] if args else None):
+            result = method(self, *args, **kwargs)
+        REGISTRY.observe(CROWN_SECONDS, time.time() - start, operation=operation)
+        REGISTRY.inc(CROWN_OPERATIONS, operation=operation,
+                     result='failed' if result[0] == 0 else 'ok')
+        return result
+    return measuredMethod
 
 class NeptuneCrown(object):
     """
@@ -26,21 +56,123 @@ class NeptuneCrown(object):
     It manipulates devices and responds in human-readable statements in cases of
     failure and success.
     """
-    def __init__(self, test=True):
+    def __init__(self, test=True, callLater=None, writer=None, flushPolicy=None):
         """
         Loads device information and registers logger
         :param test: Optional argument that turns off Serial commands so that the object can be tested
         without connection to a serial device like Arduino.
         :type test: bool
+        :param callLater: Scheduler, e.g. reactor.callLater, letting device state be written
+        behind rather than on every change.
+        :type callLater: callable
+        :param writer: Writer, e.g. a started DiskWriter, taking file writes off the caller's
+        thread. By default files are written immediately.
+        :type writer: DiskWriter
+        :param flushPolicy: When log entries are written out; by default, each immediately
+        :type flushPolicy: FlushPolicy
         :return: None
         """
-        # Load device information
-        self.deviceManager = DeviceManager()
+        # Register Logger with core ID code
+        self.logger = NeptuneLogger('0000', writer=writer, flushPolicy=flushPolicy,
+                                    callLater=callLater)
+
+        # Load device information, sharing our logger so the log is only held once
+        self.deviceManager = DeviceManager(logger=self.logger, callLater=callLater, writer=writer)
         self.devices = self.deviceManager.devices
+        # Called with the ID of each device as it changes, e.g. to push changes to web clients
+        self.listeners = []
 
-        # Register Logger with core ID code
-        self.logger = NeptuneLogger('0000')
+    def reload(self):
+        """
+        Discards in-memory state and re-reads device information and the log from disk.
+
+        A single crown is meant to live for the life of the process, so this is the only
+        point at which changes made to the files by hand are picked up.
+        :return: None
+        """
+        self.logger.reload()
+        self.deviceManager.reload()
+        self.devices = self.deviceManager.devices
+        self._changed(None)
+
+    def _changed(self, destId):
+        """
+        Internal method telling every listener that a device has changed.
+        :param destId: Device ID, or None if any device may have changed
+        :type destId: str
+        :return: None
+        """
+        for listener in self.listeners:
+            listener(destId)
+
+    def _checkChange(self, destId, newValue, deviceType):
+        """
+        Internal method checking that a device exists, is of the given type, and can take
+        a new value.
+        :param destId: Device ID
+        :type destId: str
+        :param newValue: New value
+        :type newValue: str
+        :param deviceType: "switch" or "step"
+        :type deviceType: str
+        :return: Why the change cannot be made, or None if it can
+        :rtype: str
+        """
+        # Check for the device existence
+        if not str(destId) in self.devices.keys():
+            return "No device exists with ID %s" % destId
+        if self.devices[destId]['deviceType'] != deviceType:
+            return "Device \"%s\" (%s) is not a %s type." % (self.devices[destId]['name'], destId, deviceType)
+        if not newValue.isdigit():
+            return "New value %s is not a digit." % newValue
+        # Make sure new value is within range
+        minVal = self.devices[destId]['minValue']
+        maxVal = self.devices[destId]['maxValue']
+        if int(newValue) < int(minVal):
+            return "New value %s is below minimum %s." % (newValue, minVal)
+        if int(newValue) > int(maxVal):
+            return "New value %s is above maximum %s." % (newValue, maxVal)
+        return None
+
+    def _describeChange(self, destId, newValue):
+        """
+        Internal method describing a change to a switch or step device, for the user.
+        :param destId: Device ID
+        :type destId: str
+        :param newValue: New value, already checked
+        :type newValue: str
+        :rtype: str
+        """
+        device = self.devices[destId]
+        prettyVal = newValue
+        if int(newValue) == int(device['minValue']):
+            prettyVal = device['minName']
+        elif int(newValue) == int(device['maxValue']):
+            prettyVal = device['maxName']
+        if device['deviceType'] == "switch":
+            return "Device %s has been switched to %s" % (device['name'], prettyVal)
+
+        prettyExtra = ''
+        if '&#37;' in device['unitType']:
+            prettyExtra = device['unitType']
+        elif device['unitType'] == "%":
+            multiplier = 100.0/float(device['maxValue'])
+            perc = multiplier*float(newValue)
+            percMin = 100.0-perc
+            prettyExtra = ", (%s%% %s, %s%% %s)" % (percMin, device['minValue'],
+                                                        perc, device['maxName'])
+        return "Device %s has been set to %s%s" % (device['name'], prettyVal, prettyExtra)
+
+    def flush(self):
+        """
+        Writes any log entries and device changes still waiting to be saved to disk.
+        :return: Ticket for the device write, or None if there was nothing to write
+        :rtype: WriteTicket
+        """
+        self.logger.flush()
+        return self.deviceManager.flush()
 
+    @measured
     def setSwitchDevice(self, destId, newValue, author='0000'):
         """
         Given the ID of a switch device, sets a value
@@ -55,54 +187,27 @@ class NeptuneCrown(object):
         self.logger.author = author
         commandStr = "Switch device %s to %s." % (destId, newValue)
 
-        # Check for the device existence
-        if not str(destId) in self.devices.keys():
-            failure = (0, "No device exists with ID %s" % destId)
-            self.logger.logCommand(destId, commandStr, failure)
-            return failure
-
-        # Process the device based on type:
-        if self.devices[destId]['deviceType'] == "switch":
-            typeCode = "s"
-        else:
-            failure = (0, "Device \"%s\" (%s) is not a switch type." % (self.devices[destId]['name'],destId))
-            self.logger.logCommand(destId, commandStr, failure)
-            return failure
-
-        if not newValue.isdigit():
-            failure = (0, "New value %s is not a digit." % newValue)
-            self.logger.logCommand(destId, commandStr, failure)
-            return failure
-
-        # Make sure new value is within rage
-        minVal = self.devices[destId]['minValue']
-        maxVal = self.devices[destId]['maxValue']
-        if int(newValue) < int(minVal):
-            failure = (0, "New value %s is below minimum %s." % (newValue, minVal))
-            self.logger.logCommand(destId, commandStr, failure)
-            return failure
-        if int(newValue) > int(maxVal):
-            failure = (0, "New value %s is above maximum %s." % (newValue, maxVal))
+        # Check the device exists, is a switch, and can take the value
+        problem = self._checkChange(destId, newValue, "switch")
+        if problem is not None:
+            failure = (0, problem)
             self.logger.logCommand(destId, commandStr, failure)
             return failure
 
         # Great! Format some pretty output
-        prettyVal = newValue
-        if int(newValue) == int(minVal):
-            prettyVal = self.devices[destId]['minName']
-        elif int(newValue) == int(maxVal):
-            prettyVal = self.devices[destId]['maxName']
-        prettyDescription = "Device %s has been switched to %s" % (self.devices[destId]['name'], prettyVal)
+        prettyDescription = self._describeChange(destId, newValue)
 
         # Make the change
         self.devices[destId]['currentValue'] = newValue
-        self.deviceManager.saveState(self.devices)
+        self.deviceManager.saveState(self.devices, destId)
+        self._changed(destId)
         # Construct serial command
-        success = (">%s%s%s" % (destId, typeCode, newValue), prettyDescription)
+        success = (">%s%s%s" % (destId, TYPE_CODES["switch"], newValue), prettyDescription)
         # Log the change
         self.logger.logCommand(destId, commandStr, success)
         return success
 
+    @measured
     def setStepDevice(self, destId, newValue, author='0000'):
         """
         Given the ID of a step device, sets a value
@@ -117,64 +222,27 @@ class NeptuneCrown(object):
         self.logger.author = author
         commandStr = "Set variable step device %s to %s." % (destId, newValue)
 
-        # Check for the device existence
-        if not str(destId) in self.devices.keys():
-            failure = (0, "No device exists with ID %s" % destId)
-            self.logger.logCommand(destId, commandStr, failure)
-            return failure
-
-        # Process the device based on type:
-        if self.devices[destId]['deviceType'] == "step":
-            typeCode = "t"
-        else:
-            failure = (0, "Device \"%s\" (%s) is not a step type." % (self.devices[destId]['name'],destId))
-            self.logger.logCommand(destId, commandStr, failure)
-            return failure
-
-        if not newValue.isdigit():
-            failure = (0, "New value %s is not a digit." % newValue)
-            self.logger.logCommand(destId, commandStr, failure)
-            return failure
-
-        # Make sure new value is within rage
-        minVal = self.devices[destId]['minValue']
-        maxVal = self.devices[destId]['maxValue']
-        if int(newValue) < int(minVal):
-            failure = (0, "New value %s is below minimum %s." % (newValue, minVal))
-            self.logger.logCommand(destId, commandStr, failure)
-            return failure
-        if int(newValue) > int(maxVal):
-            failure = (0, "New value %s is above maximum %s." % (newValue, maxVal))
+        # Check the device exists, is a step device, and can take the value
+        problem = self._checkChange(destId, newValue, "step")
+        if problem is not None:
+            failure = (0, problem)
             self.logger.logCommand(destId, commandStr, failure)
             return failure
 
         # Great! Format some pretty output
-        prettyVal = newValue
-        if int(newValue) == int(minVal):
-            prettyVal = self.devices[destId]['minName']
-        elif int(newValue) == int(maxVal):
-            prettyVal = self.devices[destId]['maxName']
-        prettyExtra = ''
-        if '&#37;' in self.devices[destId]['unitType']:
-            prettyExtra = self.devices[destId]['unitType']
-        elif self.devices[destId]['unitType'] == "%":
-            multiplier = 100.0/float(self.devices[destId]['maxValue'])
-            perc = multiplier*float(newValue)
-            percMin = 100.0-perc
-            prettyExtra = ", (%s%% %s, %s%% %s)" % (percMin, self.devices[destId]['minValue'], 
-                                                        perc, self.devices[destId]['maxName'])
-
-        prettyDescription = "Device %s has been set to %s%s" % (self.devices[destId]['name'], prettyVal, prettyExtra)
+        prettyDescription = self._describeChange(destId, newValue)
 
         # Make the change
         self.devices[destId]['currentValue'] = newValue
-        self.deviceManager.saveState(self.devices)
+        self.deviceManager.saveState(self.devices, destId)
+        self._changed(destId)
         # Construct serial command
-        success = (">%s%s%s" % (destId, typeCode, newValue), prettyDescription)
+        success = (">%s%s%s" % (destId, TYPE_CODES["step"], newValue), prettyDescription)
         # Log the change
         self.logger.logCommand(destId, commandStr, success)
         return success
 
+    @measured
     def updateSensorDevice(self, destId, newValue, author='0000'):
         """
         Given the ID of a sensor device, queries device for an update
@@ -200,6 +268,7 @@ class NeptuneCrown(object):
             failure = (0, "Device \"%s\" (%s) is not a sensor type." % (self.devices[destId]['name'],destId))
             self.logger.logCommand(destId, commandStr, failure)
             return failure
+        typeCode = "n"
 
         if not newValue.isdigit():
             failure = (0, "New value %s is not a digit." % newValue)
@@ -220,11 +289,18 @@ class NeptuneCrown(object):
 
         # Great! Format some pretty output
         prettyDescription = "Device %s has been updated to value %s." % (self.devices[destId]['name'], newValue)
+        # Store the reading, whichever serial link it came in on; a repeated reading changes
+        #  nothing. Readings are live data, so they are not written to disk on their own
+        if newValue != self.devices[destId]['currentValue']:
+            self.devices[destId]['currentValue'] = newValue
+            self.deviceManager.noteChange(self.devices, destId)
+            self._changed(destId)
         # Construct serial command
         success = (">%s%s%s" % (destId, typeCode, newValue), prettyDescription)
         self.logger.logCommand(destId, commandStr, success)
         return success
 
+    @measured
     def setDeviceAttribute(self, destId, attrName, newValue, author='0000'):
         """
         Given the ID of a device, sets a specified attribute to a given value
@@ -260,7 +336,123 @@ class NeptuneCrown(object):
             typeCode = "u" 
 
         self.devices[destId][attrName] = newValue
-        self.deviceManager.saveState(self.devices)
+        self.deviceManager.saveState(self.devices, destId)
+        self._changed(destId)
         success = (1, ">%s%s%s" % (destId, typeCode, newValue))
         self.logger.logCommand(destId, commandStr, success)
         return success
+
+    def checkChanges(self, changes):
+        """
+        Checks a batch of changes to switch and step devices, without making any.
+        :param changes: (device ID, new value) for each device to set
+        :type changes: list
+        :return: Why each change that cannot be made cannot, in order; empty if all can
+        :rtype: list
+        """
+        if not changes:
+            return ["No changes given."]
+        problems = []
+        seen = set()
+        for (destId, newValue) in changes:
+            if destId in seen:
+                problems.append("Device %s is set more than once." % destId)
+                continue
+            seen.add(destId)
+            deviceType = self.devices.get(destId, {}).get('deviceType')
+            if destId in self.devices and deviceType not in TYPE_CODES:
+                problems.append("Device \"%s\" (%s) is not a switch or step type."
+                                % (self.devices[destId]['name'], destId))
+                continue
+            problem = self._checkChange(destId, newValue, deviceType)
+            if problem is not None:
+                problems.append(problem)
+        return problems
+
+    @measured
+    def applyChanges(self, changes, author='0000', scene=None):
+        """
+        Sets several switch and step devices at once: every change is checked first, and
+        either all are made or, if any cannot be, none. The changes are saved to disk
+        together, logged in one group, and come back as serial commands to be sent in one
+        transmission.
+        :param changes: (device ID, new value) for each device to set
+        :type changes: list
+        :param author: Device ID of the object requesting the change
+        :param scene: Name of the scene the changes come from, if any, for the log
+        :type scene: str
+        :return: Either a list of serial commands or failure code, and human readable text
+        :rtype: tuple
+        """
+        self.logger.author = author
+        changes = [(str(destId), str(newValue)) for (destId, newValue) in changes]
+        problems = self.checkChanges(changes)
+
+        with self.logger.batch():
+            if scene is not None:
+                self.logger.logComment("Applying scene %s." % scene)
+            if problems:
+                failure = (0, "Nothing has been changed. %s" % " ".join(problems))
+                for (destId, newValue) in changes:
+                    self.logger.logCommand(destId, "Set device %s to %s." % (destId, newValue), failure)
+                return failure
+
+            # Great! Make every change, then save them as one
+            commands = []
+            descriptions = []
+            for (destId, newValue) in changes:
+                descriptions.append(self._describeChange(destId, newValue))
+                self.devices[destId]['currentValue'] = newValue
+                commands.append(">%s%s%s" % (destId, TYPE_CODES[self.devices[destId]['deviceType']], newValue))
+            self.deviceManager.saveState(self.devices, [destId for (destId, newValue) in changes])
+            for (destId, newValue) in changes:
+                self._changed(destId)
+            for ((destId, newValue), command, description) in zip(changes, commands, descriptions):
+                self.logger.logCommand(destId, "Set device %s to %s." % (destId, newValue), (command, description))
+        return (commands, "\n".join(descriptions))
+
+    def saveScene(self, name, changes):
+        """
+        Stores a named scene, a batch of changes which can be applied together later with
+        applyScene; the changes are checked now, and again when applied.
+        :param name: Scene name, e.g. "spa"
+        :type name: str
+        :param changes: (device ID, new value) for each device the scene sets
+        :type changes: list
+        :return: Success or failure code, and human readable text
+        :rtype: tuple
+        """
+        changes = [(str(destId), str(newValue)) for (destId, newValue) in changes]
+        problems = self.checkChanges(changes)
+        if problems:
+            return (0, "Scene %s has not been saved. %s" % (name, " ".join(problems)))
+        self.deviceManager.saveScene(name, changes)
+        self.logger.logComment("Saved scene %s: %s." % (name, ", ".join("%s to %s" % change for change in changes)))
+        return (1, "Scene %s has been saved, setting %s devices." % (name, len(changes)))
+
+    def applyScene(self, name, author='0000'):
+        """
+        Applies a named scene, as with applyChanges.
+        :param name: Scene name
+        :type name: str
+        :param author: Device ID of the object requesting the change
+        :return: Either a list of serial commands or failure code, and human readable text
+        :rtype: tuple
+        """
+        if name not in self.deviceManager.scenes:
+            return (0, "No scene is named %s." % name)
+        return self.applyChanges(self.deviceManager.scenes[name], author, scene=name)
+
+    def removeScene(self, name):
+        """
+        Forgets a named scene.
+        :param name: Scene name
+        :type name: str
+        :return: Success or failure code, and human readable text
+        :rtype: tuple
+        """
+        if name not in self.deviceManager.scenes:
+            return (0, "No scene is named %s." % name)
+        self.deviceManager.removeScene(name)
+        self.logger.logComment("Removed scene %s." % name)
+        return (1, "Scene %s has been removed." % name)
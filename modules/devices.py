@@ -11,6 +11,7 @@
 #-------------------------------------------------------------------------------
 import os
 import json
+import time
 
 # On my Mac, required modules are not in the Python Path and must be inserted.
 PLATFORM = "mac"
@@ -19,6 +20,12 @@ if PLATFORM == "mac":
     sys.path.insert(0, '/Users/jisunstetson/bin')
 # Now this line will work on all platforms:
 from modules.neptune.logger import NeptuneLogger
+from modules.neptune.fileutil import atomicWrite
+from modules.neptune.writer import InlineWriter
+from modules.neptune.tracing import TRACER
+
+# Seconds to gather device changes before writing them to disk in one go
+SAVE_DELAY = 0.5
 
 class NeptuneDevice(object):
     """
@@ -439,28 +446,88 @@ class DefaultDeviceMapper(object):
 class DeviceManager(object):
     """
     This object saves and loads the state of all devices on the Neptune.
+
+    Given a scheduler, saves are written behind: saveState only marks the state dirty, and
+    every change made within saveDelay seconds of the first is written out together.
+    Sensor readings are noted with noteChange instead, which marks the state dirty without
+    scheduling a save of its own, so they reach disk with the next save or flush.
+    The state is serialized on the caller's thread and written to disk through a writer
+    (see writer.py).
+
+    Attributes:
+        dirty (bool): Whether devices holds changes not yet written to disk.
+        version (int): Bumped whenever devices changes or is reloaded, so that anything
+        derived from it knows to be rebuilt. It starts from the time in microseconds, so
+        versions keep rising across restarts.
+        deviceVersions (dict): For each device changed since the last reload, the version
+        it was last changed at.
+        reloadedAt (int): Version at the last reload; every device may have changed then.
+        scenes (dict): Named scenes, each a list of [device ID, value] changes applied
+        together; kept in their own file, next to the device info.
     """
-    def __init__(self):
+    def __init__(self, logger=None, callLater=None, saveDelay=SAVE_DELAY, writer=None):
         """
         Load device state from disk or from default, store in memory.
+        :param logger: Optional logger to share with the caller, rather than loading another.
+        :type logger: NeptuneLogger
+        :param callLater: Scheduler used to write behind, e.g. reactor.callLater. Without
+        one, every save is written immediately.
+        :type callLater: callable
+        :param saveDelay: Seconds to gather changes before writing them
+        :type saveDelay: float
+        :param writer: Writer performing file writes; by default they happen immediately
+        :type writer: DiskWriter or InlineWriter
         :return: None
         """
         # Register Logger with ID matching that of the core device.
-        self.logger = NeptuneLogger('0000')
-        
+        if logger is None:
+            logger = NeptuneLogger('0000')
+        self.logger = logger
+        self.callLater = callLater
+        self.saveDelay = saveDelay
+        if writer is None:
+            writer = InlineWriter()
+        self.writer = writer
+        self.dirty = False
+        self.version = int(time.time() * 1000000)
+        self.deviceVersions = {}
+        self.reloadedAt = 0
+        self._pendingFlush = None
+        # (trace ID, when) for each trace with a change waiting to be written
+        self._pendingTraces = []
+
         # Define filepath of device state
         ## This works on multiple platforms with different env variables for home
         if os.environ.has_key('HOMEPATH'):
             self.deviceInfoFilePath = "%s/.neptuneDeviceInfo.json" % os.environ['HOMEPATH']
         else:
             self.deviceInfoFilePath = "%s/.neptuneDeviceInfo.json" % os.environ['HOME']
+        self.sceneFilePath = os.path.join(os.path.dirname(self.deviceInfoFilePath), ".neptuneScenes.json")
         # Load device info
+        self.reload()
+
+    def reload(self):
+        """
+        Loads device info from disk, falling back to (and writing out) the defaults.
+        Changes not yet written are written first, once every write already queued has
+        reached disk, so that nothing set before the reload is lost.
+        :return: None
+        """
+        self.flush()
+        self.version += 1
+        self.deviceVersions = {}
+        self.reloadedAt = self.version
+        self.writer.drain()
         if os.path.exists(self.deviceInfoFilePath):
             self.devices = self._loadDevicesFromFile()
         else:
             self.logger.logComment("Creating new Device Info file at %s" % self.deviceInfoFilePath)
             self.devices = self._loadDevicesFromDefaults()
-        
+        self.scenes = {}
+        if os.path.exists(self.sceneFilePath):
+            with open(self.sceneFilePath) as sceneFile:
+                self.scenes = json.load(sceneFile)
+
     def _loadDevicesFromFile(self):
         """
         Reads the device info file off of disk and load it into memory.
@@ -485,17 +552,116 @@ class DeviceManager(object):
         for device in defaults:
             devices[device.attrs['deviceId']] = device.attrs
         # Write them to disk
-        with open(self.deviceInfoFilePath, 'w') as deviceInfoFile:
-            json.dump(devices, deviceInfoFile)
+        self.writer.submit(atomicWrite, self.deviceInfoFilePath, json.dumps(devices))
         return devices
 
-    def saveState(self, devices):
+    def saveState(self, devices, changed=None):
         """
-        Saves the current state of all devices to disk.
+        Saves the current state of all devices to disk, once the save delay has passed.
         :param devices: device data as a dict of device ids and attributes
         :type devices: dict
+        :param changed: ID of the device which changed, or a list of IDs for several changed
+        together; if not given, any may have
+        :type changed: str or list
         :return: None
         """
-        with open(self.deviceInfoFilePath, 'w') as deviceInfoFile:
-            json.dump(devices, deviceInfoFile)
-        
+        self.noteChange(devices, changed)
+        if TRACER.current is not None:
+            self._pendingTraces.append((TRACER.current, TRACER.seconds()))
+        if self.callLater is None or not self.saveDelay:
+            self.flush()
+        elif self._pendingFlush is None:
+            # The window opens at the first change; later ones ride along with it
+            self._pendingFlush = self.callLater(self.saveDelay, self.flush)
+
+    def noteChange(self, devices, changed=None):
+        """
+        Records that devices have changed, marking them dirty and bumping the version, but
+        without scheduling a save; e.g. for sensor readings, which are live data and not worth
+        a write of their own. They reach disk with the next save, or with flush at shutdown.
+        :param devices: device data as a dict of device ids and attributes
+        :type devices: dict
+        :param changed: ID of the device which changed, or a list of IDs for several changed
+        together; if not given, any may have
+        :type changed: str or list
+        :return: None
+        """
+        self.devices = devices
+        self.dirty = True
+        self.version += 1
+        if changed is None:
+            self.deviceVersions = {}
+            self.reloadedAt = self.version
+        elif isinstance(changed, list):
+            for devId in changed:
+                self.deviceVersions[devId] = self.version
+        else:
+            self.deviceVersions[changed] = self.version
+
+    def changedSince(self, version):
+        """
+        Lists the devices changed after a version, for clients which hold the state as it
+        was then and only want what has changed.
+        :param version: A version the client was given earlier
+        :type version: int
+        :return: IDs of the devices changed, or None if every device must be sent: the
+        version is from before the last reload, or from before a restart
+        :rtype: list
+        """
+        if version < self.reloadedAt or version > self.version:
+            return None
+        return sorted(devId for (devId, changedAt) in self.deviceVersions.items() if changedAt > version)
+
+    def flush(self):
+        """
+        Writes any unsaved changes to disk now. Callers which need a change to be durable
+        before they carry on, and the reactor at shutdown, use this to skip the wait; wait
+        on the returned ticket to know the write has completed.
+        :return: Ticket for the write, or None if there was nothing to write
+        :rtype: WriteTicket
+        """
+        self._cancelFlush()
+        if not self.dirty:
+            return None
+        # Serialize now, so later changes cannot leak into this write half-made
+        deviceJson = json.dumps(self.devices)
+        self.dirty = False
+        (waiting, self._pendingTraces) = (self._pendingTraces, [])
+        # Write to a temporary file and rename, so a crash never leaves half a file
+        return self.writer.submit(TRACER.traced('devices.write', waiting, atomicWrite),
+                                  self.deviceInfoFilePath, deviceJson)
+
+    def saveScene(self, name, changes):
+        """
+        Stores a named scene, replacing any of the same name, and writes the scenes out.
+        :param name: Scene name, e.g. "spa"
+        :type name: str
+        :param changes: (device ID, value) for each device the scene sets
+        :type changes: list
+        :return: Ticket for the write
+        :rtype: WriteTicket
+        """
+        self.scenes[name] = [[devId, value] for (devId, value) in changes]
+        return self.writer.submit(atomicWrite, self.sceneFilePath, json.dumps(self.scenes))
+
+    def removeScene(self, name):
+        """
+        Forgets a named scene, and writes the scenes out.
+        :param name: Scene name
+        :type name: str
+        :return: Ticket for the write
+        :rtype: WriteTicket
+        """
+        del self.scenes[name]
+        return self.writer.submit(atomicWrite, self.sceneFilePath, json.dumps(self.scenes))
+
+    def _cancelFlush(self):
+        """
+        Internal method which cancels a scheduled flush, if one is waiting.
+        :return: None
+        """
+        if self._pendingFlush is not None:
+            if self._pendingFlush.active():
+                self._pendingFlush.cancel()
+            self._pendingFlush = None
+
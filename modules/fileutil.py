@@ -0,0 +1,43 @@
+#-------------------------------------------------------------------------------
+# Name:        fileutil.py
+# Purpose:     Small file helpers shared by the Neptune Pool and Spa Automation
+#              modules which keep files on disk.
+#
+# Author:      alji
+#
+# Created:     18/10/2026
+# Copyright:   (c) alji 2026
+# Licence:     <your licence>
+#-------------------------------------------------------------------------------
+import os
+
+def replaceFile(sourcePath, destPath):
+    """
+    Moves sourcePath over destPath. On POSIX the rename is atomic; Windows will not
+    rename over an existing file, so there the old file is removed first.
+    :param sourcePath: File to move
+    :type sourcePath: str
+    :param destPath: File to replace
+    :type destPath: str
+    :return: None
+    """
+    if os.name == 'nt' and os.path.exists(destPath):
+        os.remove(destPath)
+    os.rename(sourcePath, destPath)
+
+def atomicWrite(path, data):
+    """
+    Writes data to a temporary file beside path, syncs it to disk, and then moves it
+    over path, so that readers only ever see the old file or the complete new one.
+    :param path: File to write
+    :type path: str
+    :param data: Contents of the file
+    :type data: str
+    :return: None
+    """
+    tempPath = path + '.tmp'
+    with open(tempPath, 'w') as tempFile:
+        tempFile.write(data)
+        tempFile.flush()
+        os.fsync(tempFile.fileno())
+    replaceFile(tempPath, path)
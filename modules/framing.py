@@ -0,0 +1,151 @@
+#-------------------------------------------------------------------------------
+# Name:        framing.py
+# Purpose:     Module for Neptune Pool and Spa Automation containing the compact
+#              binary frame format the Arduino may use in place of text lines,
+#              carrying many device readings per frame.
+#
+# Author:      alji
+#
+# Created:     18/10/2026
+# Copyright:   (c) alji 2026
+# Licence:     <your licence>
+#-------------------------------------------------------------------------------
+import struct
+import binascii
+
+# A frame is:
+#   magic   1 byte   FRAME_MAGIC
+#   count   1 byte   number of readings, 1-255
+#   reading 5 bytes  each: device ID (uint16), device type code (char), value (uint16)
+#   check   2 bytes  CRC-16/CCITT of everything before it
+# all big-endian. A text line costs 9 bytes per reading (e.g. "2007n80\r\n"); a frame
+# costs 5 per reading plus 4 per frame.
+FRAME_MAGIC = 0xA5
+HEADER = struct.Struct('>BB')
+READING = struct.Struct('>HcH')
+CHECK = struct.Struct('>H')
+MAX_READINGS = 255
+# Smallest and largest frames, in bytes
+MIN_FRAME = HEADER.size + READING.size + CHECK.size
+MAX_FRAME = HEADER.size + MAX_READINGS * READING.size + CHECK.size
+
+# Text lines used to agree on frames. The controller asks with FRAMES_ON; the Arduino
+# answers FRAMES_ACCEPTED and sends frames from then on. Anything else, or no answer,
+# means the link stays on text lines. FRAMES_OFF puts the Arduino back on text lines.
+FRAMES_ON = "?F1"
+FRAMES_OFF = "?F0"
+FRAMES_ACCEPTED = "!F1"
+
+# Device IDs are four digits, e.g. 2007
+_deviceId = "%04d".__mod__
+
+# One Struct for each reading count, built when first seen
+_BODIES = {}
+
+def _body(count):
+    """
+    Internal function returning the Struct unpacking count readings at once.
+    :type count: int
+    :rtype: struct.Struct
+    """
+    body = _BODIES.get(count)
+    if body is None:
+        body = _BODIES[count] = struct.Struct('>' + READING.format[1:] * count)
+    return body
+
+def checksum(data):
+    """
+    CRC-16/CCITT (initial value 0xFFFF) of data, as the Arduino computes it.
+    :type data: str
+    :rtype: int
+    """
+    return binascii.crc_hqx(data, 0xFFFF)
+
+def encodeFrame(readings):
+    """
+    Packs readings into one frame.
+    :param readings: Up to MAX_READINGS tuples of (device ID, type code, value)
+    :type readings: list
+    :return: The frame
+    :rtype: str
+    """
+    if not 0 < len(readings) <= MAX_READINGS:
+        raise ValueError("A frame holds 1 to %s readings, not %s" % (MAX_READINGS, len(readings)))
+    fields = []
+    for (devId, typeCode, value) in readings:
+        fields.extend((int(devId), typeCode, int(value)))
+    frame = HEADER.pack(FRAME_MAGIC, len(readings)) + _body(len(readings)).pack(*fields)
+    return frame + CHECK.pack(checksum(frame))
+
+class FrameDecoder(object):
+    """
+    This object turns the bytes arriving from the Arduino back into readings. Bytes may
+    arrive in any size of chunk; partial frames are kept until the rest comes in. A frame
+    failing its checksum is dropped, and decoding picks up at the next FRAME_MAGIC.
+
+    Attributes:
+        frames (int): Frames decoded.
+        badFrames (int): Frames dropped for a bad checksum or reading count.
+        badRun (int): Frames dropped since the last good one.
+        skipped (int): Bytes discarded looking for the start of a frame.
+    """
+    def __init__(self):
+        self.buffer = ''
+        self.frames = 0
+        self.badFrames = 0
+        self.badRun = 0
+        self.skipped = 0
+
+    def feed(self, data):
+        """
+        Adds bytes from the link, and decodes every frame now complete.
+        :param data: Bytes read from the link
+        :type data: str
+        :return: tuples of (device ID, type code, value), device ID as four digits and
+        value as a string, like the fields of a text line
+        :rtype: list
+        """
+        buf = self.buffer + data
+        readings = []
+        offset = 0
+        magic = chr(FRAME_MAGIC)
+        while True:
+            start = buf.find(magic, offset)
+            if start < 0:
+                self.skipped += len(buf) - offset
+                offset = len(buf)
+                break
+            self.skipped += start - offset
+            offset = start
+            if len(buf) - offset < HEADER.size:
+                break
+            count = HEADER.unpack_from(buf, offset)[1]
+            if count == 0:
+                self.badFrames += 1
+                self.badRun += 1
+                offset += 1
+                continue
+            bodyEnd = offset + HEADER.size + count * READING.size
+            if len(buf) < bodyEnd + CHECK.size:
+                break
+            if CHECK.unpack_from(buf, bodyEnd)[0] != checksum(buf[offset:bodyEnd]):
+                # Not a frame after all, or a damaged one; look again one byte on
+                self.badFrames += 1
+                self.badRun += 1
+                offset += 1
+                continue
+            fields = _body(count).unpack_from(buf, offset + HEADER.size)
+            readings.extend(zip(map(_deviceId, fields[0::3]), fields[1::3], map(str, fields[2::3])))
+            self.frames += 1
+            self.badRun = 0
+            offset = bodyEnd + CHECK.size
+        self.buffer = buf[offset:]
+        return readings
+
+    def reset(self):
+        """
+        Discards any partial frame, e.g. when the link goes back to text lines.
+        :return: None
+        """
+        self.buffer = ''
+        self.badRun = 0
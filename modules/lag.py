@@ -0,0 +1,137 @@
+#-------------------------------------------------------------------------------
+# Name:        lag.py
+# Purpose:     Module for Neptune Pool and Spa Automation containing the probe which
+#              watches how late the reactor runs what it has scheduled, and tells the
+#              rest of the service when to ease off.
+#
+# Author:      alji
+#
+# Created:     18/10/2026
+# Copyright:   (c) alji 2026
+# Licence:     <your licence>
+#-------------------------------------------------------------------------------
+import time
+
+from modules.neptune.metrics import REGISTRY, REACTOR_LAG_SECONDS, REACTOR_OVERLOADED, REACTOR_OVERLOADS
+
+# Seconds between probes
+LAG_INTERVAL = 0.25
+# Smoothed lag, in seconds, at which the reactor counts as overloaded, and below which it
+# counts as recovered; the gap keeps the service from flapping between the two
+LAG_THRESHOLD = 0.1
+LAG_RECOVERED = 0.025
+# Weight given to each new probe in the smoothed lag
+LAG_SMOOTHING = 0.3
+
+# Asks the Arduino to report its sensors this many times less often, 1 being its usual rate
+SENSOR_SLOWDOWN = "?S%d"
+# Slowdown asked for while the reactor is overloaded
+OVERLOAD_SLOWDOWN = 4
+
+class LagMonitor(object):
+    """
+    This object measures how late the reactor runs a call scheduled every interval seconds,
+    which is how long anything else scheduled, a web request or a serial line, waits its
+    turn. Lag is smoothed over several probes so a single slow call does not count.
+
+    When the smoothed lag reaches threshold the reactor is overloaded, and onOverload is
+    called; once it falls back below recovered, onRecover is called.
+
+    Attributes:
+        lag (float): Lag of the latest probe, in seconds.
+        smoothed (float): Lag smoothed over recent probes, in seconds.
+        worst (float): Largest lag seen, in seconds.
+        overloaded (bool): Whether the reactor is overloaded.
+        overloads (int): Times the reactor has become overloaded.
+    """
+    def __init__(self, callLater, interval=LAG_INTERVAL, threshold=LAG_THRESHOLD,
+                 recovered=LAG_RECOVERED, smoothing=LAG_SMOOTHING, seconds=time.time,
+                 onOverload=None, onRecover=None):
+        """
+        :param callLater: Scheduler, e.g. reactor.callLater
+        :type callLater: callable
+        :param interval: Seconds between probes
+        :type interval: float
+        :param threshold: Smoothed lag at which the reactor is overloaded
+        :type threshold: float
+        :param recovered: Smoothed lag below which an overloaded reactor has recovered
+        :type recovered: float
+        :param smoothing: Weight given to each new probe, from 0 to 1
+        :type smoothing: float
+        :param seconds: Clock, e.g. reactor.seconds
+        :type seconds: callable
+        :param onOverload: Called with no arguments when the reactor becomes overloaded
+        :type onOverload: callable
+        :param onRecover: Called with no arguments when the reactor recovers
+        :type onRecover: callable
+        :return: None
+        """
+        if recovered > threshold:
+            raise ValueError("Recovery lag %s is above the overload threshold %s" % (recovered, threshold))
+        self.callLater = callLater
+        self.interval = interval
+        self.threshold = threshold
+        self.recovered = recovered
+        self.smoothing = smoothing
+        self.seconds = seconds
+        self.onOverload = onOverload
+        self.onRecover = onRecover
+        self.lag = 0.0
+        self.smoothed = 0.0
+        self.worst = 0.0
+        self.overloaded = False
+        self.overloads = 0
+        self._expected = None
+        self._probe = None
+
+    def start(self):
+        """
+        Starts probing.
+        :return: None
+        """
+        if self._probe is None:
+            self._schedule()
+
+    def stop(self):
+        """
+        Stops probing.
+        :return: None
+        """
+        if self._probe is not None:
+            if self._probe.active():
+                self._probe.cancel()
+            self._probe = None
+
+    def _schedule(self):
+        """
+        Internal method which schedules the next probe.
+        :return: None
+        """
+        self._expected = self.seconds() + self.interval
+        self._probe = self.callLater(self.interval, self._measure)
+
+    def _measure(self):
+        """
+        Internal method run by each probe: records how late it ran and decides whether
+        the reactor is overloaded.
+        :return: None
+        """
+        self.lag = max(0.0, self.seconds() - self._expected)
+        self._schedule()
+        self.smoothed += self.smoothing * (self.lag - self.smoothed)
+        self.worst = max(self.worst, self.lag)
+        REGISTRY.observe(REACTOR_LAG_SECONDS, self.lag)
+        if not self.overloaded and self.smoothed >= self.threshold:
+            self.overloaded = True
+            self.overloads += 1
+            REGISTRY.inc(REACTOR_OVERLOADS)
+            REGISTRY.set(REACTOR_OVERLOADED, 1)
+            print("WARNING: Reactor running %.0f ms late, easing off" % (self.smoothed * 1000.0))
+            if self.onOverload is not None:
+                self.onOverload()
+        elif self.overloaded and self.smoothed < self.recovered:
+            self.overloaded = False
+            REGISTRY.set(REACTOR_OVERLOADED, 0)
+            print("Reactor back on time, resuming")
+            if self.onRecover is not None:
+                self.onRecover()
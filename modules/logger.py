@@ -5,6 +5,12 @@
 #              two object types: a logger and a log entry, and is capable of
 #              logging a variety of entry types.
 #
+#              The log is stored as JSON lines: one entry per line, appended as
+#              it is logged, so that logging never rewrites what is already on disk.
+#              Once the active log file grows large or old enough it is rolled over
+#              into an archive of segments, which are gzip compressed in the
+#              background and dropped after a retention period.
+#
 # Author:      alji
 #
 # Created:     03/04/2013
@@ -12,63 +18,444 @@
 # Licence:     <your licence>
 #-------------------------------------------------------------------------------
 import os
+import re
 import json
+import gzip
+import zlib
 import serial
-from time import sleep
+import threading
+from time import sleep, time
+from contextlib import contextmanager
 from random import randint
-from datetime import datetime
+from bisect import bisect_left, bisect_right, insort
+from datetime import datetime, timedelta
+from collections import OrderedDict
+
+from modules.neptune.fileutil import atomicWrite
+from modules.neptune.writer import InlineWriter
+from modules.neptune.metrics import REGISTRY, LOG_FLUSHES, LOG_ENTRIES_FLUSHED, LOG_WRITE_SECONDS
+from modules.neptune.tracing import TRACER
+
+# Log entries are keyed by time to the microsecond plus a sequence number, e.g.
+#  2013:04:03:17:42:05.123456:000000
+# Every field is fixed width, so keys sort chronologically as plain strings.
+LOG_TIME_FORMAT = "%Y:%m:%d:%H:%M:%S.%f"
+# Format of the keys used by older logs; one entry per second, named weekday in the middle
+LEGACY_TIME_FORMAT = "%Y:%m:%d:%A:%H:%M:%S"
+
+# The active log rolls over into the archive at whichever of these limits it reaches first
+MAX_SEGMENT_BYTES = 4 * 1024 * 1024
+MAX_SEGMENT_AGE = timedelta(days=7)
+# Archived segments are dropped once everything in them is older than this
+RETENTION = timedelta(days=90)
+# zlib level used for archived segments; 6 is zlib's own balance of size against speed
+COMPRESS_LEVEL = 6
+# Entries per block of an archived segment. Blocks are indexed, and compressed one by one,
+#  so that a query reads only the blocks which can hold its matches
+BLOCK_ENTRIES = 256
+# Seconds a rolled over segment stays in memory after reaching the archive, covering
+#  queries which read the archive before it arrived there
+RETIRE_GRACE = 60
+
+def formatLogTime(when, sequence=0):
+    """
+    Builds a log key from a time and a sequence number.
+    :param when: Time of the entry
+    :type when: datetime
+    :param sequence: Distinguishes entries logged within the same microsecond
+    :type sequence: int
+    :return: log key
+    :rtype: str
+    """
+    return "%s:%06d" % (when.strftime(LOG_TIME_FORMAT), sequence)
+
+def parseLogTime(logTime):
+    """
+    Splits a log key back into its time and sequence number.
+    :param logTime: log key
+    :type logTime: str
+    :return: time and sequence number
+    :rtype: tuple
+    """
+    stamp, sequence = logTime.rsplit(':', 1)
+    return (datetime.strptime(stamp, LOG_TIME_FORMAT), int(sequence))
+
+def toLogTime(logTime):
+    """
+    Converts a key in the legacy per-second format to the current format. Current keys
+    are returned unchanged.
+    :param logTime: log key in either format
+    :type logTime: str
+    :return: log key in the current format
+    :rtype: str
+    """
+    # Current keys have the hour where legacy keys have the weekday; skip the slow parse
+    if logTime[11:12].isdigit():
+        return logTime
+    try:
+        return formatLogTime(datetime.strptime(logTime, LEGACY_TIME_FORMAT))
+    except ValueError:
+        return logTime
+
+def insertOrdered(logTimes, logTime):
+    """
+    Adds a key to a time-ordered list of keys. New entries nearly always belong at the
+    end, so that case is a plain append.
+    :param logTimes: Keys, oldest first
+    :type logTimes: list
+    :param logTime: Key to add
+    :type logTime: str
+    :return: None
+    """
+    if not logTimes or logTime > logTimes[-1]:
+        logTimes.append(logTime)
+    else:
+        insort(logTimes, logTime)
+
+def parseRecord(line):
+    """
+    Decodes one line of a log file.
+    :param line: JSON line, as written by NeptuneLogger
+    :type line: str
+    :return: (log key, entry data), or None for a blank or unreadable line
+    :rtype: tuple
+    """
+    if not line.strip():
+        return None
+    try:
+        record = json.loads(line)
+    except ValueError:
+        # A crash mid-append can leave a partial last line behind
+        print("Skipping unreadable log line: %s" % line.strip())
+        return None
+    return (toLogTime(record.pop('logTime')), record)
+
+def readRecords(logFile, needle=None):
+    """
+    Reads log entries from an open log file one line at a time.
+    :param logFile: File of JSON lines, as written by NeptuneLogger, or a list of its lines
+    :type logFile: file
+    :param needle: Text every wanted line holds, e.g. from fieldNeedle; other lines are
+    skipped without being decoded
+    :type needle: str
+    :return: generator of (log key, entry data), in the order they were written
+    """
+    for line in logFile:
+        if needle is not None and needle not in line:
+            continue
+        record = parseRecord(line)
+        if record is not None:
+            yield record
+
+def fieldNeedle(field, value):
+    """
+    Builds the text found in the line of every entry whose field holds value. Lines are
+    written by json.dumps, so the pair reads exactly as json.dumps writes it in a dict.
+    :param field: Field of the entry, e.g. 'destination'
+    :type field: str
+    :param value: Value of the field
+    :rtype: str
+    """
+    return json.dumps({field: value})[1:-1]
+
+def appendLines(path, lines, sync=False):
+    """
+    Appends lines to a log file in a single write; nothing already written is touched.
+    :param path: The log file
+    :type path: str
+    :param lines: The lines, each including its newline
+    :type lines: str
+    :param sync: Whether to fsync, so the lines survive a power cut once this returns
+    :type sync: bool
+    :return: None
+    """
+    with open(path, 'a') as logFile:
+        logFile.write(lines)
+        if sync:
+            logFile.flush()
+            os.fsync(logFile.fileno())
+
+# appendLines, with each write observed for /metrics
+timedAppendLines = REGISTRY.timed(LOG_WRITE_SECONDS, appendLines)
+
+def truncateFile(path):
+    """
+    Empties a file, creating it if need be.
+    :param path: The file
+    :type path: str
+    :return: None
+    """
+    logFile = open(path, 'w')
+    logFile.close()
+
+def nextSequence(logTime):
+    """
+    Returns the key following logTime within the same microsecond.
+    :param logTime: log key
+    :type logTime: str
+    :rtype: str
+    """
+    when, sequence = parseLogTime(logTime)
+    return formatLogTime(when, sequence + 1)
+
+class FlushPolicy(object):
+    """
+    This object decides when the lines a NeptuneLogger has buffered are written out, in
+    one write (and one fsync) per flush:
+        FlushPolicy()                        every entry, immediately
+        FlushPolicy(maxEntries=50)           every 50 entries
+        FlushPolicy(maxEntries=50, maxDelay=0.2)
+                                             every 50 entries, or 0.2s after the first
+                                             of them, whichever comes first
+    A maxDelay needs the logger to have a scheduler; without one every entry is flushed.
+    """
+    def __init__(self, maxEntries=1, maxDelay=None, sync=True):
+        """
+        :param maxEntries: Entries to buffer before flushing
+        :type maxEntries: int
+        :param maxDelay: Seconds an entry may wait in the buffer, or None for no limit
+        :type maxDelay: float
+        :param sync: Whether each flush is fsynced to disk
+        :type sync: bool
+        :return: None
+        """
+        self.maxEntries = maxEntries
+        self.maxDelay = maxDelay
+        self.sync = sync
 
 class NeptuneLogger(object):
     """
     This object manipulates the Neptune Log, clearing or filling it with entries.
 
+    Only the active segment of the log is held in memory. Queries span the active
+    segment and the archive, so callers need not know where an entry lives.
+
+    Files are written through a writer (see writer.py). With a DiskWriter, logging only
+    updates memory and queues the append; a segment which has been rolled over stays in
+    memory until the writer has moved it into the archive.
+
+    New entries go into memory at once, but their lines are buffered and written out as
+    the flush policy dictates. Within a batch() they are all written in a single flush.
+
     Attributes:
         last (str): Returns the last log entry, commonly used to check for success
         by client after a new log entry.
+        log (OrderedDict): Entries in the active segment, by key.
+        logTimes (list): Every key in the active segment, oldest first.
+        indexes (dict): For each of INDEXED_FIELDS, the keys of the active entries
+        holding each value of that field, oldest first.
+        archive (LogArchive): Segments the log has rolled over into.
     """
-    def __init__(self, author):
+    # Entry fields with an index kept in memory alongside the log
+    INDEXED_FIELDS = ('destination', 'entryType', 'author')
+
+    def __init__(self, author, maxSegmentBytes=MAX_SEGMENT_BYTES, maxSegmentAge=MAX_SEGMENT_AGE,
+                 retention=RETENTION, writer=None, flushPolicy=None, callLater=None):
         """
         :param author: Every entry requires an author; the device ID of the requester.
         :type author: str or int
+        :param maxSegmentBytes: Size at which the active log rolls over, or None for no limit
+        :type maxSegmentBytes: int
+        :param maxSegmentAge: Age of its oldest entry at which the active log rolls over,
+        or None for no limit
+        :type maxSegmentAge: timedelta
+        :param retention: How long archived segments are kept, or None to keep them forever
+        :type retention: timedelta
+        :param writer: Writer performing file writes; by default they happen immediately
+        :type writer: DiskWriter or InlineWriter
+        :param flushPolicy: When buffered entries are written; by default, each immediately
+        :type flushPolicy: FlushPolicy
+        :param callLater: Scheduler, e.g. reactor.callLater, for the policy's maxDelay
+        :type callLater: callable
         :return: None
         """
         self.author = author
+        self.maxSegmentBytes = maxSegmentBytes
+        self.maxSegmentAge = maxSegmentAge
+        if writer is None:
+            writer = InlineWriter()
+        self.writer = writer
+        if flushPolicy is None:
+            flushPolicy = FlushPolicy()
+        self.flushPolicy = flushPolicy
+        self.callLater = callLater
+        # Encoded lines waiting to be written, and the state deciding when they are
+        self._pendingLines = []
+        self._pendingFlush = None
+        self._batchDepth = 0
+        # (trace ID, when) for each trace with lines waiting to be written
+        self._pendingTraces = []
         # This software can be run on multiple platforms, each with its own env
         #  variable for the home dir. The following ensures compatibility.
         if os.environ.has_key('HOMEPATH'):
-            self.logFilePath = "%s/.neptuneLog.json" % os.environ['HOMEPATH']
+            homeDir = os.environ['HOMEPATH']
         else:
-            self.logFilePath = "%s/.neptuneLog.json" % os.environ['HOME']
+            homeDir = os.environ['HOME']
+        self.logFilePath = "%s/.neptuneLog.jsonl" % homeDir
+        # Logs from before the JSON lines format are migrated on first load
+        self.legacyLogFilePath = "%s/.neptuneLog.json" % homeDir
+        self.archive = LogArchive("%s/.neptuneLogArchive" % homeDir, retention)
         # Load log into memory, or create it if it does not exist.
+        self.reload()
+
+    def reload(self):
+        """
+        Discards the log held in memory and reads it back from disk, once every write
+        already queued has reached it.
+        :return: None
+        """
+        self.flush()
+        self.writer.drain()
+        self.archive.reload()
         self.log = self.getOrCreateLog()
+        self._rebuildIndexes()
+        # Segments rolled over but still on their way into the archive
+        self._retiring = []
+        if os.path.exists(self.logFilePath):
+            self.activeBytes = os.path.getsize(self.logFilePath)
+        else:
+            self.activeBytes = 0
+        # Newest key anywhere in the log; new keys must sort after it
+        if self.logTimes:
+            self.lastLogTime = self.logTimes[-1]
+        else:
+            self.lastLogTime = self.archive.lastLogTime
+        # The newest archived entry, kept for last so that it never reads the archive
+        self._lastArchived = {}
+        if self.archive.lastLogTime is not None:
+            self._lastArchived = dict(self.archive.iterEntries(start=self.archive.lastLogTime))
+        self._rollOverAt = None
+
+    def _rebuildIndexes(self):
+        """
+        Internal method which builds every index from the log held in memory.
+        :return: None
+        """
+        # Time-ordered index; files are written in order, so this sort is nearly free
+        self.logTimes = sorted(self.log)
+        self.indexes = dict((field, {}) for field in self.INDEXED_FIELDS)
+        for logTime in self.logTimes:
+            self._indexEntry(logTime, self.log[logTime])
+
+    def _indexEntry(self, logTime, data):
+        """
+        Internal method which adds one entry to each secondary index.
+        :param logTime: Key of the entry
+        :type logTime: str
+        :param data: The entry's data
+        :type data: dict
+        :return: None
+        """
+        for field in self.INDEXED_FIELDS:
+            insertOrdered(self.indexes[field].setdefault(data.get(field), []), logTime)
 
     def getOrCreateLog(self):
         """
         This method simply checks for the existence of a log file, and creates one
-        if required.
-        :return: log in the form of nested dicts from json
+        if required. The file is read one line at a time, in the order it was written.
+        :return: log in the form of nested dicts from json, keyed by log time
+        :rtype: OrderedDict
         """
+        if not os.path.exists(self.logFilePath) and os.path.exists(self.legacyLogFilePath):
+            self._migrateLegacyLog()
+
+        log = OrderedDict()
         if os.path.exists(self.logFilePath):
-            logFile = open(self.logFilePath, 'r')
-            log = json.loads(logFile.read())
-            logFile.close()
+            with open(self.logFilePath, 'r') as logFile:
+                for (logTime, record) in readRecords(logFile):
+                    # Entries from the legacy format could share a second; keep them all
+                    while logTime in log:
+                        logTime = nextSequence(logTime)
+                    log[logTime] = record
         else:
             print("No device log found. Creating.")
-            log = {}
         return log
 
+    def _migrateLegacyLog(self):
+        """
+        Internal method which converts a log written as one JSON dict into JSON lines,
+        oldest entry first. The old file is kept alongside, renamed, rather than deleted.
+        :return: None
+        """
+        print("Migrating device log %s to %s." % (self.legacyLogFilePath, self.logFilePath))
+        with open(self.legacyLogFilePath, 'r') as legacyFile:
+            legacyLog = json.load(legacyFile)
+
+        # Write to a temporary file first so an interrupted migration is simply redone
+        tempPath = self.logFilePath + '.migrating'
+        with open(tempPath, 'w') as logFile:
+            for logTime in sorted(legacyLog, key=toLogTime):
+                logFile.write(self._encodeRecord(toLogTime(logTime), legacyLog[logTime]))
+        os.rename(tempPath, self.logFilePath)
+        os.rename(self.legacyLogFilePath, self.legacyLogFilePath + '.migrated')
+
+    def _encodeRecord(self, logTime, data):
+        """
+        Internal method which encodes one log entry as a single line of JSON.
+        :param logTime: Key of the entry in the log
+        :type logTime: str
+        :param data: The entry's data
+        :type data: dict
+        :return: JSON followed by a newline
+        :rtype: str
+        """
+        record = dict(data)
+        record['logTime'] = logTime
+        return json.dumps(record) + "\n"
+
     def clearLog(self):
         """
         This method simply clears the device log, leaving it on disk.
         :return: None
         """
-        self.log = {} # Clear log in memory
-        logJson = json.dumps(self.log)
+        self.log = OrderedDict() # Clear log in memory
+        self._rebuildIndexes()
+        self._retiring = []
+        self._lastArchived = {}
+        self._cancelFlush()
+        self._pendingLines = []
+        self._pendingTraces = []
+        self.activeBytes = 0
+        self._rollOverAt = None
+
+        # Truncate the log file and drop the archive.
+        self.writer.submit(truncateFile, self.logFilePath)
+        self.writer.submit(self.archive.clear)
+
+    def rollOver(self):
+        """
+        Moves the active log into the archive as a new segment and starts an empty one.
+        :return: None
+        """
+        if not self.logTimes:
+            return
+        segment = self.archive.describeSegment(self.logTimes, self.indexes)
+        # Queued behind every append to the active file, so the segment moves complete
+        self.flush()
+        ticket = self.writer.submit(self.archive.addSegment, self.logFilePath, segment)
+        self._retiring.append({'log': self.log,
+                               'logTimes': self.logTimes,
+                               'indexes': self.indexes,
+                               'ticket': ticket,
+                               'archivedAt': None})
+        self._lastArchived = {self.logTimes[-1]: self.log[self.logTimes[-1]]}
+        self.log = OrderedDict()
+        self._rebuildIndexes()
+        self.activeBytes = 0
+        self._rollOverAt = None
 
-        # Write empty log to file.
-        logFile = open(self.logFilePath, 'w')
-        logFile.write(logJson)
-        logFile.close()
+    def compact(self, now=None):
+        """
+        Compresses newly archived segments and drops those which have passed the
+        retention period. Only the archive is touched, so this may run on a thread other
+        than the reactor's.
+        :param now: Time to measure retention from, defaulting to the current time
+        :type now: datetime
+        :return: File names of the segments dropped
+        :rtype: list
+        """
+        self.archive.compressPending()
+        return self.archive.compact(now)
 
     def logCommand(self, deviceId, command, success):
         """
@@ -81,8 +468,7 @@ class NeptuneLogger(object):
         :type success: bool
         :return: None
         """
-        nowDt = datetime.now()
-        now = nowDt.strftime("%Y:%m:%d:%A:%H:%M:%S")
+        now = self._nextLogTime()
 
         entry = NeptuneLogEntry(entryType="command",
                                 author=self.author,
@@ -99,8 +485,7 @@ class NeptuneLogger(object):
         :type comment: str
         :return: None
         """
-        nowDt = datetime.now()
-        now = nowDt.strftime("%Y:%m:%d:%A:%H:%M:%S")
+        now = self._nextLogTime()
 
         entry = NeptuneLogEntry(entryType="comment",
                                 author=self.author,
@@ -118,8 +503,7 @@ class NeptuneLogger(object):
         :type success: bool
         :return: None
         """
-        nowDt = datetime.now()
-        now = nowDt.strftime("%Y:%m:%d:%A:%H:%M:%S")
+        now = self._nextLogTime()
 
         entry = NeptuneLogEntry(entryType="handshake",
                                 author=self.author,
@@ -128,6 +512,22 @@ class NeptuneLogger(object):
                                 success=success)
         self._addEntry(entry)
 
+    def _nextLogTime(self, logTime=None):
+        """
+        Internal method which returns a key for a new entry. Keys never repeat and never
+        go backwards, even if several entries land in one microsecond or the clock is
+        set back; in either case the sequence number is advanced instead.
+        :param logTime: Key asked for by the caller, or None for the current time
+        :type logTime: str
+        :return: log key
+        :rtype: str
+        """
+        if logTime is None:
+            logTime = formatLogTime(datetime.now())
+        if self.lastLogTime is not None and logTime <= self.lastLogTime:
+            logTime = nextSequence(self.lastLogTime)
+        return logTime
+
     def _addEntry(self, entry):
         """
         Internal method which just writes the requested entry to the log.
@@ -135,51 +535,605 @@ class NeptuneLogger(object):
         :type entry: NeptuneLogEntry
         :return: None
         """
+        # Start a new segment first if the active one has grown too old
+        if self._rollOverAt is not None and entry.logTime >= self._rollOverAt:
+            self.rollOver()
+
         # Add the entry to the log in memory, by date/time
-        self.log[entry.logTime] = entry.data
-        # Encode as JSON
-        logJson = json.dumps(self.log)
+        data = entry.data
+        self.log[entry.logTime] = data
+        insertOrdered(self.logTimes, entry.logTime)
+        self._indexEntry(entry.logTime, data)
+        if self.lastLogTime is None or entry.logTime > self.lastLogTime:
+            self.lastLogTime = entry.logTime
+        # Encode as a single line of JSON
+        line = self._encodeRecord(entry.logTime, data)
+
+        # Buffer the line for appending to the log file, as the flush policy allows
+        self._pendingLines.append(line)
+        self.activeBytes += len(line)
+        if TRACER.current is not None:
+            self._pendingTraces.append((TRACER.current, TRACER.seconds()))
+        self._scheduleFlush()
+
+        if self.maxSegmentBytes is not None and self.activeBytes >= self.maxSegmentBytes:
+            self.rollOver()
+        elif self._rollOverAt is None and self.maxSegmentAge is not None:
+            self._rollOverAt = formatLogTime(parseLogTime(self.logTimes[0])[0] + self.maxSegmentAge)
+
+    def logMany(self, entries):
+        """
+        Logs several entries with a single flush, e.g. a burst of sensor readings.
+        :param entries: The entries to log; any without a logTime are given one, and any
+        whose logTime is taken or older than the last entry are sequenced after it
+        :type entries: list of NeptuneLogEntry
+        :return: None
+        """
+        with self.batch():
+            for entry in entries:
+                if entry.logTime is not None:
+                    entry.logTime = toLogTime(entry.logTime)
+                entry.logTime = self._nextLogTime(entry.logTime)
+                self._addEntry(entry)
+
+    @contextmanager
+    def batch(self):
+        """
+        Context in which every entry logged is written out in one flush, at its end,
+        whatever the flush policy. Batches may be nested; the outermost one flushes.
+        :return: context manager
+        """
+        self._batchDepth += 1
+        try:
+            yield self
+        finally:
+            self._batchDepth -= 1
+            if not self._batchDepth:
+                self.flush()
+
+    def _scheduleFlush(self):
+        """
+        Internal method which flushes buffered lines if the flush policy calls for it
+        now, or arranges for a flush after the policy's maxDelay.
+        :return: None
+        """
+        if self._batchDepth:
+            return
+        policy = self.flushPolicy
+        if len(self._pendingLines) >= policy.maxEntries:
+            self.flush()
+        elif policy.maxDelay is not None:
+            if self.callLater is None:
+                self.flush()
+            elif self._pendingFlush is None:
+                self._pendingFlush = self.callLater(policy.maxDelay, self.flush)
 
-        # Write device state json to file.
-        logFile = open(self.logFilePath, 'w')
-        logFile.write(logJson)
-        logFile.close()
+    def flush(self):
+        """
+        Writes every buffered line to the log file, in one write.
+        :return: Ticket for the write, or None if there was nothing to write
+        :rtype: WriteTicket
+        """
+        self._cancelFlush()
+        if not self._pendingLines:
+            return None
+        REGISTRY.inc(LOG_FLUSHES)
+        REGISTRY.inc(LOG_ENTRIES_FLUSHED, len(self._pendingLines))
+        lines = ''.join(self._pendingLines)
+        self._pendingLines = []
+        (waiting, self._pendingTraces) = (self._pendingTraces, [])
+        return self.writer.submit(TRACER.traced('log.write', waiting, timedAppendLines),
+                                  self.logFilePath, lines, self.flushPolicy.sync)
 
-    def _getType(self, type):
+    def _cancelFlush(self):
+        """
+        Internal method which cancels a scheduled flush, if one is waiting.
+        :return: None
+        """
+        if self._pendingFlush is not None:
+            if self._pendingFlush.active():
+                self._pendingFlush.cancel()
+            self._pendingFlush = None
+
+    def _inMemory(self):
+        """
+        Internal method which lists the segments held in memory: any still retiring into
+        the archive, oldest first, and then the active segment. Retiring segments are
+        forgotten RETIRE_GRACE seconds after the writer has archived them.
+        :return: (log, logTimes, indexes) for each segment
+        :rtype: list
+        """
+        now = time()
+        segments = []
+        for retiring in list(self._retiring):
+            if retiring['ticket'].done:
+                if retiring['archivedAt'] is None:
+                    retiring['archivedAt'] = now
+                elif now - retiring['archivedAt'] > RETIRE_GRACE:
+                    self._retiring.remove(retiring)
+                    continue
+            segments.append((retiring['log'], retiring['logTimes'], retiring['indexes']))
+        segments.append((self.log, self.logTimes, self.indexes))
+        return segments
+
+    def _getIndexed(self, field, value, archived=None):
+        """
+        Internal method which fetches the entries whose field holds value, by index. Reading
+        the archive is disk I/O, so callers on the reactor thread read it on a worker thread
+        and pass what they read as archived.
+        :param field: One of INDEXED_FIELDS
+        :type field: str
+        :param value: Value of the field to match
+        :param archived: The archived matches, if already read off the reactor thread with
+        archive.iterEntries(field=field, value=value); read here otherwise
+        :type archived: list
+        :return: Matching log entries, oldest first
+        :rtype: OrderedDict
+        """
+        if archived is None:
+            archived = self.archive.iterEntries(field=field, value=value)
+        # An entry in the archive and still in memory is simply matched twice, by one key
+        matches = OrderedDict(archived)
+        for (log, logTimes, indexes) in self._inMemory():
+            for logTime in indexes[field].get(value, []):
+                matches[logTime] = log[logTime]
+        return matches
+
+    def _getType(self, type, archived=None):
         """
         Internal method which searches device log for entries by type.
         :param type: The type of entry to fetch (Command, Comment, Handshake)
+        :param archived: The archived matches, if already read (see _getIndexed)
+        :type archived: list
         :return: Entries matching the type requested.
         :rtype: dict
         """
-        matches = {}
-        for entry in self.log:
-            if self.log[entry]['entryType'] == type:
-                matches[entry] = self.log[entry]
-        return matches
+        return self._getIndexed('entryType', type, archived)
+
+    def getByDestination(self, deviceId, archived=None):
+        """
+        Fetches every entry addressed to a device, e.g. its history of commands.
+        :param deviceId: Device ID of the destination
+        :type deviceId: str
+        :param archived: The archived matches, if already read (see _getIndexed)
+        :type archived: list
+        :return: Log entries with that destination, oldest first.
+        :rtype: OrderedDict
+        """
+        return self._getIndexed('destination', deviceId, archived)
+
+    def getByAuthor(self, author, archived=None):
+        """
+        Fetches every entry logged by a device.
+        :param author: Device ID of the author
+        :type author: str
+        :param archived: The archived matches, if already read (see _getIndexed)
+        :type archived: list
+        :return: Log entries by that author, oldest first.
+        :rtype: OrderedDict
+        """
+        return self._getIndexed('author', author, archived)
 
-    def getComments(self):
+    def getComments(self, archived=None):
         """
         Fetches Comments from the log.
+        :param archived: The archived matches, if already read (see _getIndexed)
+        :type archived: list
         :return: Log entries of type Comment.
         :rtype: dict
         """
-        return self._getType("comment")
+        return self._getType("comment", archived)
 
-    def getHandshakes(self):
+    def getHandshakes(self, archived=None):
         """
         Fetches Handshakes from the log.
+        :param archived: The archived matches, if already read (see _getIndexed)
+        :type archived: list
         :return: Log entries of type Comment.
         :rtype: dict
         """
-        return self._getType("handshake")
+        return self._getType("handshake", archived)
+
+    def getRange(self, start=None, end=None, archived=None):
+        """
+        Fetches the entries logged from start up to, but not including, end.
+        :param start: Earliest time to include, or None for the beginning of the log
+        :type start: datetime or str
+        :param end: Time to stop at, or None for the end of the log
+        :type end: datetime or str
+        :param archived: The archived matches, if already read off the reactor thread with
+        archive.iterEntries(start, end); read here otherwise
+        :type archived: list
+        :return: Matching log entries, oldest first
+        :rtype: OrderedDict
+        """
+        if isinstance(start, datetime):
+            start = formatLogTime(start)
+        if isinstance(end, datetime):
+            end = formatLogTime(end)
+        if archived is None:
+            archived = self.archive.iterEntries(start, end)
+
+        matches = OrderedDict(archived)
+        for (log, logTimes, indexes) in self._inMemory():
+            first = 0 if start is None else bisect_left(logTimes, start)
+            stop = len(logTimes) if end is None else bisect_left(logTimes, end)
+            for logTime in logTimes[first:stop]:
+                matches[logTime] = log[logTime]
+        return matches
 
     @property
     def last(self):
         """The last log entry logged"""
-        lastDate = self.log.keys()[-1]
-        lastEntry = self.log[lastDate]
-        return {lastDate:lastEntry}
+        for (log, logTimes, indexes) in reversed(self._inMemory()):
+            if logTimes:
+                lastDate = logTimes[-1]
+                lastEntry = log[lastDate]
+                return {lastDate:lastEntry}
+        # Just rolled over; the last entry closes the newest archived segment
+        return dict(self._lastArchived)
+
+class LogArchive(object):
+    """
+    This object holds the segments the active log has rolled over into. Segments live in
+    their own directory beside a manifest recording, for each segment, the range of keys
+    it covers and the values of NeptuneLogger.INDEXED_FIELDS within it, so that queries
+    only open the segments which can hold a match. Each segment is divided into blocks of
+    BLOCK_ENTRIES entries, and the manifest also records where each block begins and which
+    blocks hold each value; a query reads just those blocks, one at a time, so its cost
+    follows its matches rather than the size of the archive.
+
+    A segment arrives as plain JSON lines and is later gzip compressed by
+    compressPending, off the reactor thread, one block to a gzip member so that any block
+    can be decompressed on its own; either form can be queried.
+
+    Attributes:
+        segments (list): The manifest; one dict per segment, oldest first.
+        lastLogTime (str): Key of the newest archived entry, or None.
+    """
+    def __init__(self, archiveDir, retention=RETENTION):
+        """
+        :param archiveDir: Directory holding the segments and manifest
+        :type archiveDir: str
+        :param retention: How long segments are kept, or None to keep them forever
+        :type retention: timedelta
+        :return: None
+        """
+        self.archiveDir = archiveDir
+        self.manifestPath = os.path.join(archiveDir, 'manifest.json')
+        self.retention = retention
+        # Segments are added on the reactor thread but compacted on another; both go
+        #  through this lock to change the manifest.
+        self.lock = threading.Lock()
+        self.segments = []
+
+    def reload(self):
+        """
+        Reads the manifest back from disk.
+        :return: None
+        """
+        with self.lock:
+            if os.path.exists(self.manifestPath):
+                with open(self.manifestPath, 'r') as manifestFile:
+                    self.segments = json.load(manifestFile)
+            else:
+                self.segments = []
+
+    def _saveManifest(self):
+        """
+        Internal method which writes the manifest to disk. The caller must hold the lock.
+        :return: None
+        """
+        if not os.path.isdir(self.archiveDir):
+            os.makedirs(self.archiveDir)
+        atomicWrite(self.manifestPath, json.dumps(self.segments))
+
+    def _segmentPath(self, segment):
+        return os.path.join(self.archiveDir, segment['file'])
+
+    def _openSegment(self, segment):
+        """
+        Internal method which opens a segment's file for reading, as it is stored.
+        :rtype: file
+        """
+        return open(self._segmentPath(segment), 'rb')
+
+    def _openCurrent(self, segment):
+        """
+        Internal method which opens a segment as the manifest now lists it. Our copy of the
+        manifest may name a file compressPending has since renamed, so a file which fails to
+        open is looked up again; only a segment the manifest has dropped is given up on.
+        :param segment: Manifest entry, possibly out of date
+        :type segment: dict
+        :return: (the open segment, the manifest entry it was opened by), or (None, None)
+        if it has been compacted away
+        :rtype: tuple
+        """
+        while True:
+            try:
+                return (self._openSegment(segment), segment)
+            except IOError:
+                with self.lock:
+                    current = [listed for listed in self.segments
+                               if listed['first'] == segment['first']]
+                if not current:
+                    return (None, None)
+                if current[0]['file'] == segment['file']:
+                    # Still listed under the name which failed; not a race, so let it out
+                    raise
+                segment = current[0]
+
+    def _indexBlocks(self, sourceFile, fields, targetFile=None):
+        """
+        Internal method which divides a segment into blocks of BLOCK_ENTRIES entries and
+        indexes them: the first key and offset of each block, and the blocks holding each
+        value of each field. Given a targetFile, each block is also compressed into it as a
+        gzip member of its own, and the offsets are into that file.
+        :param sourceFile: The segment as plain JSON lines, open for reading
+        :type sourceFile: file
+        :param fields: Fields to index
+        :type fields: list
+        :param targetFile: File to compress the segment into, or None
+        :type targetFile: file
+        :return: (blocks, blockIndex) for the manifest entry
+        :rtype: tuple
+        """
+        blocks = []
+        # Values are keyed by their JSON, so that None survives the manifest
+        blockIndex = dict((field, {}) for field in fields)
+        lines = []
+        offset = 0
+        entries = 0
+        for line in sourceFile:
+            record = parseRecord(line)
+            if record is not None:
+                (logTime, data) = record
+                if entries % BLOCK_ENTRIES == 0:
+                    if targetFile is not None:
+                        self._writeMember(targetFile, lines)
+                        lines = []
+                        offset = targetFile.tell()
+                    blocks.append([logTime, offset])
+                for field in fields:
+                    holding = blockIndex[field].setdefault(json.dumps(data.get(field)), [])
+                    if not holding or holding[-1] != len(blocks) - 1:
+                        holding.append(len(blocks) - 1)
+                entries += 1
+            if targetFile is None:
+                offset += len(line)
+            else:
+                lines.append(line)
+        if targetFile is not None:
+            self._writeMember(targetFile, lines)
+        return (blocks, blockIndex)
+
+    def _writeMember(self, targetFile, lines):
+        """
+        Internal method which appends lines to a file as one gzip member.
+        :return: None
+        """
+        if not lines:
+            return
+        member = gzip.GzipFile(fileobj=targetFile, mode='wb', compresslevel=COMPRESS_LEVEL)
+        try:
+            member.write(''.join(lines))
+        finally:
+            member.close()
+
+    def _blockSpans(self, segment, start=None, end=None, field=None, value=None):
+        """
+        Internal method which finds the blocks of a segment a query has to read: those
+        which can hold a match.
+        :return: (offset, offset of the next block or None) for each block, oldest first
+        :rtype: list
+        """
+        blocks = segment['blocks']
+        keys = [block[0] for block in blocks]
+        first = 0 if start is None else max(bisect_right(keys, start) - 1, 0)
+        last = len(keys) - 1 if end is None else bisect_left(keys, end) - 1
+        if field is None:
+            wanted = range(first, last + 1)
+        else:
+            wanted = [number for number in segment['blockIndex'][field].get(json.dumps(value), [])
+                      if first <= number <= last]
+        return [(blocks[number][1], blocks[number + 1][1] if number + 1 < len(blocks) else None)
+                for number in wanted]
+
+    def _readBlock(self, segment, segmentFile, offset, endOffset):
+        """
+        Internal method which reads one block of an open segment, decompressing it if the
+        segment has been compressed.
+        :return: The block's lines
+        :rtype: list
+        """
+        segmentFile.seek(offset)
+        if endOffset is None:
+            data = segmentFile.read()
+        else:
+            data = segmentFile.read(endOffset - offset)
+        if segment['file'].endswith('.gz'):
+            # The block is a gzip member of its own
+            data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+        return data.splitlines(True)
+
+    @property
+    def lastLogTime(self):
+        """Key of the newest archived entry"""
+        with self.lock:
+            if not self.segments:
+                return None
+            return self.segments[-1]['last']
+
+    def describeSegment(self, logTimes, indexes):
+        """
+        Builds the manifest entry for a segment about to be added.
+        :param logTimes: Every key in the segment, oldest first
+        :type logTimes: list
+        :param indexes: The logger's indexes over the segment
+        :type indexes: dict
+        :return: manifest entry
+        :rtype: dict
+        """
+        return {'file': "%s.jsonl" % re.sub(r'\D', '', logTimes[0]),
+                'first': logTimes[0],
+                'last': logTimes[-1],
+                'count': len(logTimes),
+                'values': dict((field, list(index)) for (field, index) in indexes.items())}
+
+    def addSegment(self, sourcePath, segment):
+        """
+        Moves a log file into the archive as its newest segment.
+        :param sourcePath: The log file; it no longer exists once this returns
+        :type sourcePath: str
+        :param segment: Manifest entry for the file, from describeSegment
+        :type segment: dict
+        :return: None
+        """
+        segment['bytes'] = os.path.getsize(sourcePath)
+        with open(sourcePath, 'rb') as sourceFile:
+            (segment['blocks'], segment['blockIndex']) = self._indexBlocks(sourceFile,
+                                                                           sorted(segment['values']))
+        with self.lock:
+            if not os.path.isdir(self.archiveDir):
+                os.makedirs(self.archiveDir)
+            os.rename(sourcePath, self._segmentPath(segment))
+            self.segments.append(segment)
+            self._saveManifest()
+
+    def iterEntries(self, start=None, end=None, field=None, value=None):
+        """
+        Streams archived entries from start up to, but not including, end, optionally
+        only those whose field holds value.
+        :param start: Earliest key to include, or None
+        :type start: str
+        :param end: Key to stop at, or None
+        :type end: str
+        :param field: One of NeptuneLogger.INDEXED_FIELDS, or None for every entry
+        :type field: str
+        :param value: Value of field to match
+        :return: generator of (log key, entry data), oldest first
+        """
+        with self.lock:
+            segments = list(self.segments)
+        needle = None
+        if field is not None and value is not None:
+            # A line without the field at all matches None too, so that has no needle
+            needle = fieldNeedle(field, value)
+        for segment in segments:
+            if start is not None and segment['last'] < start:
+                continue
+            if end is not None and segment['first'] >= end:
+                break
+            if field is not None and value not in segment['values'][field]:
+                continue
+            (segmentFile, segment) = self._openCurrent(segment)
+            if segmentFile is None:
+                # Compacted away since we took our copy of the manifest
+                continue
+            with segmentFile:
+                for (offset, endOffset) in self._blockSpans(segment, start, end, field, value):
+                    for (logTime, data) in readRecords(self._readBlock(segment, segmentFile, offset, endOffset),
+                                                       needle):
+                        if start is not None and logTime < start:
+                            continue
+                        if end is not None and logTime >= end:
+                            break
+                        if field is not None and data.get(field) != value:
+                            continue
+                        yield (logTime, data)
+
+    def compressPending(self):
+        """
+        Compresses every segment still held as plain JSON lines. The compressed copy is
+        written beside the original, and the manifest only switches to it once complete.
+        :return: None
+        """
+        with self.lock:
+            pending = [segment for segment in self.segments
+                       if not segment['file'].endswith('.gz')]
+        for segment in pending:
+            fileName = segment['file']
+            rawPath = os.path.join(self.archiveDir, fileName)
+            tempPath = rawPath + '.gz.tmp'
+            with open(rawPath, 'rb') as rawFile:
+                with open(tempPath, 'wb') as compressedFile:
+                    (blocks, blockIndex) = self._indexBlocks(rawFile, sorted(segment['values']),
+                                                             compressedFile)
+            os.rename(tempPath, rawPath + '.gz')
+
+            compressed = dict(segment, file=fileName + '.gz', blocks=blocks, blockIndex=blockIndex,
+                              compressedBytes=os.path.getsize(rawPath + '.gz'))
+            with self.lock:
+                # Replaced rather than changed in place; a reader may hold the old entry, and
+                #  its offsets must keep matching the file it names
+                self.segments = [compressed if listed['file'] == fileName else listed
+                                 for listed in self.segments]
+                self._saveManifest()
+            self._removeSegmentFile(fileName)
+
+    def _removeSegmentFile(self, fileName):
+        """
+        Internal method which deletes a segment file no longer in the manifest. A reader
+        may still hold it open, which Windows refuses; it is then left for sweepOrphans.
+        :return: None
+        """
+        try:
+            os.remove(os.path.join(self.archiveDir, fileName))
+        except OSError as e:
+            print("Unable to remove log segment %s: %s" % (fileName, e))
+
+    def sweepOrphans(self):
+        """
+        Deletes files in the archive directory which the manifest no longer lists,
+        left behind when a removal failed or compression was interrupted.
+        :return: None
+        """
+        if not os.path.isdir(self.archiveDir):
+            return
+        # List under the lock, so a segment being added is either in both or in neither
+        with self.lock:
+            keep = set(segment['file'] for segment in self.segments)
+            keep.add(os.path.basename(self.manifestPath))
+            orphans = [fileName for fileName in os.listdir(self.archiveDir) if fileName not in keep]
+        for fileName in orphans:
+            self._removeSegmentFile(fileName)
+
+    def compact(self, now=None):
+        """
+        Drops every segment whose newest entry has passed the retention period.
+        :param now: Time to measure retention from, defaulting to the current time
+        :type now: datetime
+        :return: File names of the segments dropped
+        :rtype: list
+        """
+        self.sweepOrphans()
+        if self.retention is None:
+            return []
+        cutoff = formatLogTime((now or datetime.now()) - self.retention)
+        with self.lock:
+            expired = [segment for segment in self.segments if segment['last'] < cutoff]
+            if not expired:
+                return []
+            self.segments = [segment for segment in self.segments if segment['last'] >= cutoff]
+            self._saveManifest()
+
+        # The manifest no longer lists them, so removing the files can happen unlocked
+        for segment in expired:
+            self._removeSegmentFile(segment['file'])
+        return [segment['file'] for segment in expired]
+
+    def clear(self):
+        """
+        Drops every segment.
+        :return: None
+        """
+        with self.lock:
+            segments = self.segments
+            self.segments = []
+            if os.path.isdir(self.archiveDir):
+                self._saveManifest()
+        for segment in segments:
+            self._removeSegmentFile(segment['file'])
 
 class NeptuneLogEntry(object):
     """
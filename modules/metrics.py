@@ -0,0 +1,259 @@
+#-------------------------------------------------------------------------------
+# Name:        metrics.py
+# Purpose:     Module for Neptune Pool and Spa Automation containing the counters
+#              and histograms kept on how the service is performing, and their
+#              rendering in the Prometheus text format for /metrics.
+#
+# Author:      alji
+#
+# Created:     18/10/2026
+# Copyright:   (c) alji 2026
+# Licence:     <your licence>
+#-------------------------------------------------------------------------------
+import time
+import bisect
+import functools
+from collections import OrderedDict
+
+# Upper bounds of the latency buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Crown operations and log writes mostly take well under a millisecond
+FAST_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.1)
+
+# Every metric exposed, as name: (type, help, buckets for histograms)
+HTTP_REQUESTS = 'neptune_http_requests_total'
+HTTP_ERRORS = 'neptune_http_errors_total'
+HTTP_SECONDS = 'neptune_http_request_seconds'
+CROWN_OPERATIONS = 'neptune_crown_operations_total'
+CROWN_SECONDS = 'neptune_crown_operation_seconds'
+SERIAL_BYTES = 'neptune_serial_bytes_total'
+SERIAL_READINGS = 'neptune_serial_readings_total'
+SERIAL_BAD_LINES = 'neptune_serial_bad_lines_total'
+SERIAL_COMMANDS = 'neptune_serial_commands_total'
+SERIAL_QUEUE_DEPTH = 'neptune_serial_queue_depth'
+SERIAL_ACK_SECONDS = 'neptune_serial_ack_seconds'
+LOG_FLUSHES = 'neptune_log_flushes_total'
+LOG_ENTRIES_FLUSHED = 'neptune_log_entries_flushed_total'
+LOG_WRITE_SECONDS = 'neptune_log_write_seconds'
+LOG_ENTRIES = 'neptune_log_entries'
+LOG_ARCHIVED_ENTRIES = 'neptune_log_archived_entries'
+LOG_FILE_BYTES = 'neptune_log_file_bytes'
+DISK_WRITER_DEPTH = 'neptune_disk_writer_queue_depth'
+REACTOR_LAG_SECONDS = 'neptune_reactor_lag_seconds'
+REACTOR_OVERLOADED = 'neptune_reactor_overloaded'
+REACTOR_OVERLOADS = 'neptune_reactor_overloads_total'
+SERIAL_READINGS_SHED = 'neptune_serial_readings_shed_total'
+STREAM_SUBSCRIBERS = 'neptune_stream_subscribers'
+STREAM_DROPPED = 'neptune_stream_dropped_total'
+CATALOG = OrderedDict((
+    (HTTP_REQUESTS, ('counter', "HTTP requests answered, by endpoint.", None)),
+    (HTTP_ERRORS, ('counter', "HTTP requests answered with a \"0:\" failure, or not at all.", None)),
+    (HTTP_SECONDS, ('histogram', "Time to answer an HTTP request, by endpoint.", LATENCY_BUCKETS)),
+    (CROWN_OPERATIONS, ('counter', "Crown operations, by operation and result.", None)),
+    (CROWN_SECONDS, ('histogram', "Time taken by crown operations.", FAST_BUCKETS)),
+    (SERIAL_BYTES, ('counter', "Bytes over each serial link, by direction.", None)),
+    (SERIAL_READINGS, ('counter', "Readings and acks taken in from each serial link.", None)),
+    (SERIAL_BAD_LINES, ('counter', "Serial lines or readings which could not be parsed.", None)),
+    (SERIAL_COMMANDS, ('counter', "Outgoing serial commands, by what became of them.", None)),
+    (SERIAL_QUEUE_DEPTH, ('gauge', "Commands waiting for each serial link, by lane.", None)),
+    (SERIAL_ACK_SECONDS, ('histogram', "Time from first sending a command to its ack, by device.",
+                          LATENCY_BUCKETS)),
+    (LOG_FLUSHES, ('counter', "Groups of log entries written out.", None)),
+    (LOG_ENTRIES_FLUSHED, ('counter', "Log entries written out.", None)),
+    (LOG_WRITE_SECONDS, ('histogram', "Time to append a group of entries to the log file.",
+                         FAST_BUCKETS)),
+    (LOG_ENTRIES, ('gauge', "Log entries held in memory.", None)),
+    (LOG_ARCHIVED_ENTRIES, ('gauge', "Log entries in archived segments.", None)),
+    (LOG_FILE_BYTES, ('gauge', "Size of the active log file.", None)),
+    (DISK_WRITER_DEPTH, ('gauge', "Writes waiting for the disk writer thread.", None)),
+    (REACTOR_LAG_SECONDS, ('histogram', "How late the reactor ran each lag probe.", LATENCY_BUCKETS)),
+    (REACTOR_OVERLOADED, ('gauge', "Whether the reactor is overloaded and the service easing off.",
+                          None)),
+    (REACTOR_OVERLOADS, ('counter', "Times the reactor has become overloaded.", None)),
+    (SERIAL_READINGS_SHED, ('counter', "Sensor readings superseded by a newer one while easing off.",
+                            None)),
+    (STREAM_SUBSCRIBERS, ('gauge', "Clients holding an event stream open on /stream.", None)),
+    (STREAM_DROPPED, ('counter', "Event streams closed for falling too far behind.", None)),
+))
+
+class Histogram(object):
+    """
+    This object counts observations into fixed buckets, so that any number of them cost
+    the same handful of integers.
+
+    Attributes:
+        buckets (tuple): Upper bound of each bucket, ascending; a last, unbounded bucket
+        catches anything larger.
+        counts (list): Observations in each bucket, one more than there are bounds.
+        count (int): Observations made.
+        sum (float): Total of the observations.
+    """
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        """
+        :param buckets: Upper bound of each bucket, ascending
+        :type buckets: tuple
+        :return: None
+        """
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        """
+        Counts one observation.
+        :type value: float
+        :return: None
+        """
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """
+        Estimates a quantile as the upper bound of the bucket it falls in.
+        :param q: Quantile, e.g. 0.95
+        :type q: float
+        :return: Upper bound, None if there are no observations, or infinity if the
+        quantile falls in the unbounded bucket
+        :rtype: float
+        """
+        if not self.count:
+            return None
+        needed = q * self.count
+        seen = 0
+        for (i, count) in enumerate(self.counts):
+            seen += count
+            if seen >= needed and count:
+                if i < len(self.buckets):
+                    return self.buckets[i]
+                break
+        return float('inf')
+
+def _labelText(labels):
+    """
+    Internal function formatting labels as {name="value",...}, escaped as Prometheus expects.
+    :type labels: tuple
+    :rtype: str
+    """
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"')
+                                           .replace('\n', '\\n'))
+                             for (name, value) in labels)
+
+def _number(value):
+    """
+    Internal function formatting a sample value.
+    :rtype: str
+    """
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+class MetricsRegistry(object):
+    """
+    This object holds the counters and histograms the service updates as it works, for
+    every metric in CATALOG, and renders them along with gauges sampled at scrape time.
+    Labels are given as keyword arguments, e.g. inc(HTTP_REQUESTS, endpoint='/switch').
+    """
+    def __init__(self, catalog=CATALOG):
+        self.catalog = catalog
+        # By metric name, then by sorted (label, value) pairs
+        self.samples = dict((name, {}) for name in catalog)
+
+    def inc(self, name, amount=1, **labels):
+        """
+        Adds to a counter.
+        :param name: Metric name, from CATALOG
+        :type name: str
+        :param amount: Amount to add
+        :type amount: int
+        :return: None
+        """
+        key = tuple(sorted(labels.items()))
+        samples = self.samples[name]
+        samples[key] = samples.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        """
+        Sets a gauge.
+        :param name: Metric name, from CATALOG
+        :type name: str
+        :param value: The gauge's value
+        :type value: float
+        :return: None
+        """
+        self.samples[name][tuple(sorted(labels.items()))] = value
+
+    def observe(self, name, value, **labels):
+        """
+        Adds an observation to a histogram.
+        :param name: Metric name, from CATALOG
+        :type name: str
+        :param value: The observation, in seconds for timings
+        :type value: float
+        :return: None
+        """
+        key = tuple(sorted(labels.items()))
+        samples = self.samples[name]
+        histogram = samples.get(key)
+        if histogram is None:
+            histogram = samples[key] = Histogram(self.catalog[name][2])
+        histogram.observe(value)
+
+    def timed(self, name, func, **labels):
+        """
+        Wraps func so that every call is observed in a histogram.
+        :param name: Metric name, from CATALOG
+        :type name: str
+        :param func: The function to time
+        :type func: callable
+        :return: The wrapped function
+        :rtype: callable
+        """
+        @functools.wraps(func)
+        def timedCall(*args, **kwargs):
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.observe(name, time.time() - start, **labels)
+        return timedCall
+
+    def render(self, sampled=()):
+        """
+        Renders every metric in the Prometheus text format.
+        :param sampled: Further samples taken at scrape time, as (name, labels, value) with
+        labels a dict and value a number or, for histograms, a Histogram
+        :type sampled: list
+        :return: The exposition
+        :rtype: str
+        """
+        extra = dict((name, []) for name in self.catalog)
+        for (name, labels, value) in sampled:
+            extra[name].append((tuple(sorted(labels.items())), value))
+        lines = []
+        for (name, (kind, text, buckets)) in self.catalog.items():
+            samples = sorted(self.samples[name].items()) + extra[name]
+            if not samples:
+                continue
+            lines.append("# HELP %s %s" % (name, text))
+            lines.append("# TYPE %s %s" % (name, kind))
+            for (labels, value) in samples:
+                if kind != 'histogram':
+                    lines.append("%s%s %s" % (name, _labelText(labels), _number(value)))
+                    continue
+                cumulative = 0
+                for (bound, count) in zip(value.buckets + (float('inf'),), value.counts):
+                    cumulative += count
+                    lines.append("%s_bucket%s %s" % (name, _labelText(labels + (('le', _number(bound)),)),
+                                                     cumulative))
+                lines.append("%s_sum%s %s" % (name, _labelText(labels), _number(value.sum)))
+                lines.append("%s_count%s %s" % (name, _labelText(labels), value.count))
+        return "\n".join(lines) + "\n"
+
+# The registry shared by the whole service
+REGISTRY = MetricsRegistry()
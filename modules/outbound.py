@@ -0,0 +1,451 @@
+#-------------------------------------------------------------------------------
+# Name:        outbound.py
+# Purpose:     Module for Neptune Pool and Spa Automation containing the queue
+#              of commands waiting to go out over the serial link to the Arduino.
+#
+# Author:      alji
+#
+# Created:     18/10/2026
+# Copyright:   (c) alji 2026
+# Licence:     <your licence>
+#-------------------------------------------------------------------------------
+import re
+import time
+from collections import OrderedDict
+
+from modules.neptune.metrics import Histogram
+from modules.neptune.tracing import TRACER
+
+# Bits on the wire for every byte at 8N1: a start bit, eight data bits and a stop bit
+BITS_PER_BYTE = 10
+
+# Device commands built by the crown look like >IDtypeValue, e.g. >2002s1
+COMMAND_PATTERN = re.compile(r'^>(\d{4})')
+
+# Lanes, most urgent first
+CRITICAL = 0
+NORMAL = 1
+BULK = 2
+LANE_NAMES = ('critical', 'normal', 'bulk')
+# Commands which make the pool and spa safe: heaters off, fill valve closed
+CRITICAL_COMMANDS = ('>2005s0', '>2006s0', '>1102s0')
+# A lane with commands waiting is served once it has been passed over this many times
+MAX_SKIPS = 8
+
+# With acks, commands sent but not yet acknowledged before no more are sent
+ACK_WINDOW = 4
+# Places in flight kept over the window for critical commands; one per critical command
+CRITICAL_RESERVE = len(CRITICAL_COMMANDS)
+# Seconds to wait for an ack before sending a command again
+ACK_TIMEOUT = 1.0
+# Times a command is sent again before it is given up on
+MAX_RETRIES = 2
+# Sequence numbers run from 1 to SEQUENCE_LIMIT and start again; they follow
+# SEQUENCE_MARK, e.g. >2002s1#17, and the Arduino answers 2002a17
+SEQUENCE_LIMIT = 9999
+SEQUENCE_MARK = '#'
+
+def commandDevice(command):
+    """
+    Finds the device a serial command is addressed to.
+    :param command: Serial command
+    :type command: str
+    :return: Device ID, or None if the command is not addressed to a device
+    :rtype: str
+    """
+    match = COMMAND_PATTERN.match(command)
+    if match is None:
+        return None
+    return match.group(1)
+
+def classify(command):
+    """
+    Picks the lane for a serial command: CRITICAL_COMMANDS are critical, other device
+    commands normal, and anything not addressed to a device (e.g. a link probe) bulk.
+    :param command: Serial command
+    :type command: str
+    :return: CRITICAL, NORMAL or BULK
+    :rtype: int
+    """
+    if command in CRITICAL_COMMANDS:
+        return CRITICAL
+    if commandDevice(command) is None:
+        return BULK
+    return NORMAL
+
+class InFlight(object):
+    """
+    This object follows one device command from when it is first sent until it is
+    acknowledged or given up on.
+
+    Attributes:
+        devId (str): Device the command is addressed to.
+        command (str): The command, without its sequence number.
+        lane (int): Lane the command was queued in.
+        firstSent (float): When the command was first sent, in seconds.
+        attempts (int): Times the command has been sent.
+        seq (int): Sequence number of the latest attempt.
+        traceId (str): Trace the command belongs to, if it was traced.
+    """
+    def __init__(self, devId, command, lane, firstSent, traceId=None):
+        self.devId = devId
+        self.command = command
+        self.lane = lane
+        self.firstSent = firstSent
+        self.attempts = 0
+        self.seq = None
+        self.timer = None
+        self.traceId = traceId
+
+class OutboundQueue(object):
+    """
+    This object holds serial commands until the link can take them. Only the latest
+    pending command for each device is kept: a newer command replaces the one waiting,
+    in its place in line, so a device being spammed (a dashboard slider, say) costs the
+    link one command however many arrive, and never pushes other devices back. Commands
+    not addressed to a device, e.g. the "I like you." probe, coalesce only with an
+    identical command still waiting, so repeating one never grows the queue.
+
+    Commands wait in one of three lanes (see classify). The critical lane is always
+    served first; between the normal and bulk lanes, normal goes first, but a lane passed
+    over MAX_SKIPS times is served next, so bulk traffic is slowed, never starved. Since
+    each device holds at most one place in line, a critical command waits at most for the
+    command already on the wire and one command for each other critical device.
+
+    Given a scheduler, commands are released no faster than the link carries them;
+    without one, each is transmitted as soon as it is queued.
+
+    Given an ack window, device commands are sent with a sequence number and must be
+    acknowledged (see ack): at most window of them are outstanding at once, so commands
+    are pipelined rather than sent one at a time. Critical commands may also take one of
+    CRITICAL_RESERVE places kept over the window, so a safety command does not wait on
+    acks for other commands, while the link never has more than window + CRITICAL_RESERVE
+    outstanding. A command not acknowledged within ackTimeout is sent again, up to
+    maxRetries times, unless a newer command for the same device is already waiting.
+    Commands not addressed to a device are never acknowledged, and are sent without a
+    sequence number.
+
+    Commands queued together with putMany are a batch: once the first of them is due, the
+    rest still waiting go out with it, in one transmission, as far as the ack window allows.
+
+    Attributes:
+        depth (int): Commands waiting to be transmitted.
+        laneDepths (list): Commands waiting in each lane, most urgent first.
+        sent (int): Commands transmitted, retries included.
+        coalesced (int): Commands replaced by a newer one for the same device, or by the
+        same unaddressed command.
+        inFlight (OrderedDict): InFlight commands awaiting an ack, by sequence number.
+        latency (dict): Histogram of seconds from first send to ack, by device ID.
+        acked, retried, failed, superseded, strayAcks (int): Commands acknowledged, sent
+        again, given up on, and dropped for a newer command; and acks matching nothing.
+    """
+    def __init__(self, transmit, callLater=None, baudrate=9600, overhead=0, maxSkips=MAX_SKIPS,
+                 window=None, ackTimeout=ACK_TIMEOUT, maxRetries=MAX_RETRIES, seconds=time.time,
+                 onAck=None, onFailure=None):
+        """
+        :param transmit: Called with each command when it is time to send it, or with every
+        command of a batch sent together
+        :type transmit: callable
+        :param callLater: Scheduler, e.g. reactor.callLater, used to pace the link
+        :type callLater: callable
+        :param baudrate: Speed of the link, in bits per second
+        :type baudrate: int
+        :param overhead: Bytes sent along with every command, e.g. its line ending
+        :type overhead: int
+        :param maxSkips: Times a waiting lane may be passed over before it is served
+        :type maxSkips: int
+        :param window: Commands which may await an ack at once, or None to send without acks
+        :type window: int
+        :param ackTimeout: Seconds to wait for an ack before sending a command again
+        :type ackTimeout: float
+        :param maxRetries: Times a command is sent again before it is given up on
+        :type maxRetries: int
+        :param seconds: Clock, in seconds, for measuring latency
+        :type seconds: callable
+        :param onAck: Called with the InFlight command and its latency when acknowledged
+        :type onAck: callable
+        :param onFailure: Called with the InFlight command when it is given up on
+        :type onFailure: callable
+        :return: None
+        """
+        if window is not None and callLater is None:
+            raise ValueError("Acks need a scheduler to time out unacknowledged commands")
+        self.transmit = transmit
+        self.callLater = callLater
+        self.baudrate = baudrate
+        self.overhead = overhead
+        self.maxSkips = maxSkips
+        self.lanes = [OrderedDict() for name in LANE_NAMES]
+        self.skips = [0 for name in LANE_NAMES]
+        # Lane holding each waiting command, by key
+        self._laneOf = {}
+        self.sent = 0
+        self.coalesced = 0
+        self._linkBusy = None
+
+        self.window = window
+        self.ackTimeout = ackTimeout
+        self.maxRetries = maxRetries
+        self.seconds = seconds
+        self.onAck = onAck
+        self.onFailure = onFailure
+        self.inFlight = OrderedDict()
+        # Commands timed out and queued again, by device ID, so retries keep their history
+        self._retrying = {}
+        # (trace ID, when queued) for each waiting command queued during a trace
+        self._traceOf = {}
+        # For each waiting command queued in a batch, the keys of the whole batch
+        self._batchOf = {}
+        self._seq = 0
+        self.latency = {}
+        self.acked = 0
+        self.retried = 0
+        self.failed = 0
+        self.superseded = 0
+        self.strayAcks = 0
+
+    @property
+    def depth(self):
+        """Commands waiting to be transmitted"""
+        return len(self._laneOf)
+
+    @property
+    def laneDepths(self):
+        """Commands waiting in each lane, most urgent first"""
+        return [len(lane) for lane in self.lanes]
+
+    def put(self, command, lane=None):
+        """
+        Queues a command, replacing any still waiting for the same device.
+        :param command: Serial command
+        :type command: str
+        :param lane: CRITICAL, NORMAL or BULK; chosen by classify if not given
+        :type lane: int
+        :return: None
+        """
+        self._enqueue(command, lane)
+        self._drain()
+
+    def putMany(self, commands, lane=None):
+        """
+        Queues commands as a batch, to be transmitted together; each replaces any command
+        still waiting for the same device, as with put.
+        :param commands: Serial commands
+        :type commands: list
+        :param lane: CRITICAL, NORMAL or BULK; chosen for each command by classify if not given
+        :type lane: int
+        :return: None
+        """
+        keys = [self._enqueue(command, lane) for command in commands]
+        for key in keys:
+            self._batchOf[key] = keys
+        self._drain()
+
+    def _enqueue(self, command, lane):
+        """
+        Internal method which queues a command without transmitting anything.
+        :return: The command's key
+        """
+        if lane is None:
+            lane = classify(command)
+        key = commandDevice(command)
+        if key is None:
+            # Commands for no device are keyed by their text, so only a repeat replaces one
+            key = ('unaddressed', command)
+        if key in self._laneOf:
+            self.coalesced += 1
+            if key in self._traceOf:
+                (traceId, queuedAt) = self._traceOf.pop(key)
+                TRACER.record(traceId, 'serial.coalesced', queuedAt, TRACER.seconds() - queuedAt,
+                              command=self.lanes[self._laneOf[key]][key])
+            if self._laneOf[key] != lane:
+                # The newer command decides the lane; it loses the older one's place
+                del self.lanes[self._laneOf[key]][key]
+        # Updating an OrderedDict key keeps its position, so the device keeps its place
+        self.lanes[lane][key] = command
+        self._laneOf[key] = lane
+        if TRACER.current is not None:
+            self._traceOf[key] = (TRACER.current, TRACER.seconds())
+        return key
+
+    def _nextLane(self):
+        """
+        Internal method which picks the lane to serve next, and keeps count of the lanes
+        passed over.
+        :return: Lane index, or None if nothing is waiting
+        :rtype: int
+        """
+        waiting = [lane for lane in range(len(self.lanes)) if self.lanes[lane]]
+        if not waiting:
+            return None
+        chosen = waiting[0]
+        if chosen != CRITICAL:
+            for lane in waiting:
+                if self.skips[lane] >= self.maxSkips:
+                    chosen = lane
+                    break
+        for lane in waiting:
+            if lane == chosen:
+                self.skips[lane] = 0
+            else:
+                self.skips[lane] += 1
+        return chosen
+
+    def transmitTime(self, command):
+        """
+        Seconds the link is busy carrying a command.
+        :param command: Serial command
+        :type command: str
+        :rtype: float
+        """
+        return (len(command) + self.overhead) * BITS_PER_BYTE / float(self.baudrate)
+
+    def _drain(self):
+        """
+        Internal method which transmits the next command if the link is free.
+        :return: None
+        """
+        while self._linkBusy is None and self._laneOf:
+            if self._windowOpen():
+                lane = self._nextLane()
+            elif self.lanes[CRITICAL] and self._windowOpen(CRITICAL):
+                lane = CRITICAL
+            else:
+                break
+            (key, command) = self.lanes[lane].popitem(last=False)
+            batch = self._batchOf.get(key, ())
+            released = [self._release(key, command, lane)]
+            # The rest of its batch still waiting goes out in the same transmission
+            for other in batch:
+                if other in self._laneOf and self._windowOpen(self._laneOf[other]):
+                    otherLane = self._laneOf[other]
+                    released.append(self._release(other, self.lanes[otherLane].pop(other), otherLane))
+            # Each released entry is (command, lane, trace ID, when queued)
+            commands = [entry[0] for entry in released]
+            # Mark the link busy first, in case transmitting leads to another put
+            if self.callLater is not None:
+                self._linkBusy = self.callLater(sum(self.transmitTime(sent) for sent in commands),
+                                                self._linkFree)
+            self.sent += len(commands)
+            traced = [entry for entry in released if entry[2] is not None]
+            if not traced:
+                self.transmit(*commands)
+                continue
+            start = TRACER.seconds()
+            for (command, lane, traceId, queuedAt) in traced:
+                TRACER.record(traceId, 'serial.queued', queuedAt, start - queuedAt, lane=LANE_NAMES[lane])
+            self.transmit(*commands)
+            done = TRACER.seconds()
+            for (command, lane, traceId, queuedAt) in traced:
+                TRACER.record(traceId, 'serial.transmit', start, done - start, command=command,
+                              wireMs=round(self.transmitTime(command) * 1000.0, 3))
+
+    def _release(self, key, command, lane):
+        """
+        Internal method which takes a command about to be transmitted off the queue, and
+        numbers it if it must be acknowledged.
+        :return: (command as sent, lane, trace ID, when queued)
+        :rtype: tuple
+        """
+        del self._laneOf[key]
+        self._batchOf.pop(key, None)
+        (traceId, queuedAt) = self._traceOf.pop(key, (None, None))
+        if self.window is not None and not isinstance(key, tuple):
+            command = self._track(key, command, lane, traceId)
+        return (command, lane, traceId, queuedAt)
+
+    def _linkFree(self):
+        """
+        Internal method called once the link has carried the last command.
+        :return: None
+        """
+        self._linkBusy = None
+        self._drain()
+
+    def _windowOpen(self, lane=None):
+        """
+        Internal method telling whether another command may be sent before acks come back;
+        one in the critical lane may also take a place kept in reserve.
+        :param lane: Lane of the command, if known
+        :type lane: int
+        :rtype: bool
+        """
+        if self.window is None:
+            return True
+        if lane == CRITICAL:
+            return len(self.inFlight) < self.window + CRITICAL_RESERVE
+        return len(self.inFlight) < self.window
+
+    def _track(self, devId, command, lane, traceId=None):
+        """
+        Internal method which numbers a device command about to be sent, and starts
+        waiting for its ack.
+        :return: The command with its sequence number
+        :rtype: str
+        """
+        record = self._retrying.pop(devId, None)
+        if record is None or record.command != command:
+            record = InFlight(devId, command, lane, self.seconds(), traceId)
+        record.attempts += 1
+        self._seq = self._seq % SEQUENCE_LIMIT + 1
+        record.seq = self._seq
+        self.inFlight[record.seq] = record
+        record.timer = self.callLater(self.ackTimeout, self._ackTimedOut, record.seq)
+        return "%s%s%d" % (command, SEQUENCE_MARK, record.seq)
+
+    def ack(self, devId, seq):
+        """
+        Matches an ack from the Arduino to the command it acknowledges.
+        :param devId: Device ID the ack came from
+        :type devId: str
+        :param seq: Sequence number acknowledged
+        :type seq: str or int
+        :return: Seconds from the command's first send to its ack, or None if the ack
+        matches no command awaiting one
+        :rtype: float
+        """
+        record = self.inFlight.get(int(seq))
+        if record is None or record.devId != devId:
+            self.strayAcks += 1
+            return None
+        del self.inFlight[record.seq]
+        if record.timer.active():
+            record.timer.cancel()
+        latency = self.seconds() - record.firstSent
+        if devId not in self.latency:
+            self.latency[devId] = Histogram()
+        self.latency[devId].observe(latency)
+        self.acked += 1
+        if record.traceId is not None:
+            TRACER.record(record.traceId, 'serial.ack', TRACER.seconds() - latency, latency,
+                          attempts=record.attempts)
+        if self.onAck is not None:
+            self.onAck(record, latency)
+        self._drain()
+        return latency
+
+    def _ackTimedOut(self, seq):
+        """
+        Internal method called when a command's ack has not come back in time.
+        :return: None
+        """
+        record = self.inFlight.pop(seq, None)
+        if record is None:
+            return
+        if record.devId in self._laneOf:
+            # A newer command for the device is already waiting; it replaces this one
+            self.superseded += 1
+            if record.traceId is not None:
+                TRACER.record(record.traceId, 'serial.superseded', TRACER.seconds(), 0.0)
+        elif record.attempts > self.maxRetries:
+            self.failed += 1
+            if record.traceId is not None:
+                TRACER.record(record.traceId, 'serial.failed', TRACER.seconds(), 0.0,
+                              attempts=record.attempts)
+            if self.onFailure is not None:
+                self.onFailure(record)
+        else:
+            self.retried += 1
+            self._retrying[record.devId] = record
+            self.put(record.command, record.lane)
+        self._drain()
@@ -0,0 +1,174 @@
+#-------------------------------------------------------------------------------
+# Name:        profiling.py
+# Purpose:     Module for Neptune Pool and Spa Automation containing the profiler
+#              which can be switched on in the running service to profile the next
+#              few HTTP requests or serial lines.
+#
+# Author:      alji
+#
+# Created:     18/10/2026
+# Copyright:   (c) alji 2026
+# Licence:     <your licence>
+#-------------------------------------------------------------------------------
+import os
+import re
+import pstats
+import cProfile
+from datetime import datetime
+from collections import OrderedDict
+
+from modules.neptune.writer import InlineWriter
+
+# Environment variable profiling a round from start-up, as "<count>[:<target>]", e.g. "50:http"
+PROFILE_VARIABLE = 'NEPTUNE_PROFILE'
+# What may be profiled: HTTP requests, serial lines (and frames), or both
+TARGETS = ('http', 'serial', 'all')
+# Calls profiled in a round when no count is given
+PROFILE_COUNT = 50
+# Functions listed in each text summary
+SUMMARY_LINES = 40
+
+def parseRound(text):
+    """
+    Reads a round of profiling as given in PROFILE_VARIABLE.
+    :param text: "<count>[:<target>]", e.g. "50:http"
+    :type text: str
+    :return: (count, target)
+    :rtype: tuple
+    """
+    (count, target) = (text.split(':', 1) + ['all'])[:2]
+    if not count.isdigit():
+        raise ValueError("Profile count %r is not a number" % count)
+    return (int(count), target)
+
+def writeStats(basePath, stats, calls):
+    """
+    Writes profile stats twice: as a .prof file, for pstats or a viewer, and as a .txt
+    summary of the functions taking the most time.
+    :param basePath: Path of the files, without extension
+    :type basePath: str
+    :param stats: The stats
+    :type stats: pstats.Stats
+    :param calls: Calls the stats were gathered over
+    :type calls: int
+    :return: None
+    """
+    stats.dump_stats(basePath + '.prof')
+    with open(basePath + '.txt', 'w') as summaryFile:
+        summaryFile.write("%s calls profiled\n" % calls)
+        stats.stream = summaryFile
+        stats.sort_stats('cumulative').print_stats(SUMMARY_LINES)
+
+class Profiler(object):
+    """
+    This object profiles a round of the next count HTTP requests, serial lines, or both,
+    with cProfile, and then writes the stats out, gathered together by tag (the endpoint
+    of each request, the port of each line), to ~/.neptuneProfiles. Nothing is profiled
+    between rounds, so it costs nothing until it is armed; it can be armed in the running
+    service, e.g. from the /profile endpoint.
+
+    Only the work done on the reactor thread is profiled; a request which hands work to
+    another thread is profiled up to the handover.
+
+    Attributes:
+        target (str): What the round profiles, one of TARGETS.
+        remaining (int): Calls still to profile in this round.
+        session (str): When the round started, naming its files.
+        stats (OrderedDict): pstats.Stats gathered so far, by (kind, tag).
+        calls (dict): Calls profiled so far, by (kind, tag).
+        written (list): Files written for the last round, without extension.
+    """
+    def __init__(self, writer=None):
+        """
+        :param writer: Writer performing file writes; by default they happen immediately
+        :type writer: DiskWriter or InlineWriter
+        :return: None
+        """
+        if writer is None:
+            writer = InlineWriter()
+        self.writer = writer
+        self.target = None
+        self.remaining = 0
+        self.session = None
+        self.stats = OrderedDict()
+        self.calls = {}
+        self.written = []
+        self._active = False
+
+    def arm(self, count=PROFILE_COUNT, target='all'):
+        """
+        Starts a round of profiling.
+        :param count: Calls to profile
+        :type count: int
+        :param target: One of TARGETS
+        :type target: str
+        :return: None
+        """
+        if target not in TARGETS:
+            raise ValueError("Cannot profile %r, choose from %s" % (target, ', '.join(TARGETS)))
+        if count < 1:
+            raise ValueError("Cannot profile %s calls" % count)
+        if self.remaining:
+            raise ValueError("Already profiling, %s %s calls to go" % (self.remaining, self.target))
+        self.target = target
+        self.remaining = count
+        self.session = datetime.now().strftime('%Y%m%d-%H%M%S')
+        self.stats = OrderedDict()
+        self.calls = {}
+
+    def call(self, kind, tag, func, *args, **kwargs):
+        """
+        Calls func(*args, **kwargs), profiling it if a round wants calls of this kind.
+        :param kind: "http" or "serial"
+        :type kind: str
+        :param tag: What the stats are gathered by, e.g. the endpoint
+        :type tag: str
+        :param func: The call
+        :type func: callable
+        :return: What func returns
+        """
+        if not self.remaining or self._active or self.target not in (kind, 'all'):
+            return func(*args, **kwargs)
+        profile = cProfile.Profile()
+        self._active = True
+        try:
+            return profile.runcall(func, *args, **kwargs)
+        finally:
+            self._active = False
+            key = (kind, tag)
+            if key in self.stats:
+                self.stats[key].add(profile)
+            else:
+                self.stats[key] = pstats.Stats(profile)
+            self.calls[key] = self.calls.get(key, 0) + 1
+            self.remaining -= 1
+            if not self.remaining:
+                self.finish()
+
+    def finish(self):
+        """
+        Ends the round, early if calls remain, and writes out the stats gathered.
+        :return: Files written, without extension
+        :rtype: list
+        """
+        # This software can be run on multiple platforms, each with its own env
+        #  variable for the home dir. The following ensures compatibility.
+        if os.environ.has_key('HOMEPATH'):
+            homeDir = os.environ['HOMEPATH']
+        else:
+            homeDir = os.environ['HOME']
+        outputDir = "%s/.neptuneProfiles" % homeDir
+        if self.stats and not os.path.isdir(outputDir):
+            os.makedirs(outputDir)
+        self.written = []
+        for ((kind, tag), stats) in self.stats.items():
+            basePath = "%s/%s-%s-%s" % (outputDir, self.session, kind, re.sub(r'\W+', '', tag) or 'root')
+            self.writer.submit(writeStats, basePath, stats, self.calls[(kind, tag)])
+            self.written.append(basePath)
+        self.remaining = 0
+        self.stats = OrderedDict()
+        self.calls = {}
+        return self.written
+
+# The profiler shared by the whole service
+PROFILER = Profiler()
@@ -0,0 +1,119 @@
+#-------------------------------------------------------------------------------
+# Name:        routing.py
+# Purpose:     Module for Neptune Pool and Spa Automation containing the router
+#              which spreads outgoing serial commands across several Arduino links
+#              by device ID.
+#
+# Author:      alji
+#
+# Created:     18/10/2026
+# Copyright:   (c) alji 2026
+# Licence:     <your licence>
+#-------------------------------------------------------------------------------
+from collections import OrderedDict
+
+from modules.neptune.outbound import commandDevice
+
+class SerialRouter(object):
+    """
+    This object stands in for a single serial link wherever one is expected: it offers the
+    same serialWrite and serialWriteMany, and hands each command to the link serving the
+    device it is addressed to. Links serve ranges of device IDs, following the ID plan in
+    DefaultDeviceMapper, e.g. physical devices (1100-1199) on one Arduino and radio devices
+    (2000-2999) on another. Commands addressed to no device, such as the link probe, go to
+    every link.
+
+    Each link keeps its own outbound queue and pace, so together they carry as many
+    commands as there are links.
+    """
+    def __init__(self):
+        # (lowest ID, highest ID, link), one per link
+        self.routes = []
+
+    @property
+    def links(self):
+        """Every link, in the order added"""
+        return [link for (low, high, link) in self.routes]
+
+    @property
+    def queueDepth(self):
+        """Commands waiting across every link"""
+        return sum(link.queueDepth for link in self.links)
+
+    def addLink(self, link, low, high):
+        """
+        Adds a link serving device IDs low to high, inclusive.
+        :param link: Anything with serialWrite(data, lane), serialWriteMany(commands, lane) and
+        queueDepth, e.g. a SerialResource
+        :param low: Lowest device ID served
+        :type low: int
+        :param high: Highest device ID served
+        :type high: int
+        :return: None
+        """
+        for (otherLow, otherHigh, other) in self.routes:
+            if low <= otherHigh and otherLow <= high:
+                raise ValueError("Devices %s-%s overlap devices %s-%s on another link"
+                                 % (low, high, otherLow, otherHigh))
+        self.routes.append((int(low), int(high), link))
+
+    def linkFor(self, devId):
+        """
+        Finds the link serving a device.
+        :param devId: Device ID
+        :type devId: str or int
+        :return: The link, or None if no link serves the device
+        """
+        devId = int(devId)
+        for (low, high, link) in self.routes:
+            if low <= devId <= high:
+                return link
+        return None
+
+    def serialWrite(self, data, lane=None):
+        """
+        Queues a command on the link serving the device it is addressed to.
+        :param data: Requested data to be sent
+        :type data: str
+        :param lane: outbound.CRITICAL, NORMAL or BULK; chosen from the command if not given
+        :type lane: int
+        :return: Whether a link took the command
+        :rtype: bool
+        """
+        devId = commandDevice(data)
+        if devId is None:
+            results = [link.serialWrite(data, lane) for link in self.links]
+            return bool(results) and all(results)
+        link = self.linkFor(devId)
+        if link is None:
+            print("ERROR: No serial link serves device %s, dropping %s" % (devId, data))
+            return False
+        return link.serialWrite(data, lane)
+
+    def serialWriteMany(self, commands, lane=None):
+        """
+        Queues commands to be sent together, each link taking those for its own devices
+        in one transmission.
+        :param commands: Requested commands to be sent
+        :type commands: list
+        :param lane: outbound.CRITICAL, NORMAL or BULK; chosen from each command if not given
+        :type lane: int
+        :return: Whether links took every command
+        :rtype: bool
+        """
+        byLink = OrderedDict()
+        taken = True
+        for command in commands:
+            devId = commandDevice(command)
+            if devId is None:
+                taken = self.serialWrite(command, lane) and taken
+                continue
+            link = self.linkFor(devId)
+            if link is None:
+                print("ERROR: No serial link serves device %s, dropping %s" % (devId, command))
+                taken = False
+                continue
+            byLink.setdefault(link, []).append(command)
+        for (link, linkCommands) in byLink.items():
+            taken = link.serialWriteMany(linkCommands, lane) and taken
+        return taken
@@ -0,0 +1,233 @@
+#-------------------------------------------------------------------------------
+# Name:        simulator.py
+# Purpose:     Module for Neptune Pool and Spa Automation containing a stand-in for
+#              the Arduino, so that the serial side of the service can be exercised
+#              (and loaded) without hardware.
+#
+# Author:      alji
+#
+# Created:     18/10/2026
+# Copyright:   (c) alji 2026
+# Licence:     <your licence>
+#-------------------------------------------------------------------------------
+import re
+import random
+
+from twisted.protocols.basic import LineReceiver
+
+from modules.neptune.framing import encodeFrame, FRAMES_ON, FRAMES_OFF, FRAMES_ACCEPTED
+from modules.neptune.outbound import SEQUENCE_MARK
+
+# Sensors reported, with the range their readings wander in
+SENSORS = {'2007': (60, 104), '2008': (0, 100)}
+# The controller ends every command with this ahead of the line delimiter
+COMMAND_SUFFIX = "/r/n"
+# Commands look like >IDtypeValue, with a sequence number after SEQUENCE_MARK when acked
+COMMAND_PATTERN = re.compile(r'^>(\d{4})(\w)([^%s]*)(?:%s(\d+))?$' % (SEQUENCE_MARK, SEQUENCE_MARK))
+# Asks for sensors to be reported less often, e.g. ?S4; see lag.SENSOR_SLOWDOWN
+SLOWDOWN_PATTERN = re.compile(r'^\?S(\d+)$')
+# Lines sent in place of a reading when a malformed one is due
+MALFORMED_LINES = ("20", "2007", "2007x55", "2007nabc", "\x00\xff\xfe", "n2007 80")
+
+class ArduinoSimulator(LineReceiver):
+    """
+    This object behaves like the Arduino at the far end of the serial link: it reports each
+    sensor in SENSORS about rate times a second, give or take jitter, carries out device
+    commands and acknowledges the numbered ones, agrees to binary frames when asked, and
+    reports less often when asked to slow down.
+
+    To test the controller's defences it can also send a malformed line in place of one
+    reading in every malformedEvery, and stall the link, holding back everything it has to
+    say for stallSeconds, every stallEvery seconds.
+
+    Attributes:
+        state (dict): Latest value commanded for each device ID.
+        slowdown (int): Times less often than rate that sensors are being reported.
+        readings, malformed, commands, acked, stalls (int): Readings and malformed lines
+        sent, commands received and acknowledged, and stalls begun.
+    """
+    def __init__(self, callLater, rate=1.0, jitter=0.0, malformedEvery=0, stallEvery=0,
+                 stallSeconds=0, ackDelay=0.005, acks=True, framing=True, seed=None):
+        """
+        :param callLater: Scheduler, e.g. reactor.callLater
+        :type callLater: callable
+        :param rate: Readings per second from each sensor
+        :type rate: float
+        :param jitter: Largest change to the time between readings, as a fraction of it
+        :type jitter: float
+        :param malformedEvery: Send a malformed line in place of one reading in this many; 0 never
+        :type malformedEvery: int
+        :param stallEvery: Seconds between stalls of the link; 0 never
+        :type stallEvery: float
+        :param stallSeconds: Seconds each stall lasts
+        :type stallSeconds: float
+        :param ackDelay: Seconds taken to carry out a command before acknowledging it
+        :type ackDelay: float
+        :param acks: Whether to acknowledge numbered commands
+        :type acks: bool
+        :param framing: Whether to agree to binary frames when asked
+        :type framing: bool
+        :param seed: Seed for the readings, jitter and malformed lines, for repeatable runs
+        :return: None
+        """
+        self.callLater = callLater
+        self.rate = rate
+        self.jitter = jitter
+        self.malformedEvery = malformedEvery
+        self.stallEvery = stallEvery
+        self.stallSeconds = stallSeconds
+        self.ackDelay = ackDelay
+        self.ackCommands = acks
+        self.framing = framing
+        self.random = random.Random(seed)
+
+        self.state = {}
+        self.values = dict((devId, (low + high) // 2) for (devId, (low, high)) in SENSORS.items())
+        self.framed = False
+        self.slowdown = 1
+        self.stalled = False
+        self._held = []
+        self._timers = {}
+        self.readings = 0
+        self.malformed = 0
+        self.commands = 0
+        self.acked = 0
+        self.stalls = 0
+
+    def connectionMade(self):
+        """
+        Built-in method to LineReceiver; starts reporting as soon as the link is up.
+        :return: None
+        """
+        for devId in sorted(SENSORS):
+            self._scheduleReading(devId)
+        if self.stallEvery:
+            self._timers['stall'] = self.callLater(self.stallEvery, self._startStall)
+
+    def connectionLost(self, reason=None):
+        """
+        Built-in method to LineReceiver; stops everything scheduled.
+        :return: None
+        """
+        self.stop()
+
+    def stop(self):
+        """
+        Cancels every reading and stall still to come.
+        :return: None
+        """
+        for timer in self._timers.values():
+            if timer.active():
+                timer.cancel()
+        self._timers.clear()
+
+    def _scheduleReading(self, devId):
+        """
+        Internal method which schedules the next reading from a sensor.
+        :return: None
+        """
+        interval = float(self.slowdown) / self.rate
+        if self.jitter:
+            interval *= 1 + self.random.uniform(-self.jitter, self.jitter)
+        self._timers[devId] = self.callLater(interval, self._sendReading, devId)
+
+    def _sendReading(self, devId):
+        """
+        Internal method which reports a sensor, wandering its value a step up or down.
+        :return: None
+        """
+        (low, high) = SENSORS[devId]
+        value = min(high, max(low, self.values[devId] + self.random.choice((-1, 0, 1))))
+        self.values[devId] = value
+        self._scheduleReading(devId)
+        if self.malformedEvery and self.random.randrange(self.malformedEvery) == 0:
+            self.malformed += 1
+            self._emit(self.random.choice(MALFORMED_LINES))
+            return
+        self.readings += 1
+        self._emitReading(devId, 'n', value)
+
+    def _emitReading(self, devId, typeCode, value):
+        """
+        Internal method which sends one reading, as a text line or a frame.
+        :return: None
+        """
+        if self.framed:
+            self._emit(encodeFrame([(devId, typeCode, value)]), raw=True)
+        else:
+            self._emit("%s%s%s" % (devId, typeCode, value))
+
+    def _emit(self, data, raw=False):
+        """
+        Internal method which writes to the link, or holds the data back during a stall.
+        :param data: A line, without its delimiter, or raw bytes
+        :type data: str
+        :param raw: Whether data is raw bytes rather than a line
+        :type raw: bool
+        :return: None
+        """
+        if not raw:
+            data += self.delimiter
+        if self.stalled:
+            self._held.append(data)
+        else:
+            self.transport.write(data)
+
+    def _startStall(self):
+        """
+        Internal method which stalls the link.
+        :return: None
+        """
+        self.stalled = True
+        self.stalls += 1
+        self._timers['stall'] = self.callLater(self.stallSeconds, self._endStall)
+
+    def _endStall(self):
+        """
+        Internal method which ends a stall, releasing everything held back in one burst.
+        :return: None
+        """
+        self.stalled = False
+        held = ''.join(self._held)
+        self._held = []
+        if held:
+            self.transport.write(held)
+        self._timers['stall'] = self.callLater(self.stallEvery, self._startStall)
+
+    def lineReceived(self, line):
+        """
+        Built-in method to LineReceiver; carries out a command from the controller.
+        :param line: Incoming serial bytes
+        :return: None
+        """
+        if line.endswith(COMMAND_SUFFIX):
+            line = line[:-len(COMMAND_SUFFIX)]
+        if line == FRAMES_ON:
+            if self.framing:
+                self._emit(FRAMES_ACCEPTED)
+                self.framed = True
+            return
+        if line == FRAMES_OFF:
+            self.framed = False
+            return
+        slowdown = SLOWDOWN_PATTERN.match(line)
+        if slowdown is not None:
+            self.slowdown = max(1, int(slowdown.group(1)))
+            return
+        match = COMMAND_PATTERN.match(line)
+        if match is None:
+            # The link probe, or anything else, goes unanswered, as on the real board
+            return
+        (devId, typeCode, value, seq) = match.groups()
+        self.commands += 1
+        self.state[devId] = value
+        if seq is not None and self.ackCommands:
+            self.callLater(self.ackDelay, self._ack, devId, seq)
+
+    def _ack(self, devId, seq):
+        """
+        Internal method which acknowledges a numbered command.
+        :return: None
+        """
+        self.acked += 1
+        self._emitReading(devId, 'a', seq)
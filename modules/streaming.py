@@ -0,0 +1,271 @@
+#-------------------------------------------------------------------------------
+# Name:        streaming.py
+# Purpose:     Module for Neptune Pool and Spa Automation containing the change
+#              stream, which pushes device changes to web clients as the crown
+#              applies them, over Server-Sent Events or long polls.
+#
+# Author:      alji
+#
+# Created:     18/10/2026
+# Copyright:   (c) alji 2026
+# Licence:     <your licence>
+#-------------------------------------------------------------------------------
+import json
+
+from zope.interface import implementer
+from twisted.internet.interfaces import IPushProducer
+
+from modules.neptune.metrics import REGISTRY, STREAM_SUBSCRIBERS, STREAM_DROPPED
+
+# Seconds between the comments sent to keep idle event streams open through proxies
+HEARTBEAT_INTERVAL = 15.0
+# Longest a long poll is held open waiting for a change, in seconds
+LONG_POLL_TIMEOUT = 30.0
+# Changes a slow subscriber may hold back in one stall before it is disconnected. Only the
+#  latest change for each device is kept, so this bounds how far it falls behind, not memory
+MAX_PENDING = 256
+
+def formatEvent(version, devId, device):
+    """
+    Formats a device change as a Server-Sent Event. Its ID is the state version, which a
+    reconnecting client sends back in Last-Event-ID to catch up on what it missed.
+    :param version: State version after the change
+    :type version: int
+    :param devId: Device ID
+    :type devId: str
+    :param device: The device's attributes
+    :type device: dict
+    :return: The event
+    :rtype: str
+    """
+    return "id: %s\nevent: device\ndata: %s\n\n" % (version, json.dumps({'id': devId, 'device': device},
+                                                                        sort_keys=True))
+
+@implementer(IPushProducer)
+class Subscriber(object):
+    """
+    This object is one client's open event stream. It is registered as the producer for
+    its connection, so when the client falls behind and the connection's buffer fills,
+    it is paused; while paused it holds back changes, only the latest for each device, and
+    sends them once resumed. A subscriber which holds back more than MAX_PENDING changes in
+    one stall is disconnected, leaving the client to reconnect and catch up.
+
+    Attributes:
+        request: The client's request, written to as changes arrive.
+        paused (bool): Whether the connection has asked for writes to stop.
+        pending (dict): Events held back while paused, by device ID.
+        heldBack (int): Changes held back since paused, counting each one, including those
+        replaced by a later change to the same device.
+    """
+    def __init__(self, request, stream):
+        """
+        :param request: The client's request
+        :param stream: The stream subscribed to
+        :type stream: ChangeStream
+        :return: None
+        """
+        self.request = request
+        self.stream = stream
+        self.paused = False
+        self.pending = {}
+        self.heldBack = 0
+
+    def send(self, devId, event):
+        """
+        Sends an event, or holds it back while paused.
+        :param devId: Device the event is about, or None for a heartbeat
+        :type devId: str
+        :param event: The formatted event
+        :type event: str
+        :return: None
+        """
+        if not self.paused:
+            self.request.write(event)
+        elif devId is not None:
+            self.pending[devId] = event
+            self.heldBack += 1
+            if self.heldBack > MAX_PENDING:
+                REGISTRY.inc(STREAM_DROPPED)
+                self.stream.unsubscribe(self)
+                self.request.finish()
+
+    def pauseProducing(self):
+        """
+        Built-in method to IPushProducer; the connection's buffer is full.
+        :return: None
+        """
+        self.paused = True
+
+    def resumeProducing(self):
+        """
+        Built-in method to IPushProducer; the connection has room again.
+        :return: None
+        """
+        self.paused = False
+        self.heldBack = 0
+        (pending, self.pending) = (self.pending, {})
+        if pending:
+            # Each event begins with its version, all of the same width, so this sends them
+            #  oldest first and leaves the client's Last-Event-ID at the newest
+            self.request.write(''.join(sorted(pending.values())))
+
+    def stopProducing(self):
+        """
+        Built-in method to IPushProducer; the connection is closing.
+        :return: None
+        """
+        self.stream.unsubscribe(self)
+
+class ChangeStream(object):
+    """
+    This object pushes every device change the crown applies, sensor readings included, to
+    the clients waiting on it: subscribers holding an event stream open, and long polls
+    waiting for the next change. Each change is formatted once, however many clients there
+    are, and idle clients cost no more than their connection: one timer sends heartbeats to
+    every subscriber, and a long poll has only its timeout.
+    """
+    def __init__(self, crown, callLater, heartbeat=HEARTBEAT_INTERVAL):
+        """
+        :param crown: The crown whose changes are pushed
+        :type crown: NeptuneCrown
+        :param callLater: Scheduler, e.g. reactor.callLater
+        :type callLater: callable
+        :param heartbeat: Seconds between heartbeats
+        :type heartbeat: float
+        :return: None
+        """
+        self.crown = crown
+        self.callLater = callLater
+        self.heartbeat = heartbeat
+        self.subscribers = set()
+        # Requests waiting for a change, with the version they hold and their timeout
+        self.polls = {}
+        self._beat = None
+        crown.listeners.append(self.deviceChanged)
+
+    def events(self, devIds):
+        """
+        Formats the current state of some devices as events.
+        :param devIds: Device IDs
+        :type devIds: list
+        :rtype: str
+        """
+        version = self.crown.deviceManager.version
+        devices = self.crown.devices
+        return ''.join(formatEvent(version, devId, devices[devId]) for devId in devIds)
+
+    def subscribe(self, request, since=None):
+        """
+        Opens an event stream on a request, starting with the devices changed since a
+        version, or every device.
+        :param request: The client's request
+        :param since: Version the client holds, e.g. from Last-Event-ID
+        :type since: int
+        :return: The subscriber
+        :rtype: Subscriber
+        """
+        subscriber = Subscriber(request, self)
+        request.registerProducer(subscriber, True)
+        request.notifyFinish().addBoth(lambda ignored: self.unsubscribe(subscriber))
+        changed = None
+        if since is not None:
+            changed = self.crown.deviceManager.changedSince(since)
+        if changed is None:
+            changed = sorted(self.crown.devices)
+        # Opening comment, so the client sees the stream start even with nothing to send
+        request.write(":ok\n\n" + self.events(changed))
+        self.subscribers.add(subscriber)
+        REGISTRY.set(STREAM_SUBSCRIBERS, len(self.subscribers))
+        if self._beat is None:
+            self._beat = self.callLater(self.heartbeat, self._sendHeartbeat)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        """
+        Stops sending changes to a subscriber, e.g. once its client has gone.
+        :return: None
+        """
+        if subscriber not in self.subscribers:
+            return
+        self.subscribers.discard(subscriber)
+        REGISTRY.set(STREAM_SUBSCRIBERS, len(self.subscribers))
+        subscriber.request.unregisterProducer()
+        if not self.subscribers and self._beat is not None:
+            if self._beat.active():
+                self._beat.cancel()
+            self._beat = None
+
+    def poll(self, request, since, timeout=LONG_POLL_TIMEOUT):
+        """
+        Answers a long poll: at once if devices have changed since the version the client
+        holds, otherwise with the next change, or with nothing after timeout seconds.
+        :param request: The client's request
+        :param since: Version the client holds
+        :type since: int
+        :param timeout: Seconds to wait at most
+        :type timeout: float
+        :return: None
+        """
+        changed = self.crown.deviceManager.changedSince(since)
+        if changed != []:
+            self._answerPoll(request, since, changed)
+            return
+        timer = self.callLater(timeout, self._pollTimedOut, request)
+        self.polls[request] = (since, timer)
+        request.notifyFinish().addBoth(lambda ignored: self._forgetPoll(request))
+
+    def _answerPoll(self, request, since, changed):
+        """
+        Internal method which answers a long poll with the devices changed since a version,
+        as JSON, along with the version to send next time.
+        :return: None
+        """
+        if changed is None:
+            changed = sorted(self.crown.devices)
+        devices = self.crown.devices
+        request.write(json.dumps({'version': self.crown.deviceManager.version,
+                                  'devices': dict((devId, devices[devId]) for devId in changed)},
+                                 sort_keys=True))
+        request.finish()
+
+    def _pollTimedOut(self, request):
+        """
+        Internal method which answers a long poll nothing has changed for.
+        :return: None
+        """
+        (since, timer) = self.polls.pop(request)
+        self._answerPoll(request, since, [])
+
+    def _forgetPoll(self, request):
+        """
+        Internal method which forgets a long poll once answered, or once the client has gone.
+        :return: None
+        """
+        (since, timer) = self.polls.pop(request, (None, None))
+        if timer is not None and timer.active():
+            timer.cancel()
+
+    def deviceChanged(self, devId):
+        """
+        Called by the crown whenever a device changes; pushes the change to every client.
+        :param devId: Device ID, or None if any device may have changed, e.g. on reload
+        :type devId: str
+        :return: None
+        """
+        devIds = sorted(self.crown.devices) if devId is None else [devId]
+        if self.subscribers:
+            for devId in devIds:
+                event = self.events([devId])
+                for subscriber in list(self.subscribers):
+                    subscriber.send(devId, event)
+        for (request, (since, timer)) in self.polls.items():
+            self._answerPoll(request, since, self.crown.deviceManager.changedSince(since))
+
+    def _sendHeartbeat(self):
+        """
+        Internal method which sends a comment down every idle event stream.
+        :return: None
+        """
+        self._beat = self.callLater(self.heartbeat, self._sendHeartbeat)
+        for subscriber in list(self.subscribers):
+            subscriber.send(None, ":\n\n")
@@ -0,0 +1,226 @@
+#-------------------------------------------------------------------------------
+# Name:        tracing.py
+# Purpose:     Module for Neptune Pool and Spa Automation containing the tracer,
+#              which follows a request or serial line through every stage of the
+#              service (crown, device save, log write, serial command and ack) and
+#              records how long each stage took.
+#
+# Author:      alji
+#
+# Created:     18/10/2026
+# Copyright:   (c) alji 2026
+# Licence:     <your licence>
+#-------------------------------------------------------------------------------
+import os
+import json
+import time
+import uuid
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+from modules.neptune.writer import InlineWriter
+
+# Spans kept in memory, newest last
+TRACE_RING = 4096
+# Seconds between writing recorded spans out to the trace file
+TRACE_FLUSH_INTERVAL = 1.0
+# Size at which the trace file is moved aside to .1, replacing the one there before
+MAX_TRACE_BYTES = 8 * 1024 * 1024
+# Sensor readings arrive several times a second; one serial line in this many is traced
+TRACE_SERIAL_EVERY = 10
+
+def appendSpans(path, lines):
+    """
+    Appends spans to the trace file, first moving a full file aside.
+    :param path: The trace file
+    :type path: str
+    :param lines: JSON lines, each including its newline
+    :type lines: str
+    :return: None
+    """
+    if os.path.exists(path) and os.path.getsize(path) >= MAX_TRACE_BYTES:
+        os.rename(path, path + '.1')
+    with open(path, 'a') as traceFile:
+        traceFile.write(lines)
+
+class Tracer(object):
+    """
+    This object records spans: the stages a request or serial line went through, with
+    when each began and how many milliseconds it took. Spans share the ID of the trace
+    they belong to, so a trace can be pieced together even from stages which finish long
+    after the request has been answered, such as a device save written behind or a serial
+    command acknowledged by the Arduino.
+
+    A trace is begun with trace(); while it runs, it is the current trace, and the stages
+    it calls into record their spans against it with span(). Stages which finish later note
+    the current trace ID when they are handed work, and record against it with record().
+
+    Spans are kept in a ring of the most recent TRACE_RING, and written out as JSON lines
+    to ~/.neptuneTraces.jsonl by flush(). Spans may be recorded on any thread, e.g. by the
+    disk writer; everything else belongs to the reactor thread.
+
+    Attributes:
+        current (str): ID of the trace under way, or None.
+        ring (deque): The most recent spans, oldest first.
+        enabled (bool): Whether new traces are begun.
+    """
+    def __init__(self, ringSize=TRACE_RING, writer=None, seconds=time.time):
+        """
+        :param ringSize: Spans kept in memory
+        :type ringSize: int
+        :param writer: Writer performing file writes; by default they happen immediately
+        :type writer: DiskWriter or InlineWriter
+        :param seconds: Clock
+        :type seconds: callable
+        :return: None
+        """
+        if writer is None:
+            writer = InlineWriter()
+        self.writer = writer
+        self.seconds = seconds
+        self.enabled = True
+        self.current = None
+        self.ring = deque(maxlen=ringSize)
+        # Spans not yet written out; should nothing flush, only the most recent are kept
+        self._pending = deque(maxlen=ringSize)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def trace(self, name, **attrs):
+        """
+        Begins a trace, as the current trace until the block ends, and records the whole
+        block as its first span.
+        :param name: What entered the service, e.g. "http" or "serial"
+        :type name: str
+        :param attrs: Further fields for the span, e.g. endpoint="/switch"
+        :return: The trace ID, or None if tracing is off
+        :rtype: str
+        """
+        if not self.enabled:
+            yield None
+            return
+        traceId = uuid.uuid4().hex[:16]
+        outer = self.current
+        self.current = traceId
+        start = self.seconds()
+        try:
+            yield traceId
+        finally:
+            self.current = outer
+            self.record(traceId, name, start, self.seconds() - start, **attrs)
+
+    @contextmanager
+    def span(self, name, **attrs):
+        """
+        Records the block as a span of the current trace; does nothing outside a trace.
+        :param name: The stage, e.g. "crown.setSwitchDevice"
+        :type name: str
+        :param attrs: Further fields for the span
+        :return: None
+        """
+        traceId = self.current
+        if traceId is None:
+            yield
+            return
+        start = self.seconds()
+        try:
+            yield
+        finally:
+            self.record(traceId, name, start, self.seconds() - start, **attrs)
+
+    def record(self, traceId, name, start, seconds, **attrs):
+        """
+        Records a span.
+        :param traceId: The trace the span belongs to
+        :type traceId: str
+        :param name: The stage
+        :type name: str
+        :param start: When the stage began
+        :type start: float
+        :param seconds: How long the stage took
+        :type seconds: float
+        :param attrs: Further fields for the span
+        :return: None
+        """
+        span = dict(attrs, trace=traceId, span=name, start=round(start, 6), ms=round(seconds * 1000.0, 3))
+        with self._lock:
+            self.ring.append(span)
+            self._pending.append(span)
+
+    def traced(self, name, waiting, func):
+        """
+        Wraps a write which finishes the work of one or more traces, so that each gets a span
+        from when it handed the work over until the write is done.
+        :param name: The stage, e.g. "log.write"
+        :type name: str
+        :param waiting: (trace ID, when its work was handed over) for each trace
+        :type waiting: list
+        :param func: The write
+        :type func: callable
+        :return: The wrapped write
+        :rtype: callable
+        """
+        if not waiting:
+            return func
+        def tracedCall(*args):
+            began = self.seconds()
+            try:
+                return func(*args)
+            finally:
+                done = self.seconds()
+                for (traceId, handedOver) in waiting:
+                    self.record(traceId, name, handedOver, done - handedOver,
+                                waitedMs=round((began - handedOver) * 1000.0, 3),
+                                writeMs=round((done - began) * 1000.0, 3))
+        return tracedCall
+
+    def get(self, traceId):
+        """
+        Finds the spans of a trace still in the ring.
+        :param traceId: Trace ID
+        :type traceId: str
+        :return: spans, in the order they began
+        :rtype: list
+        """
+        with self._lock:
+            spans = [span for span in self.ring if span['trace'] == traceId]
+        return sorted(spans, key=lambda span: span['start'])
+
+    def recent(self, count=20):
+        """
+        Lists the most recent traces still in the ring.
+        :param count: Traces wanted
+        :type count: int
+        :return: the first span of each trace, newest first
+        :rtype: list
+        """
+        with self._lock:
+            spans = list(self.ring)
+        firsts = {}
+        for span in spans:
+            if span['trace'] not in firsts or span['start'] < firsts[span['trace']]['start']:
+                firsts[span['trace']] = span
+        return sorted(firsts.values(), key=lambda span: span['start'], reverse=True)[:count]
+
+    def flush(self):
+        """
+        Writes every span recorded since the last flush to the trace file.
+        :return: Ticket for the write, or None if there was nothing to write
+        :rtype: WriteTicket
+        """
+        with self._lock:
+            (spans, self._pending) = (self._pending, deque(maxlen=self.ring.maxlen))
+        if not spans:
+            return None
+        # This software can be run on multiple platforms, each with its own env
+        #  variable for the home dir. The following ensures compatibility.
+        if os.environ.has_key('HOMEPATH'):
+            homeDir = os.environ['HOMEPATH']
+        else:
+            homeDir = os.environ['HOME']
+        lines = ''.join(json.dumps(span, sort_keys=True) + '\n' for span in spans)
+        return self.writer.submit(appendSpans, "%s/.neptuneTraces.jsonl" % homeDir, lines)
+
+# The tracer shared by the whole service
+TRACER = Tracer()
@@ -0,0 +1,148 @@
+#-------------------------------------------------------------------------------
+# Name:        writer.py
+# Purpose:     Module for Neptune Pool and Spa Automation containing the disk
+#              writer, a single background thread which performs file writes on
+#              behalf of the logger and device manager so that a slow disk never
+#              stalls the reactor.
+#
+# Author:      alji
+#
+# Created:     18/10/2026
+# Copyright:   (c) alji 2026
+# Licence:     <your licence>
+#-------------------------------------------------------------------------------
+import threading
+import traceback
+import Queue
+
+# Writes which may wait for the disk before submit() starts blocking the caller
+WRITE_QUEUE_SIZE = 1024
+
+class WriteTicket(object):
+    """
+    This object is handed back for every submitted write, and lets the submitter find
+    out when (and whether) the write has been done.
+
+    Attributes:
+        error (Exception): The exception raised by the write, if any.
+    """
+    def __init__(self):
+        self._done = threading.Event()
+        self.error = None
+
+    @property
+    def done(self):
+        """Whether the write has been attempted"""
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """
+        Blocks until the write has been attempted.
+        :param timeout: Seconds to wait at most, or None to wait indefinitely
+        :type timeout: float
+        :return: Whether the write was attempted in time
+        :rtype: bool
+        """
+        return self._done.wait(timeout)
+
+class DiskWriter(threading.Thread):
+    """
+    This object runs submitted writes one at a time, in the order they were submitted,
+    on its own thread. Because there is a single thread, a write can rely on every write
+    submitted before it having completed, e.g. a log segment is only moved once every
+    line bound for it has been appended.
+
+    The queue is bounded; once WRITE_QUEUE_SIZE writes are waiting, submit() blocks
+    until the disk catches up, rather than letting memory grow without limit.
+    """
+    def __init__(self, maxQueued=WRITE_QUEUE_SIZE):
+        """
+        :param maxQueued: Writes which may wait before submit() blocks
+        :type maxQueued: int
+        :return: None
+        """
+        threading.Thread.__init__(self, name="NeptuneDiskWriter")
+        self.daemon = True
+        self.queue = Queue.Queue(maxQueued)
+
+    @property
+    def depth(self):
+        """Number of writes waiting"""
+        return self.queue.qsize()
+
+    def submit(self, func, *args):
+        """
+        Queues func(*args) to run on the writer thread.
+        :param func: The write to perform
+        :type func: callable
+        :return: Ticket for the write
+        :rtype: WriteTicket
+        """
+        ticket = WriteTicket()
+        self.queue.put((func, args, ticket))
+        return ticket
+
+    def drain(self, timeout=None):
+        """
+        Blocks until every write submitted so far has been attempted.
+        :param timeout: Seconds to wait at most, or None to wait indefinitely
+        :type timeout: float
+        :return: Whether the queue drained in time
+        :rtype: bool
+        """
+        return self.submit(lambda: None).wait(timeout)
+
+    def stop(self):
+        """
+        Finishes every write submitted so far and then ends the thread.
+        :return: None
+        """
+        self.queue.put(None)
+        self.join()
+
+    def run(self):
+        """
+        Built-in method to threading.Thread; performs writes until stopped.
+        :return: None
+        """
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            (func, args, ticket) = job
+            try:
+                func(*args)
+            except Exception as e:
+                # One failed write must not stop the ones queued behind it
+                ticket.error = e
+                print("ERROR: Background write failed:\n%s" % traceback.format_exc())
+            ticket._done.set()
+
+class InlineWriter(object):
+    """
+    This object stands in for a DiskWriter where there is no reactor to protect, e.g.
+    in scripts: every write runs immediately, on the caller's thread, and any error is
+    raised to the caller.
+    """
+    depth = 0
+
+    def submit(self, func, *args):
+        """
+        Runs func(*args) immediately.
+        :param func: The write to perform
+        :type func: callable
+        :return: Ticket for the write, already done
+        :rtype: WriteTicket
+        """
+        ticket = WriteTicket()
+        func(*args)
+        ticket._done.set()
+        return ticket
+
+    def drain(self, timeout=None):
+        """Every write has already been done"""
+        return True
+
+    def stop(self):
+        """There is no thread to stop"""
+        pass
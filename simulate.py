@@ -0,0 +1,120 @@
+#!/usr/bin/python
+
+#-------------------------------------------------------------------------------
+# Name:        simulate.py
+# Purpose:     Runs a simulated Arduino for Neptune Pool and Spa Automation, either
+#              on a pseudo-terminal for main.py to open in place of the real port,
+#              or in-process against the serial resource for load and soak tests.
+#
+# Author:      alji
+#
+# Created:     18/10/2026
+# Copyright:   (c) alji 2026
+# Licence:     <your licence>
+#-------------------------------------------------------------------------------
+import os
+import sys
+import tty
+import random
+import tempfile
+import argparse
+
+from twisted.internet import reactor
+from twisted.internet.stdio import StandardIO
+from twisted.internet.task import LoopingCall
+from twisted.protocols.loopback import loopbackAsync
+
+from modules.neptune.simulator import ArduinoSimulator
+
+# Devices sent commands during a loopback run
+COMMANDED_DEVICES = ('1100', '1101', '2002', '3000', '3001', '3002', '3003')
+
+def runOnPty(simulator):
+    """
+    Attaches the simulator to a new pseudo-terminal, and prints the port to open.
+    :return: None
+    """
+    (master, slave) = os.openpty()
+    tty.setraw(slave)
+    StandardIO(simulator, stdin=master, stdout=master)
+    print("Simulated Arduino on %s; set COM_PORT in main.py to it" % os.ttyname(slave))
+
+def runOnLoopback(simulator, args):
+    """
+    Connects the simulator to a SerialResource and crown in this process, with a scratch
+    home directory, sends commands at the requested rate, and reports ingest figures.
+    :return: None
+    """
+    os.environ['HOME'] = tempfile.mkdtemp(prefix='neptuneSim')
+    os.environ.pop('HOMEPATH', None)
+    import main
+    from modules.neptune.crown import NeptuneCrown
+    from modules.neptune.writer import DiskWriter
+
+    writer = DiskWriter()
+    writer.start()
+    crown = NeptuneCrown(callLater=reactor.callLater, writer=writer, flushPolicy=main.LOG_FLUSH_POLICY)
+    serial = main.SerialResource(callLater=reactor.callLater, framing=args.framing,
+                                 acks=args.acks, port='loopback')
+    serial.setCrown(crown)
+    loopbackAsync(simulator, serial)
+    def shutdown():
+        crown.flush()
+        writer.stop()
+    reactor.addSystemEventTrigger('before', 'shutdown', shutdown)
+
+    if args.commands:
+        def command():
+            devId = random.choice(COMMANDED_DEVICES)
+            serial.serialWrite('>%ss%s' % (devId, random.randint(0, 1)))
+        LoopingCall(command).start(1.0 / args.commands)
+
+    last = {'readings': 0, 'at': reactor.seconds()}
+    def report():
+        now = reactor.seconds()
+        rate = (serial.readingsIn - last['readings']) / (now - last['at'])
+        last.update(readings=serial.readingsIn, at=now)
+        outbound = serial.outbound
+        sys.stderr.write("sent %s readings, %s malformed, %s stalls | took in %s (%.1f/s), "
+                         "%s bad | %s commands, %s acked, %s retried, %s failed, %s queued\n"
+                         % (simulator.readings, simulator.malformed, simulator.stalls,
+                            serial.readingsIn, rate, serial.badLines, outbound.sent,
+                            outbound.acked, outbound.retried, outbound.failed, outbound.depth))
+    LoopingCall(report).start(args.report, now=False)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Simulated Neptune Arduino")
+    parser.add_argument('mode', choices=('pty', 'loopback'),
+                        help="pty: wait for main.py on a pseudo-terminal; "
+                             "loopback: drive a serial resource in this process")
+    parser.add_argument('--rate', type=float, default=1.0, help="Readings per second per sensor")
+    parser.add_argument('--jitter', type=float, default=0.1,
+                        help="Largest change to the time between readings, as a fraction of it")
+    parser.add_argument('--malformed-every', type=int, default=0,
+                        help="Send a malformed line in place of one reading in this many")
+    parser.add_argument('--stall-every', type=float, default=0, help="Seconds between link stalls")
+    parser.add_argument('--stall-seconds', type=float, default=1.0, help="Seconds each stall lasts")
+    parser.add_argument('--no-acks', dest='acks', action='store_false',
+                        help="Do not acknowledge numbered commands")
+    parser.add_argument('--no-framing', dest='framing', action='store_false',
+                        help="Refuse binary frames")
+    parser.add_argument('--seed', type=int, default=None, help="Seed, for repeatable runs")
+    parser.add_argument('--commands', type=float, default=0,
+                        help="loopback: commands sent each second")
+    parser.add_argument('--report', type=float, default=5.0,
+                        help="loopback: seconds between reports")
+    parser.add_argument('--quiet', action='store_true',
+                        help="loopback: hide the service's output, leaving only the reports")
+    args = parser.parse_args()
+
+    simulator = ArduinoSimulator(reactor.callLater, rate=args.rate, jitter=args.jitter,
+                                 malformedEvery=args.malformed_every, stallEvery=args.stall_every,
+                                 stallSeconds=args.stall_seconds, acks=args.acks,
+                                 framing=args.framing, seed=args.seed)
+    if args.mode == 'pty':
+        runOnPty(simulator)
+    else:
+        if args.quiet:
+            sys.stdout = open(os.devnull, 'w')
+        runOnLoopback(simulator, args)
+    reactor.run()